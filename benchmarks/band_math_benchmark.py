@@ -0,0 +1,114 @@
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from calc.band_math import (
+    KERNEL_DTYPE,
+    linear_scale,
+    normalized_difference,
+    scratch_buffer,
+)
+
+# Compares the original whole-array index expressions with the fused float32
+# kernels on one synthetic scene, for time and peak numpy allocations
+# (tracemalloc tracks numpy buffers). Sizes default to a full Landsat scene.
+ST_MULTIPLIER = 0.00341802
+ST_ADD = 149.0
+NODATA = 0
+
+
+def legacy_ndvi(b4, b5, workspace):
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ndvi = np.where((b5 + b4) == 0, NODATA, (b5 - b4) / (b5 + b4))
+    return ndvi.astype(np.float32)
+
+
+def legacy_surface_temp(b10, workspace):
+    converted_b10 = ST_MULTIPLIER * b10 + ST_ADD
+    converted_b10[b10 == NODATA] = NODATA
+    return converted_b10
+
+
+def kernel_ndvi(b4, b5, workspace):
+    out = scratch_buffer(workspace, "out", b4.shape, KERNEL_DTYPE)
+    return normalized_difference(b5, b4, out, workspace, NODATA)
+
+
+def kernel_surface_temp(b10, workspace):
+    out = scratch_buffer(workspace, "out", b10.shape, KERNEL_DTYPE)
+    return linear_scale(b10, ST_MULTIPLIER, ST_ADD, out, workspace, NODATA)
+
+
+def blocked(kernel, block_rows):
+    # Same kernel over row blocks with one workspace, like run_block_calculation
+    def run(*arguments):
+        *bands, workspace = arguments
+        out = np.empty(bands[0].shape, dtype=KERNEL_DTYPE)
+        for start in range(0, out.shape[0], block_rows):
+            rows = slice(start, start + block_rows)
+            out[rows] = kernel(*[band[rows] for band in bands], workspace)
+        return out
+
+    return run
+
+
+def measure(function, bands, repeats):
+    times = []
+    peak = 0
+    for _ in range(repeats):
+        workspace = {}
+        tracemalloc.start()
+        start = time.perf_counter()
+        function(*bands, workspace)
+        times.append(time.perf_counter() - start)
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return min(times), peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark band math kernels.")
+    parser.add_argument("--height", type=int, default=7751)
+    parser.add_argument("--width", type=int, default=7621)
+    parser.add_argument("--block-rows", type=int, default=256)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    shape = (args.height, args.width)
+    b4 = rng.integers(7000, 30000, shape, dtype=np.uint16)
+    b5 = rng.integers(7000, 30000, shape, dtype=np.uint16)
+    b10 = rng.integers(40000, 50000, shape, dtype=np.uint16)
+    for band in [b4, b5, b10]:
+        band[:100] = NODATA
+    scene_mb = b4.nbytes / 2**20
+    print(f"Scene {shape[0]} x {shape[1]}, {scene_mb:.0f} MB per uint16 band")
+
+    cases = [
+        ("ndvi legacy", legacy_ndvi, (b4, b5)),
+        ("ndvi kernel", kernel_ndvi, (b4, b5)),
+        ("ndvi kernel blocked", blocked(kernel_ndvi, args.block_rows), (b4, b5)),
+        ("surface_temp legacy", legacy_surface_temp, (b10,)),
+        ("surface_temp kernel", kernel_surface_temp, (b10,)),
+        (
+            "surface_temp kernel blocked",
+            blocked(kernel_surface_temp, args.block_rows),
+            (b10,),
+        ),
+    ]
+    for name, function, bands in cases:
+        seconds, peak = measure(function, bands, args.repeats)
+        print(
+            f"{name:<30} {seconds:8.3f} s  peak {peak / 2**20:8.0f} MB "
+            f"({peak / b4.nbytes:4.1f}x band)"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,270 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+import rasterio
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from synthetic_scenes import generate_scenes
+from landsat_processor import (
+    process_dict,
+    build_scene_library,
+    target_reprojection_config,
+    output_file_path,
+    update_stat_tags,
+    process_landsat_data,
+)
+from calc.bulk_processing_methods import (
+    accumulate_scene,
+    bulk_group_keys,
+    finalize_accumulators,
+)
+from calc.qa_masking import resolve_qa_mask
+from file_methods.output_formats import open_output
+from file_methods.reprojection import reproject_band
+from execution.instrumentation import peak_rss_mb, reset_peak_rss
+
+# Times every stage of one processing method on synthetic scenes and records the
+# peak resident memory of each, as JSON that can be compared across commits.
+# Stages run one after another on whole arrays, unlike the fused block-by-block
+# processing, so read and compute are measured apart. Each stage only times its
+# own work: "grid" plans the shared target grid, "plan" reads the band headers and
+# MTL, and "write" writes the bands and the statistics computed in "stats".
+# "end_to_end" runs the method through process_landsat_data as the CLI does.
+STAGES = [
+    "discovery",
+    "grid",
+    "plan",
+    "read",
+    "compute",
+    "reproject",
+    "aggregate",
+    "stats",
+    "write",
+    "end_to_end",
+]
+
+
+def timed(stages, stage, function, *args, **kwargs):
+    # Runs function, adding its time to the stage and keeping the stage's peak RSS
+    reset_peak_rss()
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    seconds = time.perf_counter() - start
+    peak = peak_rss_mb()
+    stage_result = stages.setdefault(stage, {"seconds": 0.0, "peak_rss_mb": 0.0})
+    stage_result["seconds"] += seconds
+    if peak is not None:
+        stage_result["peak_rss_mb"] = max(stage_result["peak_rss_mb"], peak)
+    return result
+
+
+def read_sources(plan):
+    blocks = {}
+    for name, path in plan["sources"].items():
+        with rasterio.open(path) as src:
+            blocks[name] = src.read(1)
+    return blocks
+
+
+def compute_plan(plan, blocks):
+    # The whole scene as a single block
+    shape = next(iter(blocks.values())).shape
+    out = np.empty(shape, dtype=plan["dtype"])
+    return plan["block_calculator"](blocks, out, {})
+
+
+def write_scene(output_folder, scene_key, current_scene, stats):
+    # write_scene_output without its statistics pass
+    file_path = output_file_path(output_folder, scene_key, "benchmark")
+    with open_output(file_path, current_scene["meta"]) as destination:
+        update_stat_tags(destination, stats)
+        destination.write(current_scene["band"], 1)
+
+
+def run_stages(input_folder, processing_method, output_folder, qa_mask=None):
+    stages = {}
+    method = process_dict[processing_method]
+    bulk_process = method["bulk_process"]
+
+    scene_library = timed(stages, "discovery", build_scene_library, input_folder)
+    reprojection_config = None
+    if bulk_process:
+        reprojection_config = timed(
+            stages, "grid", target_reprojection_config, scene_library
+        )
+
+    accumulators = {}
+    output_library = {}
+    for scene, band_paths in scene_library.items():
+        plan = timed(stages, "plan", method["folder_plan"], band_paths, qa_mask=qa_mask)
+        blocks = timed(stages, "read", read_sources, plan)
+        band = timed(stages, "compute", compute_plan, plan, blocks)
+        del blocks
+        processed_scene = {"band": band, "meta": plan["meta"], "mtl": plan["mtl"]}
+        if bulk_process:
+            new_band, new_meta = timed(
+                stages,
+                "reproject",
+                reproject_band,
+                band,
+                plan["meta"],
+                reprojection_config,
+            )
+            processed_scene = {"band": new_band, "meta": new_meta, "mtl": plan["mtl"]}
+            timed(
+                stages,
+                "aggregate",
+                accumulate_scene,
+                accumulators,
+                bulk_group_keys[bulk_process](processed_scene),
+                processed_scene,
+            )
+        else:
+            output_library[os.path.basename(scene)] = processed_scene
+    if bulk_process:
+        output_library = timed(stages, "aggregate", finalize_accumulators, accumulators)
+
+    for scene_key, current_scene in output_library.items():
+        stats = timed(
+            stages,
+            "stats",
+            method["stat_calculator"],
+            current_scene["band"],
+            current_scene["meta"],
+            current_scene["mtl"],
+        )
+        timed(
+            stages, "write", write_scene, output_folder, scene_key, current_scene, stats
+        )
+    return stages
+
+
+def run_end_to_end(scene_folder, processing_method, output_folder, workers, qa_mask):
+    # Output names are built from scene keys relative to the working directory, so
+    # run from the scene folder's parent like the README does
+    parent, folder_name = os.path.split(os.path.abspath(scene_folder))
+    os.makedirs(os.path.join(output_folder, folder_name), exist_ok=True)
+    working_directory = os.getcwd()
+    os.chdir(parent)
+    try:
+        process_landsat_data(
+            f"./{folder_name}",
+            processing_method,
+            os.path.abspath(output_folder),
+            "benchmark",
+            workers=workers,
+            qa_mask=qa_mask,
+        )
+    finally:
+        os.chdir(working_directory)
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the processing stages on synthetic Landsat scenes."
+    )
+    parser.add_argument("--method", default="averaged_yearly_ndvi")
+    parser.add_argument("--scenes", type=int, default=4)
+    parser.add_argument("--height", type=int, default=1024)
+    parser.add_argument("--width", type=int, default=1024)
+    parser.add_argument("--years", type=int, default=2)
+    parser.add_argument("--cloud-fraction", type=float, default=0.1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--scene-folder",
+        default=None,
+        help="Reuse (or keep) the generated scenes in this folder",
+    )
+    parser.add_argument(
+        "--qa-mask",
+        nargs="*",
+        default=None,
+        help="Apply the QA_PIXEL mask, as the processor's --qa-mask",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=1, help="Workers for the end_to_end stage"
+    )
+    parser.add_argument("--output", default=None, help="Write the JSON result here")
+    args = parser.parse_args()
+
+    if args.method not in process_dict:
+        raise Exception(f"Unsupported processing method: {args.method}")
+    qa_mask = resolve_qa_mask(args.qa_mask)
+
+    with tempfile.TemporaryDirectory(prefix="landsat_benchmark_") as scratch:
+        scene_folder = args.scene_folder or os.path.join(scratch, "landsat")
+        if not os.path.isdir(scene_folder) or not os.listdir(scene_folder):
+            print(f"Generating {args.scenes} synthetic scenes in {scene_folder}...")
+            generate_scenes(
+                scene_folder,
+                args.scenes,
+                args.height,
+                args.width,
+                years=args.years,
+                cloud_fraction=args.cloud_fraction,
+                seed=args.seed,
+            )
+        stage_output = os.path.join(scratch, "stages")
+        end_to_end_output = os.path.join(scratch, "end_to_end")
+        os.makedirs(stage_output)
+        os.makedirs(end_to_end_output)
+
+        stages = run_stages(scene_folder, args.method, stage_output, qa_mask)
+        timed(
+            stages,
+            "end_to_end",
+            run_end_to_end,
+            scene_folder,
+            args.method,
+            end_to_end_output,
+            args.workers,
+            qa_mask,
+        )
+
+    result = {
+        "commit": git_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "gdal": rasterio.__gdal_version__,
+        "method": args.method,
+        "scenes": args.scenes,
+        "height": args.height,
+        "width": args.width,
+        "qa_mask": qa_mask,
+        "workers": args.workers,
+        # Whole process, ru_maxrss is in KB on Linux and not reset between stages
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "stages": {stage: stages[stage] for stage in STAGES if stage in stages},
+    }
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
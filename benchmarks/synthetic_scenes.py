@@ -0,0 +1,261 @@
+import argparse
+import json
+import os
+from datetime import date, timedelta
+
+import numpy as np
+import rasterio
+from rasterio.crs import CRS
+from rasterio.transform import from_origin
+from rasterio.warp import transform
+
+# Writes synthetic Collection 2 Level-2 scene folders that the processing methods
+# accept: uint16 band TIFFs, the ST_EMIS and ST_TRAD bands of the emissivity
+# method, a QA_PIXEL band with cloud blobs and an MTL JSON. The default bands
+# cover every index and surface temperature method.
+# Scenes alternate between two UTM zones and are shifted around a common centre so
+# bulk methods have to reproject them onto one grid. Everything is derived from a
+# seed, so the same arguments always give the same scenes.
+SCENE_CRS = ["EPSG:32617", "EPSG:32618"]
+SCENE_CENTER = (-78.0, 36.0)  # lon/lat on the zone 17/18 boundary
+PIXEL_SIZE = 30
+MAX_SHIFT_PIXELS = 64
+BLOCK_SIZE = 256
+
+REFLECTANCE_MULT = 2.75e-05
+REFLECTANCE_ADD = -0.2
+TEMPERATURE_MULT = 0.00341802
+TEMPERATURE_ADD = 149.0
+K1_CONSTANT_BAND_10 = 799.0284
+K2_CONSTANT_BAND_10 = 1329.2405
+DEFAULT_BANDS = (2, 3, 4, 5, 6, 10)
+# int16 ST_EMIS (scale 0.0001) and ST_TRAD (scale 0.001, W/(m2 sr um)) ranges
+EMISSIVITY_RANGE = (9600, 9900)
+THERMAL_RADIANCE_RANGE = (8000, 11000)
+ST_FILL = -9999
+
+# QA_PIXEL values of the real product for fill, clear land and high confidence cloud
+QA_FILL = 1
+QA_CLEAR = 21824
+QA_CLOUD = 22280
+
+# Digital number ranges that give plausible reflectances and temperatures
+band_ranges = {
+    2: (7500, 12000),
+    3: (8000, 13000),
+    4: (7500, 14000),
+    5: (12000, 26000),
+    6: (10000, 20000),
+    7: (8500, 16000),
+    10: (41000, 47000),
+}
+
+
+def scene_name(acquired):
+    day = acquired.strftime("%Y%m%d")
+    return f"LC09_L2SP_016035_{day}_{day}_02_T1"
+
+
+def scene_grid(index, rng, height, width):
+    crs = CRS.from_string(SCENE_CRS[index % len(SCENE_CRS)])
+    xs, ys = transform("EPSG:4326", crs, [SCENE_CENTER[0]], [SCENE_CENTER[1]])
+    shift_x, shift_y = rng.integers(-MAX_SHIFT_PIXELS, MAX_SHIFT_PIXELS + 1, 2)
+    left = round(xs[0] / PIXEL_SIZE + shift_x - width / 2) * PIXEL_SIZE
+    top = round(ys[0] / PIXEL_SIZE + shift_y + height / 2) * PIXEL_SIZE
+    return crs, from_origin(left, top, PIXEL_SIZE, PIXEL_SIZE)
+
+
+def footprint_mask(rng, height, width):
+    # Slanted fill margins on the left and right, like a real scene's swath edges
+    margin = max(width // 20, 1)
+    rows = np.arange(height)[:, None]
+    cols = np.arange(width)[None, :]
+    slope = margin / max(height, 1)
+    left = margin - rows * slope + rng.integers(0, margin + 1)
+    right = width - margin * 2 + rows * slope
+    return (cols >= left) & (cols < right)
+
+
+def cloud_mask(rng, height, width, cloud_fraction):
+    # A few elliptical blobs covering roughly cloud_fraction of the scene
+    clouds = np.zeros((height, width), dtype=bool)
+    if cloud_fraction <= 0:
+        return clouds
+    radius = max(min(height, width) // 12, 1)
+    blob_count = int(np.ceil(cloud_fraction * height * width / (np.pi * radius**2)))
+    rows = np.arange(height)[:, None]
+    cols = np.arange(width)[None, :]
+    for row, col in zip(
+        rng.integers(0, height, blob_count), rng.integers(0, width, blob_count)
+    ):
+        clouds |= ((rows - row) / radius) ** 2 + (
+            (cols - col) / (radius * 1.5)
+        ) ** 2 < 1
+    return clouds
+
+
+def band_values(rng, band_number, height, width, value_range=None, dtype=np.uint16):
+    # Smooth spatial pattern plus noise, so compression behaves like real imagery
+    low, high = value_range or band_ranges[band_number]
+    rows = np.linspace(0, 3 * np.pi, height, dtype=np.float32)[:, None]
+    cols = np.linspace(0, 2 * np.pi, width, dtype=np.float32)[None, :]
+    pattern = (np.sin(rows + band_number) * np.cos(cols) + 1) / 2
+    values = low + (high - low) * pattern
+    values += rng.normal(0, (high - low) * 0.02, (height, width)).astype(np.float32)
+    return np.clip(values, 1, np.iinfo(dtype).max).astype(dtype)
+
+
+def scene_mtl(name, acquired, cloud_cover):
+    reflectance_parameters = {}
+    for band_number in range(1, 8):
+        reflectance_parameters[f"REFLECTANCE_MULT_BAND_{band_number}"] = str(
+            REFLECTANCE_MULT
+        )
+        reflectance_parameters[f"REFLECTANCE_ADD_BAND_{band_number}"] = str(
+            REFLECTANCE_ADD
+        )
+    return {
+        "LANDSAT_METADATA_FILE": {
+            "PRODUCT_CONTENTS": {
+                "LANDSAT_PRODUCT_ID": name,
+                "PROCESSING_LEVEL": "L2SP",
+                "COLLECTION_NUMBER": "02",
+            },
+            "IMAGE_ATTRIBUTES": {
+                "SPACECRAFT_ID": "LANDSAT_9",
+                "WRS_PATH": "016",
+                "WRS_ROW": "035",
+                "DATE_ACQUIRED": acquired.isoformat(),
+                "CLOUD_COVER": f"{cloud_cover:.2f}",
+            },
+            "LEVEL2_SURFACE_REFLECTANCE_PARAMETERS": reflectance_parameters,
+            "LEVEL2_SURFACE_TEMPERATURE_PARAMETERS": {
+                "TEMPERATURE_MAXIMUM_BAND_ST_B10": "372.999941",
+                "TEMPERATURE_MINIMUM_BAND_ST_B10": "149.003418",
+                "TEMPERATURE_MULT_BAND_ST_B10": str(TEMPERATURE_MULT),
+                "TEMPERATURE_ADD_BAND_ST_B10": str(TEMPERATURE_ADD),
+            },
+            "LEVEL1_THERMAL_CONSTANTS": {
+                "K1_CONSTANT_BAND_10": str(K1_CONSTANT_BAND_10),
+                "K2_CONSTANT_BAND_10": str(K2_CONSTANT_BAND_10),
+            },
+        }
+    }
+
+
+def write_band(path, band, crs, transform, nodata):
+    height, width = band.shape
+    profile = {
+        "driver": "GTiff",
+        "dtype": band.dtype.name,
+        "nodata": nodata,
+        "width": width,
+        "height": height,
+        "count": 1,
+        "crs": crs,
+        "transform": transform,
+        "compress": "deflate",
+    }
+    if height >= BLOCK_SIZE and width >= BLOCK_SIZE:
+        profile.update(
+            {"tiled": True, "blockxsize": BLOCK_SIZE, "blockysize": BLOCK_SIZE}
+        )
+    with rasterio.open(path, "w", **profile) as dst:
+        dst.write(band, 1)
+
+
+def generate_scenes(
+    output_folder,
+    scene_count=4,
+    height=1024,
+    width=1024,
+    band_numbers=DEFAULT_BANDS,
+    years=2,
+    cloud_fraction=0.1,
+    seed=0,
+):
+    # Returns {scene folder: acquisition date} of the generated scenes
+    rng = np.random.default_rng(seed)
+    os.makedirs(output_folder, exist_ok=True)
+    scenes = {}
+    for index in range(scene_count):
+        acquired = date(2020 + index % years, 6, 1) + timedelta(days=16 * index)
+        name = scene_name(acquired)
+        scene_folder = os.path.join(output_folder, name)
+        os.makedirs(scene_folder, exist_ok=True)
+        crs, transform = scene_grid(index, rng, height, width)
+
+        footprint = footprint_mask(rng, height, width)
+        clouds = cloud_mask(rng, height, width, cloud_fraction) & footprint
+        qa = np.where(clouds, QA_CLOUD, QA_CLEAR).astype(np.uint16)
+        qa[~footprint] = QA_FILL
+        write_band(
+            os.path.join(scene_folder, f"{name}_QA_PIXEL.TIF"),
+            qa,
+            crs,
+            transform,
+            QA_FILL,
+        )
+        for band_number in band_numbers:
+            band = band_values(rng, band_number, height, width)
+            band[~footprint] = 0
+            prefix = "ST" if band_number == 10 else "SR"
+            write_band(
+                os.path.join(scene_folder, f"{name}_{prefix}_B{band_number}.TIF"),
+                band,
+                crs,
+                transform,
+                0,
+            )
+        for band_name, value_range in [
+            ("ST_EMIS", EMISSIVITY_RANGE),
+            ("ST_TRAD", THERMAL_RADIANCE_RANGE),
+        ]:
+            band = band_values(rng, 10, height, width, value_range, np.int16)
+            band[~footprint] = ST_FILL
+            write_band(
+                os.path.join(scene_folder, f"{name}_{band_name}.TIF"),
+                band,
+                crs,
+                transform,
+                ST_FILL,
+            )
+
+        cloud_cover = (
+            100 * np.count_nonzero(clouds) / max(np.count_nonzero(footprint), 1)
+        )
+        with open(os.path.join(scene_folder, f"{name}_MTL.json"), "w") as f:
+            json.dump(scene_mtl(name, acquired, cloud_cover), f, indent=2)
+        scenes[scene_folder] = acquired.isoformat()
+    return scenes
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Generate synthetic Landsat Collection 2 Level-2 scene folders."
+    )
+    parser.add_argument("output_folder")
+    parser.add_argument("--scenes", type=int, default=4)
+    parser.add_argument("--height", type=int, default=1024)
+    parser.add_argument("--width", type=int, default=1024)
+    parser.add_argument("--bands", type=int, nargs="+", default=DEFAULT_BANDS)
+    parser.add_argument("--years", type=int, default=2)
+    parser.add_argument("--cloud-fraction", type=float, default=0.1)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    scenes = generate_scenes(
+        args.output_folder,
+        args.scenes,
+        args.height,
+        args.width,
+        args.bands,
+        args.years,
+        args.cloud_fraction,
+        args.seed,
+    )
+    print(f"Wrote {len(scenes)} scenes to {args.output_folder}")
+
+
+if __name__ == "__main__":
+    main()
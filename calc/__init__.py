@@ -1,3 +1,9 @@
 from . import landsat_processing_methods
 from . import bulk_processing_methods
-from . import band_stat_calculators
\ No newline at end of file
+from . import band_stat_calculators
+from . import windowed_processing
+from . import band_math
+from . import band_expressions
+from . import product_processing
+from . import qa_masking
+from . import compositing
@@ -0,0 +1,220 @@
+import ast
+import re
+from functools import partial
+
+import numpy as np
+from file_methods.reprojection import reproject_band
+from file_methods.aoi import clip_plan_to_aoi
+from file_methods.scene_catalog import load_mtl
+from file_methods.raster_cache import open_raster
+from .band_math import KERNEL_DTYPE, scratch_buffer, linear_scale, safe_divide
+from .landsat_processing_methods import check_required_bands
+from .windowed_processing import run_multi_block_calculation
+from .qa_masking import mask_plan_with_qa
+
+# Spectral indices declared as arithmetic over band names. Only the bands an
+# expression uses are opened, and indices computed together share every decoded
+# block. "reflectance" scales the bands to surface reflectance with the MTL
+# coefficients first, which EVI and SAVI need for their constant terms. NDVI keeps
+# the digital numbers it has always been computed from. "range" bounds the
+# values counted in the band statistics.
+index_registry = {
+    "ndvi": {
+        "expression": "(B5 - B4) / (B5 + B4)",
+        "reflectance": False,
+        "range": (-1, 1),
+    },
+    "ndwi": {
+        "expression": "(B3 - B5) / (B3 + B5)",
+        "reflectance": True,
+        "range": (-1, 1),
+    },
+    "ndbi": {
+        "expression": "(B6 - B5) / (B6 + B5)",
+        "reflectance": True,
+        "range": (-1, 1),
+    },
+    "evi": {
+        "expression": "2.5 * (B5 - B4) / (B5 + 6 * B4 - 7.5 * B2 + 1)",
+        "reflectance": True,
+        "range": (-1, 1),
+    },
+    "savi": {
+        "expression": "1.5 * (B5 - B4) / (B5 + B4 + 0.5)",
+        "reflectance": True,
+        "range": (-1, 1),
+    },
+}
+
+# Names in an expression are Landsat band numbers, e.g. B5
+BAND_NAME_PATTERN = re.compile(r"B[0-9]+")
+EXPRESSION_OPERATORS = {
+    ast.Add: np.add,
+    ast.Sub: np.subtract,
+    ast.Mult: np.multiply,
+    ast.Div: None,  # safe_divide, zero denominators become nodata
+}
+
+
+def compile_expression(expression):
+    tree = ast.parse(expression, mode="eval").body
+    bands = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name):
+            if not BAND_NAME_PATTERN.fullmatch(node.id):
+                raise Exception(
+                    f"Unknown band {node.id} in band expression {expression}"
+                )
+            bands.add(node.id)
+        elif isinstance(node, ast.BinOp):
+            if type(node.op) not in EXPRESSION_OPERATORS:
+                raise Exception(f"Unsupported operator in band expression {expression}")
+        elif isinstance(node, ast.UnaryOp):
+            if not isinstance(node.op, (ast.USub, ast.UAdd)):
+                raise Exception(f"Unsupported operator in band expression {expression}")
+        elif isinstance(node, ast.Constant):
+            if not isinstance(node.value, (int, float)):
+                raise Exception(f"Unsupported constant in band expression {expression}")
+        elif not isinstance(node, (ast.operator, ast.unaryop, ast.expr_context)):
+            raise Exception(f"Unsupported syntax in band expression {expression}")
+    return {"expression": expression, "tree": tree, "bands": sorted(bands)}
+
+
+def evaluate_node(node, blocks, out, workspace, scaling, nodata, depth=0):
+    # Evaluate node into the float32 buffer out. The right hand operand of a
+    # nested operation goes to the scratch buffer of the next depth, so every
+    # level reuses the same few buffers block after block.
+    if isinstance(node, ast.Constant):
+        out.fill(node.value)
+    elif isinstance(node, ast.Name):
+        if node.id in scaling:
+            multiplier, offset = scaling[node.id]
+            linear_scale(blocks[node.id], multiplier, offset, out, workspace)
+        else:
+            np.copyto(out, blocks[node.id])
+    elif isinstance(node, ast.UnaryOp):
+        evaluate_node(node.operand, blocks, out, workspace, scaling, nodata, depth)
+        if isinstance(node.op, ast.USub):
+            np.negative(out, out=out)
+    else:
+        evaluate_node(node.left, blocks, out, workspace, scaling, nodata, depth)
+        right = operand_value(
+            node.right, blocks, out, workspace, scaling, nodata, depth
+        )
+        if isinstance(node.op, ast.Div):
+            safe_divide(out, right, workspace, nodata)
+        else:
+            EXPRESSION_OPERATORS[type(node.op)](out, right, out=out)
+    return out
+
+
+def operand_value(node, blocks, out, workspace, scaling, nodata, depth):
+    # Constants and unscaled bands are used as they are, anything else is
+    # evaluated into a scratch buffer
+    if isinstance(node, ast.Constant):
+        return KERNEL_DTYPE(node.value)
+    if isinstance(node, ast.Name) and node.id not in scaling:
+        return blocks[node.id]
+    buffer = scratch_buffer(workspace, f"expression_{depth + 1}", out.shape)
+    return evaluate_node(node, blocks, buffer, workspace, scaling, nodata, depth + 1)
+
+
+def index_block(blocks, out, workspace, compiled, scaling, nodata):
+    evaluate_node(compiled["tree"], blocks, out, workspace, scaling, nodata)
+    if nodata is not None:
+        # Fill pixels in any input band are nodata in the index
+        fill = scratch_buffer(workspace, "index_fill", out.shape, np.bool_)
+        band_fill = scratch_buffer(workspace, "index_band_fill", out.shape, np.bool_)
+        fill.fill(False)
+        for band in compiled["bands"]:
+            np.equal(blocks[band], nodata, out=band_fill)
+            np.logical_or(fill, band_fill, out=fill)
+        np.copyto(out, nodata, where=fill)
+    return out
+
+
+def reflectance_scaling(mtl, bands):
+    reflectance_params = mtl["LANDSAT_METADATA_FILE"][
+        "LEVEL2_SURFACE_REFLECTANCE_PARAMETERS"
+    ]
+    return {
+        band: (
+            float(reflectance_params[f"REFLECTANCE_MULT_BAND_{band[1:]}"]),
+            float(reflectance_params[f"REFLECTANCE_ADD_BAND_{band[1:]}"]),
+        )
+        for band in bands
+    }
+
+
+def index_plan(scene, index_name, qa_mask=None):
+    if index_name not in index_registry:
+        raise Exception(f"Unknown spectral index: {index_name}")
+    index = index_registry[index_name]
+    compiled = compile_expression(index["expression"])
+    check_required_bands(scene, compiled["bands"] + ["MTL"])
+
+    with open_raster(scene[compiled["bands"][0]]) as src:
+        meta = src.meta.copy()
+        nodata = src.nodatavals[0]  # Assuming nodata is the same for all bands
+
+    mtl = load_mtl(scene["MTL"])
+    scaling = (
+        reflectance_scaling(mtl, compiled["bands"]) if index["reflectance"] else {}
+    )
+    meta.update({"dtype": "float32", "nodata": nodata})
+
+    plan = {
+        "sources": {band: scene[band] for band in compiled["bands"]},
+        "block_calculator": partial(
+            index_block, compiled=compiled, scaling=scaling, nodata=nodata
+        ),
+        "dtype": KERNEL_DTYPE,
+        "meta": meta,
+        "mtl": mtl,
+    }
+    return mask_plan_with_qa(plan, scene, qa_mask) if qa_mask else plan
+
+
+def multi_index_plan(scene, index_names, qa_mask=None):
+    # One plan over the union of the bands, with a block calculator per index
+    index_plans = [index_plan(scene, index_name) for index_name in index_names]
+    plan = index_plans[0].copy()
+    del plan["block_calculator"]
+    plan["sources"] = {}
+    plan["block_calculators"] = {}
+    for index_name, single_plan in zip(index_names, index_plans):
+        plan["sources"].update(single_plan["sources"])
+        plan["block_calculators"][index_name] = single_plan["block_calculator"]
+    return mask_plan_with_qa(plan, scene, qa_mask) if qa_mask else plan
+
+
+def calc_indices(scene, index_names, reprojection_config=False, qa_mask=None):
+    # Returns {index name: {"band", "meta", "mtl"}} from a single read of the bands
+    print(f"Calculating {', '.join(index_names)} for {scene['MTL']}...")
+
+    plan = multi_index_plan(scene, index_names, qa_mask)
+    if reprojection_config and reprojection_config.get("aoi"):
+        plan = clip_plan_to_aoi(plan, reprojection_config["aoi"])
+    bands = run_multi_block_calculation(plan)
+
+    processed_indices = {}
+    for index_name in index_names:
+        if reprojection_config:
+            # Pixels outside the scene footprint stay nodata so they are not
+            # averaged in as real values
+            new_band, new_meta = reproject_band(
+                bands[index_name], plan["meta"], reprojection_config
+            )
+        else:
+            new_band = bands[index_name]
+            new_meta = plan["meta"]
+        processed_indices[index_name] = {
+            "band": new_band,
+            "meta": new_meta,
+            "mtl": plan["mtl"],
+        }
+    return processed_indices
+
+
+def calc_index(scene, index_name, reprojection_config=False, qa_mask=None):
+    return calc_indices(scene, [index_name], reprojection_config, qa_mask)[index_name]
@@ -0,0 +1,49 @@
+import numpy as np
+
+# Band math kernels that write into preallocated float32 buffers with out= ufuncs.
+# Integer bands are cast to float32 inside the ufunc, so there is no uint16
+# wraparound. Temporaries come from a workspace dict that is reused block after
+# block instead of being allocated per expression.
+KERNEL_DTYPE = np.float32
+
+
+def scratch_buffer(workspace, name, shape, dtype=KERNEL_DTYPE):
+    # One allocation per name, smaller (edge) blocks get a view of it
+    size = int(np.prod(shape))
+    buffer = workspace.get(name)
+    if buffer is None or buffer.size < size or buffer.dtype != dtype:
+        buffer = workspace[name] = np.empty(size, dtype=dtype)
+    return buffer[:size].reshape(shape)
+
+
+def fill_value(nodata):
+    return np.nan if nodata is None else nodata
+
+
+def safe_divide(out, denominator, workspace, nodata=None):
+    # out /= denominator in place, pixels with a zero denominator are set to nodata
+    nonzero = scratch_buffer(workspace, "safe_divide_mask", out.shape, np.bool_)
+    np.not_equal(denominator, 0, out=nonzero)
+    np.divide(out, denominator, out=out, where=nonzero)
+    np.logical_not(nonzero, out=nonzero)
+    np.copyto(out, fill_value(nodata), where=nonzero)
+    return out
+
+
+def normalized_difference(a, b, out, workspace, nodata=None):
+    # (a - b) / (a + b), pixels where a + b == 0 are set to nodata
+    total = scratch_buffer(workspace, "normalized_difference_total", out.shape)
+    np.subtract(a, b, out=out, dtype=KERNEL_DTYPE)
+    np.add(a, b, out=total, dtype=KERNEL_DTYPE)
+    return safe_divide(out, total, workspace, nodata)
+
+
+def linear_scale(band, multiplier, offset, out, workspace, nodata=None):
+    # multiplier * band + offset, source nodata pixels stay nodata
+    np.multiply(band, KERNEL_DTYPE(multiplier), out=out, dtype=KERNEL_DTYPE)
+    np.add(out, KERNEL_DTYPE(offset), out=out)
+    if nodata is not None:
+        fill = scratch_buffer(workspace, "linear_scale_mask", out.shape, np.bool_)
+        np.equal(band, nodata, out=fill)
+        np.copyto(out, nodata, where=fill)
+    return out
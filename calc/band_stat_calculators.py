@@ -1,9 +1,122 @@
 import numpy as np
 
 CELSIUS_SCALAR = -272.15
+# Histogram resolution used for the approximate median, fine enough to match the
+# quantization of the 16 bit Landsat products
+STAT_HISTOGRAM_BINS = 65536
+STAT_CHUNK_ROWS = 256
 
 
-def surface_temp_stats(band, meta, mtl, celsius=False):
+def new_stat_accumulator(low, high, nodata, exact_median=False, report_range=False):
+    # Valid pixels are those strictly inside (low, high) and not nodata,
+    # report_range reports low/high as min/max instead of the observed extremes
+    return {
+        "low": low,
+        "high": high,
+        "nodata": nodata,
+        "report_range": report_range,
+        "count": 0,
+        "mean": 0.0,
+        "m2": 0.0,
+        "min": np.inf,
+        "max": -np.inf,
+        "histogram": np.zeros(STAT_HISTOGRAM_BINS, dtype=np.int64),
+        "values": [] if exact_median else None,
+    }
+
+
+def update_stat_accumulator(accumulator, block):
+    # Fold one block (window, row chunk, ...) into the running statistics
+    valid = (block > accumulator["low"]) & (block < accumulator["high"])
+    if accumulator["nodata"] is not None:
+        valid &= block != accumulator["nodata"]
+    block_count = int(np.count_nonzero(valid))
+    if block_count == 0:
+        return accumulator
+
+    block_mean = np.sum(block, where=valid, dtype=np.float64) / block_count
+    deviation = np.subtract(block, block_mean, dtype=np.float64)
+    block_m2 = np.sum(np.square(deviation, out=deviation), where=valid)
+    merge_moments(accumulator, block_count, block_mean, block_m2)
+    accumulator["min"] = min(
+        accumulator["min"], float(np.min(block, where=valid, initial=np.inf))
+    )
+    accumulator["max"] = max(
+        accumulator["max"], float(np.max(block, where=valid, initial=-np.inf))
+    )
+
+    bin_width = (accumulator["high"] - accumulator["low"]) / STAT_HISTOGRAM_BINS
+    bins = ((block[valid] - accumulator["low"]) / bin_width).astype(np.int64)
+    np.clip(bins, 0, STAT_HISTOGRAM_BINS - 1, out=bins)
+    accumulator["histogram"] += np.bincount(bins, minlength=STAT_HISTOGRAM_BINS)
+
+    if accumulator["values"] is not None:
+        accumulator["values"].append(block[valid])
+    return accumulator
+
+
+def merge_moments(accumulator, count, mean, m2):
+    # Chan et al. parallel form of Welford's mean/variance update
+    total = accumulator["count"] + count
+    delta = mean - accumulator["mean"]
+    accumulator["mean"] += delta * count / total
+    accumulator["m2"] += m2 + delta**2 * accumulator["count"] * count / total
+    accumulator["count"] = total
+
+
+def merge_stat_accumulators(accumulator, other):
+    # Combine partial statistics, e.g. from different windows or worker processes
+    if other["count"] == 0:
+        return accumulator
+    merge_moments(accumulator, other["count"], other["mean"], other["m2"])
+    accumulator["min"] = min(accumulator["min"], other["min"])
+    accumulator["max"] = max(accumulator["max"], other["max"])
+    accumulator["histogram"] += other["histogram"]
+    if accumulator["values"] is not None:
+        accumulator["values"].extend(other["values"])
+    return accumulator
+
+
+def histogram_percentile(accumulator, percentile):
+    # Linear interpolation inside the histogram bin holding the requested rank
+    rank = (accumulator["count"] - 1) * percentile / 100
+    cumulative = np.cumsum(accumulator["histogram"])
+    bin_index = int(np.searchsorted(cumulative, rank, side="right"))
+    before = cumulative[bin_index - 1] if bin_index > 0 else 0
+    in_bin = accumulator["histogram"][bin_index]
+    bin_width = (accumulator["high"] - accumulator["low"]) / STAT_HISTOGRAM_BINS
+    position = (rank - before + 0.5) / in_bin
+    value = accumulator["low"] + (bin_index + position) * bin_width
+    return min(max(value, accumulator["min"]), accumulator["max"])
+
+
+def finalize_stats(accumulator):
+    if accumulator["count"] == 0:
+        return {key: np.nan for key in ["mean", "median", "std", "min", "max"]}
+    if accumulator["values"] is not None:
+        median = np.median(np.concatenate(accumulator["values"]))
+    else:
+        median = histogram_percentile(accumulator, 50)
+    min_key, max_key = (
+        ("low", "high") if accumulator["report_range"] else ("min", "max")
+    )
+    return {
+        "mean": accumulator["mean"],
+        "median": median,
+        "std": np.sqrt(accumulator["m2"] / accumulator["count"]),
+        "min": accumulator[min_key],
+        "max": accumulator[max_key],
+    }
+
+
+def accumulate_band(accumulator, band):
+    # Walk an in-memory (or memory mapped) band in row chunks
+    for start in range(0, band.shape[0], STAT_CHUNK_ROWS):
+        update_stat_accumulator(accumulator, band[start : start + STAT_CHUNK_ROWS])
+    return accumulator
+
+
+def surface_temp_stat_accumulator(meta, mtl, celsius=False, exact_median=False):
     celsius_scalar = CELSIUS_SCALAR if celsius else 0
     surface_temp_params = mtl["LANDSAT_METADATA_FILE"][
         "LEVEL2_SURFACE_TEMPERATURE_PARAMETERS"
@@ -14,24 +127,21 @@ def surface_temp_stats(band, meta, mtl, celsius=False):
     temp_max = (
         float(surface_temp_params["TEMPERATURE_MAXIMUM_BAND_ST_B10"]) + celsius_scalar
     )
-    filter_mask = (band != meta["nodata"]) & (band > temp_min) & (band < temp_max)
-    filtered_band = band[filter_mask]
-    return {
-        "mean": np.mean(filtered_band),
-        "median": np.median(filtered_band),
-        "std": np.std(filtered_band),
-        "min": np.min(filtered_band),
-        "max": np.max(filtered_band),
-    }
+    return new_stat_accumulator(temp_min, temp_max, meta["nodata"], exact_median)
 
 
-def ndvi_stats(band, meta, mtl):
-    filter_mask = (band != meta["nodata"]) & (band > -1) & (band < 1)
-    filtered_band = band[filter_mask]
-    return {
-        "mean": np.mean(filtered_band),
-        "median": np.median(filtered_band),
-        "std": np.std(filtered_band),
-        "min": -1,
-        "max": 1,
-    }
+def surface_temp_stats(band, meta, mtl, celsius=False, exact_median=False):
+    accumulator = surface_temp_stat_accumulator(meta, mtl, celsius, exact_median)
+    return finalize_stats(accumulate_band(accumulator, band))
+
+
+def index_stat_accumulator(meta, mtl, value_range=(-1, 1), exact_median=False):
+    low, high = value_range
+    return new_stat_accumulator(
+        low, high, meta["nodata"], exact_median, report_range=True
+    )
+
+
+def index_stats(band, meta, mtl, value_range=(-1, 1), exact_median=False):
+    accumulator = index_stat_accumulator(meta, mtl, value_range, exact_median)
+    return finalize_stats(accumulate_band(accumulator, band))
@@ -1,49 +1,140 @@
 import numpy as np
 from datetime import datetime
+from execution.instrumentation import measure_stage
+
+ACCUMULATION_DTYPE = np.float64
+COUNT_DTYPE = np.uint32
+SEASONS = ["DJF", "MAM", "JJA", "SON"]
+
+
+def iter_scenes(processed_scene_library):
+    # Bulk processors accept either a full scene library or a lazy stream of scenes
+    if isinstance(processed_scene_library, dict):
+        return iter(processed_scene_library.values())
+    return iter(processed_scene_library)
+
+
+def valid_pixel_mask(band, nodata):
+    valid = np.isfinite(band)
+    if nodata is not None:
+        valid &= band != nodata
+    return valid
+
+
+def accumulate_scene(accumulators, group_key, scene):
+    band = scene["band"]
+    if group_key not in accumulators:
+        accumulators[group_key] = {
+            "sum": np.zeros(band.shape, dtype=ACCUMULATION_DTYPE),
+            "count": np.zeros(band.shape, dtype=COUNT_DTYPE),
+            "scene_count": 0,
+            "dtype": np.result_type(band.dtype, np.float32),
+            # meta will be the same for all scenes due to reprojection, mtl is just for min/max reference
+            "meta": scene["meta"].copy(),
+            "mtl": scene["mtl"],
+        }
+    accumulator = accumulators[group_key]
+    product_id = (
+        scene["mtl"]["LANDSAT_METADATA_FILE"]
+        .get("PRODUCT_CONTENTS", {})
+        .get("LANDSAT_PRODUCT_ID")
+    )
+    with measure_stage("aggregate", product_id):
+        # Nodata fill, masked pixels and reprojection edges only add to the sum where valid
+        valid = valid_pixel_mask(band, scene["meta"]["nodata"])
+        np.add(accumulator["count"], valid, out=accumulator["count"], casting="unsafe")
+        np.add(accumulator["sum"], band, out=accumulator["sum"], where=valid)
+    accumulator["scene_count"] += 1
+
+
+def merge_accumulators(accumulator, other):
+    # Partial sums of the same group on the same grid, e.g. from different workers
+    np.add(accumulator["sum"], other["sum"], out=accumulator["sum"])
+    np.add(accumulator["count"], other["count"], out=accumulator["count"])
+    accumulator["scene_count"] += other["scene_count"]
+    return accumulator
+
+
+def finalize_accumulator(accumulator):
+    nodata = accumulator["meta"]["nodata"]
+    count = accumulator["count"]
+    bands_average = np.full(
+        count.shape, np.nan if nodata is None else nodata, dtype=accumulator["dtype"]
+    )
+    np.divide(
+        accumulator["sum"],
+        count,
+        out=bands_average,
+        where=count > 0,
+        casting="unsafe",
+    )
+    return {
+        "band": bands_average,
+        "count": count,
+        "meta": accumulator["meta"],
+        "mtl": accumulator["mtl"],
+    }
 
 
 def average_bands(scene_list):
-    band_sum = None
-    for scene in scene_list:
-        band, meta, mtl = (
-            scene["band"],
-            scene["meta"],
-            scene["mtl"],
-        )
-        if band_sum is None:
-            band_sum = np.zeros_like(band)
-        band_sum += band
+    accumulators = {}
+    for scene in iter_scenes(scene_list):
+        accumulate_scene(accumulators, "average", scene)
+    return finalize_accumulator(accumulators["average"])
+
+
+def print_num_scenes_by_year(accumulators_by_year):
+    for year in accumulators_by_year:
+        print(f"{year}: {accumulators_by_year[year]['scene_count']} scenes")
+
+
+def scene_year(scene):
+    date_acquired = scene["mtl"]["LANDSAT_METADATA_FILE"]["IMAGE_ATTRIBUTES"][
+        "DATE_ACQUIRED"
+    ]
+    date_obj = datetime.strptime(date_acquired, "%Y-%m-%d")
+    return date_obj.year
+
+
+def scene_month(scene):
+    date_acquired = scene["mtl"]["LANDSAT_METADATA_FILE"]["IMAGE_ATTRIBUTES"][
+        "DATE_ACQUIRED"
+    ]
+    return date_acquired[:7]
+
 
-    bands_average = band_sum / len(scene_list)
-    # meta will be the same for all scenes due to reprojection, mtl is just for min/max reference
-    return {"band": bands_average, "meta": meta.copy(), "mtl": mtl}
+def scene_season(scene):
+    # Meteorological seasons, December counts towards the next year's winter
+    date_obj = datetime.strptime(
+        scene["mtl"]["LANDSAT_METADATA_FILE"]["IMAGE_ATTRIBUTES"]["DATE_ACQUIRED"],
+        "%Y-%m-%d",
+    )
+    year = date_obj.year + 1 if date_obj.month == 12 else date_obj.year
+    return f"{year}_{SEASONS[date_obj.month % 12 // 3]}"
 
 
-def print_num_scenes_by_year(scenes_by_year):
-    for year in scenes_by_year:
-        print(f"{year}: {len(scenes_by_year[year])} scenes")
+def average_by_group(processed_scene_library, group_key):
+    accumulators = {}
+    for scene in iter_scenes(processed_scene_library):
+        accumulate_scene(accumulators, group_key(scene), scene)
+
+    print_num_scenes_by_year(accumulators)
+    return finalize_accumulators(accumulators)
 
 
 def average_by_year(processed_scene_library):
     print("Aggregating processed bands by year...")
 
-    scenes_by_year = {}
-
-    for scene in processed_scene_library:
-        date_acquired = processed_scene_library[scene]["mtl"]["LANDSAT_METADATA_FILE"][
-            "IMAGE_ATTRIBUTES"
-        ]["DATE_ACQUIRED"]
-        date_obj = datetime.strptime(date_acquired, "%Y-%m-%d")
-        year = date_obj.year
-        if year in scenes_by_year:
-            scenes_by_year[year].append(processed_scene_library[scene])
-        else:
-            scenes_by_year[year] = [processed_scene_library[scene]]
+    # Each scene is folded into its year's running sum as soon as it arrives, so a
+    # lazy scene stream never holds more than one scene plus one sum per year
+    accumulators = {}
+    for scene in iter_scenes(processed_scene_library):
+        accumulate_scene(accumulators, scene_year(scene), scene)
 
-    print_num_scenes_by_year(scenes_by_year)
+    print_num_scenes_by_year(accumulators)
     averages_by_year = {}
-    for year in scenes_by_year:
-        averages_by_year[f"{year}_average"] = average_bands(scenes_by_year[year])
+    for year in accumulators:
+        averages_by_year[f"{year}_average"] = finalize_accumulator(accumulators[year])
 
     return averages_by_year
 
@@ -51,7 +142,49 @@ def average_by_year(processed_scene_library):
 def average_all_data(scene_library):
     print("Averaging ALL processed bands into an average...")
 
-    scenes = list(scene_library.values())
-    averages = average_bands(scenes)
+    averages = average_bands(scene_library)
 
     return {"averaged_ST_entire_dataset": averages}
+
+
+def year_group_key(scene):
+    return f"{scene_year(scene)}_average"
+
+
+def entire_dataset_group_key(scene):
+    return "averaged_ST_entire_dataset"
+
+
+def month_group_key(scene):
+    return f"{scene_month(scene)}_average"
+
+
+def season_group_key(scene):
+    return f"{scene_season(scene)}_average"
+
+
+def average_by_month(processed_scene_library):
+    print("Aggregating processed bands by month...")
+    return average_by_group(processed_scene_library, month_group_key)
+
+
+def average_by_season(processed_scene_library):
+    print("Aggregating processed bands by season...")
+    return average_by_group(processed_scene_library, season_group_key)
+
+
+def finalize_accumulators(accumulators):
+    return {
+        group_key: finalize_accumulator(accumulators[group_key])
+        for group_key in accumulators
+    }
+
+
+# Output group each bulk process folds a scene into, used to update persisted
+# accumulators one scene at a time
+bulk_group_keys = {
+    average_by_year: year_group_key,
+    average_all_data: entire_dataset_group_key,
+    average_by_month: month_group_key,
+    average_by_season: season_group_key,
+}
@@ -0,0 +1,125 @@
+import os
+import tempfile
+import warnings
+from functools import partial
+
+import numpy as np
+
+from execution.instrumentation import measure_stage
+from execution.scene_pool import spill_band
+from .band_math import fill_value
+from .bulk_processing_methods import (
+    iter_scenes,
+    valid_pixel_mask,
+    print_num_scenes_by_year,
+    scene_year,
+    scene_month,
+    scene_season,
+)
+
+# Per-pixel temporal composites (median, percentiles, min/max) that a running sum
+# cannot give. Every processed scene is spilled to a scratch memory map as it
+# arrives, then each group of scenes is reduced one block at a time. A block spans
+# whole rows, or part of a row once one row of every scene is over the budget, so
+# at most COMPOSITE_BLOCK_BYTES of the stack is in memory at once (or a single
+# pixel of every scene, for more scenes than that holds). Nodata, masked and
+# out-of-footprint pixels are left out, like in the averages. max over an index
+# is the greenest (or wettest) pixel composite, e.g. max_yearly_ndvi.
+COMPOSITE_BLOCK_BYTES = 256 * 2**20
+
+composite_reducers = {
+    "median": np.nanmedian,
+    "p10": partial(np.nanpercentile, q=10),
+    "p25": partial(np.nanpercentile, q=25),
+    "p75": partial(np.nanpercentile, q=75),
+    "p90": partial(np.nanpercentile, q=90),
+    "min": np.nanmin,
+    "max": np.nanmax,
+}
+
+
+def entire_dataset(scene):
+    return "entire_dataset"
+
+
+composite_groupings = {
+    "yearly": scene_year,
+    "monthly": scene_month,
+    "seasonal": scene_season,
+    "all": entire_dataset,
+}
+
+
+def composite_block_shape(scene_count, height, width, itemsize):
+    # (rows, columns) of a block whose stack of every scene fits the budget
+    pixels = max(COMPOSITE_BLOCK_BYTES // (scene_count * itemsize), 1)
+    if pixels >= width:
+        return min(pixels // width, height), width
+    return 1, pixels
+
+
+def reduce_group(entries, reducer):
+    meta = entries[0]["meta"]
+    nodata = meta["nodata"]
+    height, width = entries[0]["band"].shape
+    dtype = np.result_type(entries[0]["band"].dtype, np.float32)
+    composite = np.empty((height, width), dtype=dtype)
+    count = np.empty((height, width), dtype=np.uint32)
+
+    rows, cols = composite_block_shape(len(entries), height, width, dtype.itemsize)
+    stack = np.empty((len(entries), rows, cols), dtype=dtype)
+    for row_start in range(0, height, rows):
+        row_stop = min(row_start + rows, height)
+        for col_start in range(0, width, cols):
+            col_stop = min(col_start + cols, width)
+            block = stack[:, : row_stop - row_start, : col_stop - col_start]
+            for index, entry in enumerate(entries):
+                block[index] = entry["band"][row_start:row_stop, col_start:col_stop]
+                block[index][~valid_pixel_mask(block[index], nodata)] = np.nan
+            valid_count = np.count_nonzero(~np.isnan(block), axis=0)
+            # All-NaN pixels warn and come back as NaN, they are filled below
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", RuntimeWarning)
+                reduced = composite_reducers[reducer](block, axis=0)
+            reduced[valid_count == 0] = fill_value(nodata)
+            composite[row_start:row_stop, col_start:col_stop] = reduced
+            count[row_start:row_stop, col_start:col_stop] = valid_count
+
+    return {
+        "band": composite,
+        "count": count,
+        "meta": meta.copy(),
+        "mtl": entries[0]["mtl"],
+    }
+
+
+def composite_scenes(processed_scene_library, reducer, grouping, scratch=None):
+    print(f"Compositing processed bands: {reducer} ({grouping})...")
+    group_key = composite_groupings[grouping]
+    with tempfile.TemporaryDirectory(
+        prefix="landsat_composite_", dir=scratch
+    ) as scratch_dir:
+        groups = {}
+        for index, scene in enumerate(iter_scenes(processed_scene_library)):
+            group = groups.setdefault(
+                group_key(scene), {"entries": [], "scene_count": 0}
+            )
+            group["entries"].append(
+                {
+                    "band": spill_band(
+                        scene["band"], os.path.join(scratch_dir, f"scene_{index}.npy")
+                    ),
+                    "meta": scene["meta"],
+                    "mtl": scene["mtl"],
+                }
+            )
+            group["scene_count"] += 1
+
+        print_num_scenes_by_year(groups)
+        composites = {}
+        for group in groups:
+            with measure_stage("aggregate", f"{group}_{reducer}"):
+                composites[f"{group}_{reducer}"] = reduce_group(
+                    groups[group]["entries"], reducer
+                )
+        return composites
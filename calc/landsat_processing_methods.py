@@ -1,27 +1,57 @@
-import json
+from functools import partial
+
 import numpy as np
-import rasterio
-from rasterio.warp import reproject, Resampling
+from rasterio.enums import Resampling
+from file_methods.reprojection import reproject_band
+from file_methods.aoi import clip_plan_to_aoi
+from file_methods.scene_catalog import load_mtl
+from file_methods.raster_cache import open_raster
 from .band_stat_calculators import CELSIUS_SCALAR
-
-def calc_surface_temp(scene, celsius=False, reprojection_config=False):
-    print(f"Calculating surface temperature for {scene['B10']}...")
-
-    required_bands = ["B10", "MTL"]
+from .band_math import KERNEL_DTYPE, fill_value, linear_scale, scratch_buffer
+from .windowed_processing import run_block_calculation
+from .qa_masking import mask_plan_with_qa
+
+# Emissivity corrected surface temperature, the chain of archive/process_landsat.py:
+# TOA radiance -> brightness temperature -> emissivity correction, fused into one
+# float32 pass per block over the thermal band and EMIS. Level-1 scenes give the
+# radiance as B10 digital numbers with the MTL rescaling factors. In L2SP scenes
+# B10 (ST_B10) already is surface temperature, their ST_TRAD band holds the TOA
+# radiance of band 10 instead.
+EMISSIVITY_SCALE = 0.0001
+LEVEL1_PROCESSING_LEVELS = ["L1TP", "L1GT", "L1GS"]
+THERMAL_RADIANCE_SCALE = 0.001  # ST_TRAD, W/(m2 sr um)
+THERMAL_RADIANCE_FILL = -9999
+B10_WAVELENGTH = 10.8e-6  # meters
+PLANCK_RATIO = 1.438e-2  # h * c / Boltzmann constant, mK
+
+
+def check_required_bands(scene, required_bands):
     all_bands_exist = all(band in scene for band in required_bands)
     if not all_bands_exist:
         raise Exception(
             f"Required bands are {required_bands}, only {scene.keys()} were provided"
         )
+
+
+def surface_temp_block(
+    blocks, out, workspace, multiplier, coefficient, celsius_scalar, nodata
+):
+    # Fill pixels are kept as nodata rather than rescaled into temperatures
+    return linear_scale(
+        blocks["B10"], multiplier, coefficient + celsius_scalar, out, workspace, nodata
+    )
+
+
+def surface_temp_plan(scene, celsius=False, qa_mask=None):
+    required_bands = ["B10", "MTL"]
+    check_required_bands(scene, required_bands)
     path_band_10 = scene["B10"]
     path_mtl = scene["MTL"]
 
-    with rasterio.open(path_band_10) as src:
-        b10 = src.read(1)
+    with open_raster(path_band_10) as src:
         meta = src.meta.copy()
 
-    with open(path_mtl, "r") as f:
-        mtl = json.load(f)
+    mtl = load_mtl(path_mtl)
 
     # Perform a temperature conversion calculation using metadata
     multiplier = float(
@@ -35,114 +65,158 @@ def calc_surface_temp(scene, celsius=False, reprojection_config=False):
         ]
     )
     celsius_scalar = CELSIUS_SCALAR if celsius else 0
-    converted_b10 = multiplier * b10 + coefficient + celsius_scalar
-
-    # Reproject if doing bulk processing
-    if reprojection_config:
-        dest_array = np.empty(
-            (reprojection_config["height"], reprojection_config["width"]),
-            dtype=converted_b10.dtype,
+    # Temperatures are written as floats, not in the uint16 type of the source band
+    meta.update({"dtype": "float32"})
+
+    plan = {
+        "sources": {"B10": path_band_10},
+        "block_calculator": partial(
+            surface_temp_block,
+            multiplier=multiplier,
+            coefficient=coefficient,
+            celsius_scalar=celsius_scalar,
+            nodata=meta["nodata"],
+        ),
+        "dtype": KERNEL_DTYPE,
+        "meta": meta,
+        "mtl": mtl,
+    }
+    return mask_plan_with_qa(plan, scene, qa_mask) if qa_mask else plan
+
+
+def emissivity_surface_temp_block(
+    blocks,
+    out,
+    workspace,
+    thermal_band,
+    radiance_mult,
+    radiance_add,
+    k1,
+    k2,
+    celsius_scalar,
+    nodata,
+):
+    thermal, emissivity = blocks[thermal_band], blocks["EMIS"]
+    correction = scratch_buffer(workspace, "emissivity_correction", out.shape)
+    fill = scratch_buffer(workspace, "emissivity_fill", out.shape, np.bool_)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # TOA radiance, L = ML * DN + AL
+        np.multiply(thermal, KERNEL_DTYPE(radiance_mult), out=out, dtype=KERNEL_DTYPE)
+        np.add(out, KERNEL_DTYPE(radiance_add), out=out)
+        # Brightness temperature, T = K2 / ln(K1 / L + 1)
+        np.divide(KERNEL_DTYPE(k1), out, out=out)
+        np.log1p(out, out=out)
+        np.divide(KERNEL_DTYPE(k2), out, out=out)
+        # Emissivity correction, LST = T / (1 + (wavelength * T / PLANCK_RATIO) * ln(e))
+        np.multiply(
+            emissivity,
+            KERNEL_DTYPE(EMISSIVITY_SCALE),
+            out=correction,
+            dtype=KERNEL_DTYPE,
         )
-        reproject(
-            source=converted_b10,
-            destination=dest_array,
-            src_transform=meta["transform"],
-            src_crs=meta["crs"],
-            dst_transform=reprojection_config["transform"],
-            dst_crs=reprojection_config["crs"],
-            resampling=Resampling.bilinear,
+        np.log(correction, out=correction)
+        np.multiply(correction, out, out=correction)
+        np.multiply(
+            correction, KERNEL_DTYPE(B10_WAVELENGTH / PLANCK_RATIO), out=correction
         )
-        new_band = dest_array
-        # Update meta with the reprojection config
-        new_meta = meta.copy()
-        new_meta.update(
-            {
-                "crs": reprojection_config["crs"],
-                "transform": reprojection_config["transform"],
-                "width": reprojection_config["width"],
-                "height": reprojection_config["height"],
-                "compress": "deflate",
-            }
+        np.add(correction, KERNEL_DTYPE(1), out=correction)
+        np.divide(out, correction, out=out)
+    if celsius_scalar:
+        np.add(out, KERNEL_DTYPE(celsius_scalar), out=out)
+
+    # Thermal band fill and missing emissivity (-9999 fill, or outside the EMIS
+    # band) are nodata
+    np.less_equal(emissivity, 0, out=fill)
+    if nodata is not None:
+        np.logical_or(fill, thermal == nodata, out=fill)
+    np.copyto(out, fill_value(nodata), where=fill)
+    return out
+
+
+def thermal_radiance_source(mtl):
+    # (band, radiance multiplier, radiance offset) of the band 10 TOA radiance
+    processing_level = mtl["LANDSAT_METADATA_FILE"]["PRODUCT_CONTENTS"][
+        "PROCESSING_LEVEL"
+    ]
+    if processing_level == "L2SP":
+        return "TRAD", THERMAL_RADIANCE_SCALE, 0.0
+    if processing_level in LEVEL1_PROCESSING_LEVELS:
+        rescaling = mtl["LANDSAT_METADATA_FILE"]["LEVEL1_RADIOMETRIC_RESCALING"]
+        return (
+            "B10",
+            float(rescaling["RADIANCE_MULT_BAND_10"]),
+            float(rescaling["RADIANCE_ADD_BAND_10"]),
         )
-    else:
-        new_band = converted_b10
-        new_meta = meta
+    raise Exception(
+        f"Emissivity corrected surface temperature needs a Level-1 or L2SP scene, "
+        f"got processing level {processing_level}"
+    )
 
-    return {
-        "band": new_band,
-        "meta": new_meta,
-        "mtl": mtl,
-    }
 
+def emissivity_surface_temp_plan(scene, celsius=False, qa_mask=None):
+    check_required_bands(scene, ["MTL"])
+    mtl = load_mtl(scene["MTL"])
+    thermal_band, radiance_mult, radiance_add = thermal_radiance_source(mtl)
+    check_required_bands(scene, [thermal_band, "EMIS", "MTL"])
 
+    with open_raster(scene[thermal_band]) as src:
+        meta = src.meta.copy()
 
+    if thermal_band == "TRAD" and meta["nodata"] is None:
+        meta["nodata"] = THERMAL_RADIANCE_FILL
+    thermal_constants = mtl["LANDSAT_METADATA_FILE"]["LEVEL1_THERMAL_CONSTANTS"]
+    meta.update({"dtype": "float32"})
+
+    plan = {
+        "sources": {thermal_band: scene[thermal_band], "EMIS": scene["EMIS"]},
+        # An EMIS band on another grid is resampled onto the thermal band's grid
+        # as it is read
+        "resampling": {"EMIS": Resampling.bilinear},
+        "block_calculator": partial(
+            emissivity_surface_temp_block,
+            thermal_band=thermal_band,
+            radiance_mult=radiance_mult,
+            radiance_add=radiance_add,
+            k1=float(thermal_constants["K1_CONSTANT_BAND_10"]),
+            k2=float(thermal_constants["K2_CONSTANT_BAND_10"]),
+            celsius_scalar=CELSIUS_SCALAR if celsius else 0,
+            nodata=meta["nodata"],
+        ),
+        "dtype": KERNEL_DTYPE,
+        "meta": meta,
+        "mtl": mtl,
+    }
+    return mask_plan_with_qa(plan, scene, qa_mask) if qa_mask else plan
 
-def calc_ndvi(scene, reprojection_config=False):
-    print(f"Calculating NDVI using {scene['B4']} and {scene['B5']}...")
 
-    required_bands = ["B4", "B5", "MTL"]
-    all_bands_exist = all(band in scene for band in required_bands)
-    if not all_bands_exist:
-        raise Exception(
-            f"Required bands are {required_bands}, only {scene.keys()} were provided"
-        )
+def calc_emissivity_surface_temp(
+    scene, celsius=False, reprojection_config=False, qa_mask=None
+):
+    print(f"Calculating emissivity corrected surface temperature for {scene['MTL']}...")
 
-    path_band_4 = scene["B4"]
-    path_band_5 = scene["B5"]
-    path_mtl = scene["MTL"]
+    plan = emissivity_surface_temp_plan(scene, celsius, qa_mask)
+    return process_scene_plan(plan, reprojection_config)
 
-    b4, b5, meta = None, None, None
 
-    with rasterio.open(path_band_4) as src:
-        b4 = src.read(1)
-        meta = src.meta.copy()
-        nodata = src.nodatavals[0]  # Assuming nodata is the same for both bands
+def calc_surface_temp(scene, celsius=False, reprojection_config=False, qa_mask=None):
+    print(f"Calculating surface temperature for {scene['B10']}...")
 
-    with rasterio.open(path_band_5) as src:
-        b5 = src.read(1)
+    plan = surface_temp_plan(scene, celsius, qa_mask)
+    return process_scene_plan(plan, reprojection_config)
 
-    with open(path_mtl, "r") as f:
-        mtl = json.load(f)
 
-    # Calculate NDVI with safe division and nodata handling
-    np.seterr(divide="ignore", invalid="ignore")
-    ndvi = np.where((b5 + b4) == 0, nodata, (b5 - b4) / (b5 + b4))
-    ndvi = ndvi.astype(np.float32)  # Ensure the output is float32 for NDVI values
+def process_scene_plan(plan, reprojection_config=False):
+    if reprojection_config and reprojection_config.get("aoi"):
+        plan = clip_plan_to_aoi(plan, reprojection_config["aoi"])
+    meta, mtl = plan["meta"], plan["mtl"]
+    band = run_block_calculation(plan)
 
+    # Reproject if doing bulk processing
     if reprojection_config:
-        # Prepare a destination array for reprojected NDVI data
-        dest_array = np.empty(
-            (reprojection_config["height"], reprojection_config["width"]),
-            dtype=ndvi.dtype,
-        )
-
-        reproject(
-            source=ndvi,
-            destination=dest_array,
-            src_transform=meta["transform"],
-            src_crs=meta["crs"],
-            dst_transform=reprojection_config["transform"],
-            dst_crs=reprojection_config["crs"],
-            resampling=Resampling.bilinear,
-        )
-        new_band = dest_array
-
-        new_meta = meta.copy()
-        new_meta.update(
-            {
-                "crs": reprojection_config["crs"],
-                "transform": reprojection_config["transform"],
-                "width": reprojection_config["width"],
-                "height": reprojection_config["height"],
-                "compress": "deflate",
-                "dtype": "float32",
-                "nodata": nodata,
-            }
-        )
+        new_band, new_meta = reproject_band(band, meta, reprojection_config)
     else:
-        new_band = ndvi
+        new_band = band
         new_meta = meta
-        new_meta.update({"dtype": "float32", "nodata": nodata})
 
     return {
         "band": new_band,
@@ -0,0 +1,52 @@
+from file_methods.reprojection import reproject_band
+from .band_expressions import index_registry, calc_indices
+
+# Several processing methods share one pass over the scenes. Each product
+# (surface temperature, an index, ...) is computed once per scene on its base
+# grid, the native scene grid or the AOI grid, and reprojected onto the shared
+# bulk grid only if a bulk method needs it there. Index products are computed
+# together so their bands are decoded once.
+
+
+def product_output_name(product, grid):
+    return f"{product}/{grid}"
+
+
+def process_scene_products(
+    band_paths, product_requests, reprojection_config=None, qa_mask=None
+):
+    # product_requests = {product: {"folder_process": fn, "grids": {"native",
+    # "target"}}}, returns {"<product>/<grid>": processed scene}
+    clip_to_aoi = bool(reprojection_config and reprojection_config.get("aoi"))
+    base_config = reprojection_config if clip_to_aoi else None
+    base_grid = "target" if clip_to_aoi else "native"
+
+    index_products = [
+        product for product in product_requests if product in index_registry
+    ]
+    base_products = (
+        calc_indices(band_paths, index_products, base_config, qa_mask)
+        if index_products
+        else {}
+    )
+    for product, request in product_requests.items():
+        if product not in base_products:
+            base_products[product] = request["folder_process"](
+                band_paths, reprojection_config=base_config, qa_mask=qa_mask
+            )
+
+    outputs = {}
+    for product, request in product_requests.items():
+        base = base_products[product]
+        if base_grid in request["grids"]:
+            outputs[product_output_name(product, base_grid)] = base
+        if "target" in request["grids"] and base_grid == "native":
+            new_band, new_meta = reproject_band(
+                base["band"], base["meta"], reprojection_config
+            )
+            outputs[product_output_name(product, "target")] = {
+                "band": new_band,
+                "meta": new_meta,
+                "mtl": base["mtl"],
+            }
+    return outputs
@@ -0,0 +1,74 @@
+from functools import partial
+
+import numpy as np
+
+from .band_math import fill_value, scratch_buffer
+
+# Collection 2 QA_PIXEL bit flags. A mask is applied inside the block calculation:
+# the QA band is read block by block alongside the science bands and flagged
+# pixels are set to nodata in the computed block, so statistics, averages and
+# their valid counts never see them and no full scene mask is allocated.
+QA_BAND = "QAPIXEL"
+qa_flag_bits = {
+    "fill": 0,
+    "dilated_cloud": 1,
+    "cirrus": 2,
+    "cloud": 3,
+    "cloud_shadow": 4,
+    "snow": 5,
+}
+DEFAULT_QA_MASK = ["fill", "dilated_cloud", "cloud", "cloud_shadow", "snow"]
+
+
+def resolve_qa_mask(qa_mask):
+    # None disables masking, an empty list (a bare --qa-mask) means the defaults
+    if qa_mask is None:
+        return None
+    if isinstance(qa_mask, str):
+        qa_mask = qa_mask.split(",")
+    for flag in qa_mask:
+        if flag not in qa_flag_bits:
+            raise Exception(f"Unknown QA_PIXEL flag: {flag}")
+    return sorted(set(qa_mask or DEFAULT_QA_MASK))
+
+
+def qa_bitmask(qa_mask):
+    bitmask = 0
+    for flag in qa_mask:
+        bitmask |= 1 << qa_flag_bits[flag]
+    return bitmask
+
+
+def qa_masked_block(blocks, out, workspace, block_calculator, bitmask, nodata):
+    result = block_calculator(blocks, out, workspace)
+    qa_block = blocks[QA_BAND]
+    flagged_bits = scratch_buffer(workspace, "qa_bits", qa_block.shape, qa_block.dtype)
+    flagged = scratch_buffer(workspace, "qa_flagged", qa_block.shape, np.bool_)
+    np.bitwise_and(qa_block, bitmask, out=flagged_bits)
+    np.not_equal(flagged_bits, 0, out=flagged)
+    np.copyto(result, fill_value(nodata), where=flagged)
+    return result
+
+
+def mask_plan_with_qa(plan, scene, qa_mask):
+    # Wrap the block calculator(s) of a plan so QA flagged pixels become nodata
+    if QA_BAND not in scene:
+        raise Exception(
+            f"QA masking needs the QA_PIXEL band, only {scene.keys()} were provided"
+        )
+    masked_plan = plan.copy()
+    # Appended last so the science band stays the reference grid of the plan
+    masked_plan["sources"] = {**plan["sources"], QA_BAND: scene[QA_BAND]}
+    masked_block = partial(
+        qa_masked_block, bitmask=qa_bitmask(qa_mask), nodata=plan["meta"]["nodata"]
+    )
+    if "block_calculators" in plan:
+        masked_plan["block_calculators"] = {
+            output: partial(masked_block, block_calculator=block_calculator)
+            for output, block_calculator in plan["block_calculators"].items()
+        }
+    else:
+        masked_plan["block_calculator"] = partial(
+            masked_block, block_calculator=plan["block_calculator"]
+        )
+    return masked_plan
@@ -0,0 +1,150 @@
+import os
+import time
+from contextlib import ExitStack
+
+import numpy as np
+from rasterio.vrt import WarpedVRT
+from rasterio.windows import Window
+
+from execution.instrumentation import record_stage
+from file_methods.raster_cache import open_raster, raster_key, read_block
+from .band_math import scratch_buffer
+
+
+def block_windows(src, region=None):
+    # Iterate over the internal tiles (or strips) of the first band, optionally
+    # cropped to a region window. Yields (read window, window relative to region).
+    for _, window in src.block_windows(1):
+        if region is None:
+            yield window, window
+            continue
+        col_start = max(window.col_off, region.col_off)
+        row_start = max(window.row_off, region.row_off)
+        col_stop = min(window.col_off + window.width, region.col_off + region.width)
+        row_stop = min(window.row_off + window.height, region.row_off + region.height)
+        if col_stop <= col_start or row_stop <= row_start:
+            continue
+        read_window = Window(
+            col_start, row_start, col_stop - col_start, row_stop - row_start
+        )
+        yield read_window, Window(
+            col_start - region.col_off,
+            row_start - region.row_off,
+            read_window.width,
+            read_window.height,
+        )
+
+
+def run_block_calculation(plan, destination=None, block_callback=None):
+    # plan = {"sources": {name: path}, "block_calculator": fn, "dtype": block dtype,
+    # "meta": output meta, optional "window" to only read part of the sources,
+    # optional "resampling": {name: Resampling} for sources on another grid}.
+    # destination is an open rasterio writer, a preallocated array, or None to
+    # allocate the output array here. Only one block of every source is held in
+    # memory at a time, read through the shared raster cache (raster_cache.py).
+    # The block_calculator is called as fn(blocks, out, workspace) and fills out,
+    # which is either the destination slice itself or a reused buffer, workspace
+    # holds its reused temporaries. block_callback receives every computed block,
+    # e.g. to fold it into running statistics.
+    multi_plan = plan.copy()
+    multi_plan["block_calculators"] = {"result": plan["block_calculator"]}
+    return run_multi_block_calculation(
+        multi_plan,
+        {"result": destination},
+        {"result": block_callback} if block_callback else None,
+    )["result"]
+
+
+def run_multi_block_calculation(plan, destinations=None, block_callbacks=None):
+    # Same as run_block_calculation for a plan with "block_calculators":
+    # {output: fn} instead of a single calculator. Every source block is read once
+    # and handed to each calculator. destinations and block_callbacks are dicts
+    # keyed by output, missing destinations are allocated here.
+    meta = plan["meta"]
+    destinations = dict(destinations or {})
+    for output in plan["block_calculators"]:
+        if destinations.get(output) is None:
+            destinations[output] = np.empty(
+                (meta["height"], meta["width"]), dtype=plan["dtype"]
+            )
+    block_callbacks = block_callbacks or {}
+    workspace = {}
+    # Wall/CPU seconds and bytes of the read, compute and stats parts of the loop
+    timings = {
+        stage: {"wall": 0.0, "cpu": 0.0, "bytes": 0}
+        for stage in ["read", "compute", "stats"]
+    }
+
+    with ExitStack() as stack:
+        sources = {
+            name: stack.enter_context(open_raster(path))
+            for name, path in plan["sources"].items()
+        }
+        keys = {name: raster_key(path) for name, path in plan["sources"].items()}
+        reference_name, reference = next(iter(sources.items()))
+        for name, src in sources.items():
+            if src.shape == reference.shape and src.transform == reference.transform:
+                continue
+            if name not in plan.get("resampling", {}):
+                raise Exception(
+                    f"Band {name} is not on the same grid as the other input bands"
+                )
+            # Warped block by block onto the reference grid as it is read
+            sources[name] = stack.enter_context(
+                WarpedVRT(
+                    src,
+                    crs=reference.crs,
+                    transform=reference.transform,
+                    width=reference.width,
+                    height=reference.height,
+                    resampling=plan["resampling"][name],
+                )
+            )
+            keys[name] += (keys[reference_name], plan["resampling"][name].name)
+
+        for window, out_window in block_windows(reference, plan.get("window")):
+            shape = (int(window.height), int(window.width))
+            started = (time.perf_counter(), time.thread_time())
+            blocks = {
+                name: read_block(
+                    src,
+                    keys[name],
+                    window,
+                    scratch_buffer(workspace, f"source_{name}", shape, src.dtypes[0]),
+                )
+                for name, src in sources.items()
+            }
+            started = add_timing(timings["read"], started)
+            timings["read"]["bytes"] += sum(block.nbytes for block in blocks.values())
+            for output, block_calculator in plan["block_calculators"].items():
+                destination = destinations[output]
+                if isinstance(destination, np.ndarray):
+                    out = destination[out_window.toslices()]
+                else:
+                    out = scratch_buffer(
+                        workspace, f"result_{output}", shape, plan["dtype"]
+                    )
+                result = block_calculator(blocks, out, workspace)
+                started = add_timing(timings["compute"], started)
+                if block_callbacks.get(output):
+                    block_callbacks[output](result)
+                    started = add_timing(timings["stats"], started)
+                if not isinstance(destination, np.ndarray):
+                    destination.write(result, 1, window=out_window)
+                    started = (time.perf_counter(), time.thread_time())
+
+    scene = os.path.basename(os.path.dirname(next(iter(plan["sources"].values()))))
+    for stage, timing in timings.items():
+        if timing["wall"]:
+            record_stage(
+                stage, scene, timing["wall"], timing["cpu"], bytes_read=timing["bytes"]
+            )
+    return destinations
+
+
+def add_timing(timing, started):
+    # Adds the time since started to timing and returns the new start
+    now = (time.perf_counter(), time.thread_time())
+    timing["wall"] += now[0] - started[0]
+    timing["cpu"] += now[1] - started[1]
+    return now
@@ -1,24 +1,43 @@
 import argparse
-import rasterio
-import numpy as np
+import sys
 
-def compare_rasters(original_path, output_path):
-    with rasterio.open(original_path) as orig, rasterio.open(output_path) as rast_out:
-        orig_data = orig.read()  # Read all bands
-        rast_out_data = rast_out.read()  # Read all bands
+from file_methods.raster_comparison import compare_raster_files
 
-    # Check if all data points are exactly the same across all bands
-    data_matches = np.array_equal(orig_data, rast_out_data)
-    print(f"Data matches across all bands: {data_matches}")
+def compare_rasters(original_path, output_path, tolerance=0.0, equal_only=False, threads=1):
+    # Walks both rasters block by block, see file_methods/raster_comparison.py
+    result = compare_raster_files(original_path, output_path, tolerance, equal_only, threads)
+
+    for discrepancy in result["metadata"]:
+        print(f"Metadata discrepancy in {discrepancy}")
+    if result.get("shape_mismatch"):
+        print("Rasters have different shapes or band counts, pixels were not compared")
+    elif equal_only:
+        print(f"Data matches across all bands: {result['equal']}")
+    else:
+        print(f"Data matches across all bands: {result['equal']}")
+        print(f"Compared pixels: {result['compared_pixels']}")
+        print(f"Pixels differing by more than {tolerance}: {result['differing_pixels']}")
+        print(f"Max abs diff: {result['max_abs_diff']}")
+        print(f"Mean abs diff: {result['mean_abs_diff']}")
+        if result["box"]:
+            row_min, col_min, row_max, col_max = result["box"]
+            print(f"Differences within rows {row_min}-{row_max}, columns {col_min}-{col_max}")
+            print(f"Bounds of the differences: {result['box_bounds']}")
+    return result
 
 def main():
     parser = argparse.ArgumentParser(description="Compare pixel values of two raster files.")
     parser.add_argument('original', help="Path to the original raster file")
     parser.add_argument('output', help="Path to the output raster file")
+    parser.add_argument('--tolerance', type=float, default=0.0, help="Absolute difference below which pixels count as equal")
+    parser.add_argument('--equal-only', action='store_true', help="Stop at the first difference instead of summarizing all of them")
+    parser.add_argument('--threads', type=int, default=1, help="Threads comparing blocks in parallel")
 
     args = parser.parse_args()
 
-    compare_rasters(args.original, args.output)
+    result = compare_rasters(args.original, args.output, args.tolerance, args.equal_only, args.threads)
+    # Non-zero exit status on any difference, for use as a regression gate
+    sys.exit(0 if result["equal"] and not result["metadata"] else 1)
 
 if __name__ == "__main__":
     main()
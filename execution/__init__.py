@@ -0,0 +1,5 @@
+from . import scene_pool
+from . import pipeline
+from . import instrumentation
+from . import task_graph
+from . import work_queue
\ No newline at end of file
@@ -0,0 +1,289 @@
+import cProfile
+import json
+import os
+import tempfile
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from functools import partial
+
+# Per-stage metrics (discovery, read, compute, reproject, aggregate, stats, write)
+# appended as JSON lines, one record per stage and scene, and optionally summed
+# into a Prometheus textfile at the end of the run. Stages nest: an enclosing
+# stage only reports its own time, what its inner stages took is subtracted, so
+# a windowed write does not count the reads and compute done inside it.
+# cpu_seconds is the CPU time of the measuring thread, so cpu well below wall
+# means the stage waited on I/O. peak_rss_mb is the process high water mark
+# since the outermost running stage started, overlapping stages on other
+# threads share it. Nothing is measured unless configure_metrics enabled it.
+metrics_config = {
+    "log_path": None,
+    "prometheus_path": None,
+    "trace_allocations": False,
+    "profile_scene": None,
+    "profile_folder": None,
+}
+_active_stages = threading.local()
+_log_lock = threading.Lock()
+
+STAGE_COUNTERS = ["bytes_read", "bytes_written"]
+PROMETHEUS_METRICS = [
+    ("wall_seconds", "landsat_stage_wall_seconds_total", "counter"),
+    ("cpu_seconds", "landsat_stage_cpu_seconds_total", "counter"),
+    ("bytes_read", "landsat_stage_bytes_read_total", "counter"),
+    ("bytes_written", "landsat_stage_bytes_written_total", "counter"),
+    ("count", "landsat_stage_runs_total", "counter"),
+    ("peak_rss_mb", "landsat_stage_peak_rss_megabytes", "gauge"),
+]
+
+
+def configure_metrics(
+    log_path=None,
+    prometheus_path=None,
+    trace_allocations=False,
+    profile_scene=None,
+    profile_folder=None,
+):
+    # A Prometheus textfile without a log still needs the records to sum up
+    if prometheus_path and not log_path:
+        handle, log_path = tempfile.mkstemp(
+            prefix="landsat_metrics_",
+            suffix=".jsonl",
+            dir=os.path.dirname(os.path.abspath(prometheus_path)),
+        )
+        os.close(handle)
+        metrics_config["temporary_log"] = True
+    metrics_config.update(
+        {
+            "log_path": log_path,
+            "prometheus_path": prometheus_path,
+            "trace_allocations": trace_allocations,
+            "profile_scene": profile_scene,
+            "profile_folder": profile_folder,
+        }
+    )
+    if trace_allocations and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def metrics_enabled():
+    return metrics_config["log_path"] is not None
+
+
+def finish_metrics():
+    if metrics_config["prometheus_path"]:
+        write_prometheus_textfile(
+            metrics_config["log_path"], metrics_config["prometheus_path"]
+        )
+        print(f"Wrote stage metrics to {metrics_config['prometheus_path']}")
+        if metrics_config.pop("temporary_log", False):
+            os.remove(metrics_config["log_path"])
+    elif metrics_enabled():
+        print(f"Wrote stage metrics to {metrics_config['log_path']}")
+
+
+def peak_rss_mb():
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def reset_peak_rss():
+    # Linux resets the VmHWM high water mark when 5 is written to clear_refs
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+    if metrics_config["trace_allocations"]:
+        tracemalloc.reset_peak()
+
+
+def stage_stack():
+    if not hasattr(_active_stages, "stack"):
+        _active_stages.stack = []
+    return _active_stages.stack
+
+
+def current_scene():
+    stack = stage_stack()
+    return stack[-1]["scene"] if stack else getattr(_active_stages, "scene", None)
+
+
+@contextmanager
+def scene_context(scene):
+    # Stages without an explicit scene are attributed to this one
+    previous = getattr(_active_stages, "scene", None)
+    _active_stages.scene = scene
+    try:
+        yield
+    finally:
+        _active_stages.scene = previous
+
+
+@contextmanager
+def measure_stage(stage, scene=None):
+    # Yields a dict where the stage adds its bytes_read / bytes_written counters
+    counters = dict.fromkeys(STAGE_COUNTERS, 0)
+    if not metrics_enabled():
+        yield counters
+        return
+
+    stack = stage_stack()
+    if not stack:
+        reset_peak_rss()
+    frame = {
+        "scene": scene or current_scene(),
+        "child_wall": 0.0,
+        "child_cpu": 0.0,
+        "allocated": (
+            tracemalloc.get_traced_memory()[0]
+            if metrics_config["trace_allocations"]
+            else None
+        ),
+    }
+    stack.append(frame)
+    wall_start = time.perf_counter()
+    cpu_start = time.thread_time()
+    try:
+        yield counters
+    finally:
+        wall = time.perf_counter() - wall_start
+        cpu = time.thread_time() - cpu_start
+        stack.pop()
+        record_stage(
+            stage,
+            frame["scene"],
+            wall - frame["child_wall"],
+            cpu - frame["child_cpu"],
+            allocated_start=frame["allocated"],
+            **counters,
+        )
+
+
+def record_stage(
+    stage, scene, wall_seconds, cpu_seconds, allocated_start=None, **counters
+):
+    # Appends one record, also used for stages timed by hand (the block loop)
+    if not metrics_enabled():
+        return
+    stack = stage_stack()
+    if stack:
+        stack[-1]["child_wall"] += wall_seconds
+        stack[-1]["child_cpu"] += cpu_seconds
+    record = {
+        "time": datetime.now(timezone.utc).isoformat(),
+        "pid": os.getpid(),
+        "thread": threading.current_thread().name,
+        "stage": stage,
+        "scene": scene or current_scene(),
+        "wall_seconds": wall_seconds,
+        "cpu_seconds": cpu_seconds,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+    record.update({counter: counters.get(counter, 0) for counter in STAGE_COUNTERS})
+    if metrics_config["trace_allocations"]:
+        current, peak = tracemalloc.get_traced_memory()
+        # Python and numpy allocations still held after the stage, and the
+        # highest traced total since the outermost stage started
+        if allocated_start is not None:
+            record["allocated_bytes"] = current - allocated_start
+        record["allocation_peak_bytes"] = peak
+    with _log_lock:
+        with open(metrics_config["log_path"], "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+
+def instrumented_folder_process(
+    folder_process, config, scene, reprojection_config=None
+):
+    # Drop-in folder_process that attributes stages to the scene and profiles the
+    # chosen scene. The config travels with it, so spawned worker processes
+    # record to the same log.
+    if not metrics_enabled():
+        metrics_config.update(config)
+    scene_name = os.path.basename(os.path.dirname(scene["MTL"]))
+    with scene_context(scene_name):
+        if config["profile_scene"] and config["profile_scene"] in scene_name:
+            return profile_folder_process(
+                folder_process, config, scene_name, scene, reprojection_config
+            )
+        return folder_process(scene, reprojection_config=reprojection_config)
+
+
+def profile_folder_process(
+    folder_process, config, scene_name, scene, reprojection_config
+):
+    profile_path = os.path.join(
+        config["profile_folder"] or ".", f"profile_{scene_name}.prof"
+    )
+    profiler = cProfile.Profile()
+    processed_scene = profiler.runcall(
+        folder_process, scene, reprojection_config=reprojection_config
+    )
+    profiler.dump_stats(profile_path)
+    print(f"Wrote cProfile stats for {scene_name} to {profile_path}")
+    return processed_scene
+
+
+def metrics_folder_process(folder_process):
+    # Wraps folder_process when metrics or profiling are on
+    if not metrics_enabled() and not metrics_config["profile_scene"]:
+        return folder_process
+    config = {
+        key: metrics_config[key]
+        for key in [
+            "log_path",
+            "trace_allocations",
+            "profile_scene",
+            "profile_folder",
+        ]
+    }
+    return partial(instrumented_folder_process, folder_process, config)
+
+
+def summarize_metrics(log_path):
+    # Per stage totals of every record in a JSON lines log
+    summary = {}
+    with open(log_path, "r") as f:
+        for line in f:
+            record = json.loads(line)
+            totals = summary.setdefault(
+                record["stage"],
+                {
+                    "wall_seconds": 0.0,
+                    "cpu_seconds": 0.0,
+                    "bytes_read": 0,
+                    "bytes_written": 0,
+                    "count": 0,
+                    "peak_rss_mb": 0.0,
+                },
+            )
+            for key in ["wall_seconds", "cpu_seconds", "bytes_read", "bytes_written"]:
+                totals[key] += record[key]
+            totals["count"] += 1
+            totals["peak_rss_mb"] = max(
+                totals["peak_rss_mb"], record["peak_rss_mb"] or 0
+            )
+    return summary
+
+
+def write_prometheus_textfile(log_path, prometheus_path):
+    summary = summarize_metrics(log_path)
+    lines = []
+    for key, metric, metric_type in PROMETHEUS_METRICS:
+        lines.append(f"# TYPE {metric} {metric_type}")
+        for stage in summary:
+            lines.append(f'{metric}{{stage="{stage}"}} {summary[stage][key]}')
+    # Written next to the target and renamed, so a collector never reads half a file
+    temp_path = f"{prometheus_path}.{os.getpid()}.tmp"
+    with open(temp_path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(temp_path, prometheus_path)
@@ -0,0 +1,114 @@
+import queue
+import threading
+
+# Scenes move between stages through bounded queues: reader threads decode and
+# process scenes (GDAL reads and numpy math both release the GIL), the caller
+# aggregates them and writer threads compute statistics and compress outputs. A
+# full queue blocks the stage feeding it, so only a few scenes are held in memory.
+PIPELINE_QUEUE_SIZE = 2
+# How often a blocked stage checks whether the pipeline was abandoned
+PIPELINE_POLL_SECONDS = 0.5
+_DONE = object()
+
+
+def start_threads(target, count):
+    threads = [threading.Thread(target=target, daemon=True) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+def put_unless_stopped(items, item, stop):
+    while not stop.is_set():
+        try:
+            items.put(item, timeout=PIPELINE_POLL_SECONDS)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def read_scenes_in_pipeline(
+    scene_library,
+    folder_process,
+    reprojection_config,
+    readers,
+    queue_size=PIPELINE_QUEUE_SIZE,
+):
+    # Yields (scene, processed_scene) pairs in completion order while the reader
+    # threads keep up to queue_size scenes ready ahead of the consumer
+    pending = queue.Queue()
+    for scene in scene_library:
+        pending.put(scene)
+    results = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+
+    def reader():
+        while not stop.is_set():
+            try:
+                scene = pending.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                item = (
+                    scene,
+                    folder_process(
+                        scene_library[scene], reprojection_config=reprojection_config
+                    ),
+                )
+            except Exception as error:
+                item = error
+            if not put_unless_stopped(results, item, stop):
+                return
+        put_unless_stopped(results, _DONE, stop)
+
+    threads = start_threads(reader, readers)
+    finished = 0
+    try:
+        while finished < len(threads):
+            item = results.get()
+            if item is _DONE:
+                finished += 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                yield item
+    finally:
+        # Also reached when the consumer stops early, readers exit at their next put
+        stop.set()
+
+
+def write_scenes_in_pipeline(
+    processed_scenes, write_scene, writers, queue_size=PIPELINE_QUEUE_SIZE
+):
+    # Hands every (scene, processed_scene) pair to writer threads and returns once
+    # all of them are written. The producer blocks while queue_size scenes wait.
+    pending = queue.Queue(maxsize=queue_size)
+    errors = []
+
+    def writer():
+        while True:
+            item = pending.get()
+            if item is _DONE:
+                return
+            if errors:
+                # Drain the queue without writing once a write failed
+                continue
+            try:
+                write_scene(*item)
+            except Exception as error:
+                errors.append(error)
+
+    threads = start_threads(writer, writers)
+    try:
+        for item in processed_scenes:
+            if errors:
+                break
+            pending.put(item)
+    finally:
+        for _ in threads:
+            pending.put(_DONE)
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise errors[0]
@@ -0,0 +1,92 @@
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+
+def band_to_scratch(processed_scene, scratch_path):
+    band = processed_scene["band"]
+    if isinstance(band, np.memmap) and band.filename:
+        # Already on disk (e.g. in the scene store), hand back that file instead
+        processed_scene["band"] = band.filename
+        processed_scene["scratch"] = False
+        return processed_scene
+    np.save(scratch_path, band)
+    processed_scene["band"] = scratch_path
+    processed_scene["scratch"] = True
+    return processed_scene
+
+
+def band_from_scratch(processed_scene):
+    band_path = processed_scene["band"]
+    processed_scene["band"] = np.load(band_path, mmap_mode="r")
+    if processed_scene.pop("scratch"):
+        # The mapping keeps the data readable after the file is unlinked
+        os.remove(band_path)
+    return processed_scene
+
+
+def spill_band(band, scratch_path):
+    # Keeps a band on disk instead of the heap, memory mapped bands (worker pool,
+    # scene store) already are
+    if isinstance(band, np.memmap):
+        return band
+    np.save(scratch_path, band)
+    return np.load(scratch_path, mmap_mode="r")
+
+
+def process_scene_to_scratch(
+    folder_process, band_paths, reprojection_config, scratch_path
+):
+    # Runs inside a worker process, the band goes to disk so only the small
+    # meta/mtl dicts travel back through the pickled result. A folder_process
+    # may also return several processed scenes keyed by name.
+    processed_scene = folder_process(
+        band_paths, reprojection_config=reprojection_config
+    )
+    if "band" in processed_scene:
+        return band_to_scratch(processed_scene, scratch_path)
+    scratch_base = os.path.splitext(scratch_path)[0]
+    return {
+        name: band_to_scratch(processed_scene[name], f"{scratch_base}_{index}.npy")
+        for index, name in enumerate(processed_scene)
+    }
+
+
+def process_scenes_in_pool(
+    scene_library, folder_process, reprojection_config, workers, scratch_folder=None
+):
+    # Yields (scene, processed_scene) pairs in completion order, bands are memory
+    # mapped from the scratch files so the parent never copies them
+    with tempfile.TemporaryDirectory(
+        prefix="landsat_scenes_", dir=scratch_folder
+    ) as scratch_dir, ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for index, scene in enumerate(scene_library):
+            scratch_path = os.path.join(scratch_dir, f"scene_{index}.npy")
+            future = executor.submit(
+                process_scene_to_scratch,
+                folder_process,
+                scene_library[scene],
+                reprojection_config,
+                scratch_path,
+            )
+            futures[future] = scene
+
+        for future in as_completed(futures):
+            processed_scene = future.result()
+            if "band" in processed_scene:
+                processed_scene = band_from_scratch(processed_scene)
+            else:
+                for name in processed_scene:
+                    band_from_scratch(processed_scene[name])
+            yield futures[future], processed_scene
+
+
+def map_scenes_in_pool(task, task_arguments, workers):
+    # For tasks that write their own outputs and only return small results
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(task, *arguments) for arguments in task_arguments]
+        for future in as_completed(futures):
+            yield future.result()
@@ -0,0 +1,220 @@
+import json
+import os
+import shutil
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from functools import partial
+
+# Processing split into tasks with explicit dependencies, so it can be spread over
+# worker processes on one machine or over several machines sharing storage. For
+# averaged methods each scene task folds its scene into a partial sum/count file,
+# merge tasks add up to REDUCTION_FAN_IN partials of one group at a time (a tree
+# reduction) and a write task per group finalizes the average. Per-scene methods
+# are one task per scene that also writes the output. Tasks are picklable
+# callables taking no arguments and only exchange files, so any executor that
+# runs a task after its dependencies works: the local process pool below or the
+# SQLite work queue in work_queue.py.
+REDUCTION_FAN_IN = 8
+PARTIALS_FOLDER = ".partials"
+
+
+def new_task_graph():
+    # {task_id: {"function": callable, "dependencies": [task_id, ...]}}
+    return {}
+
+
+def add_task(graph, task_id, function, dependencies=()):
+    for dependency in dependencies:
+        if dependency not in graph:
+            raise Exception(f"Task {task_id} depends on unknown task {dependency}")
+    graph[task_id] = {"function": function, "dependencies": list(dependencies)}
+    return task_id
+
+
+def save_partial(path, accumulator):
+    # Imported here, calc and file_methods import the execution package themselves
+    from file_methods.run_manifest import save_accumulator
+
+    # Arrays in an .npz, the rest of the accumulator in a JSON sidecar
+    entry = save_accumulator(path, accumulator)
+    temp_path = f"{path}.json.tmp"
+    with open(temp_path, "w") as f:
+        json.dump(entry, f)
+    os.replace(temp_path, f"{path}.json")
+
+
+def load_partial(path):
+    from file_methods.run_manifest import load_accumulator
+
+    with open(f"{path}.json", "r") as f:
+        return load_accumulator(json.load(f))
+
+
+def scene_partial_task(folder_process, band_paths, reprojection_config, partial_path):
+    from calc.bulk_processing_methods import accumulate_scene
+
+    processed_scene = folder_process(
+        band_paths, reprojection_config=reprojection_config
+    )
+    accumulators = {}
+    accumulate_scene(accumulators, "partial", processed_scene)
+    save_partial(partial_path, accumulators["partial"])
+
+
+def merge_partials_task(partial_paths, partial_path):
+    from calc.bulk_processing_methods import merge_accumulators
+
+    accumulator = load_partial(partial_paths[0])
+    for path in partial_paths[1:]:
+        merge_accumulators(accumulator, load_partial(path))
+    save_partial(partial_path, accumulator)
+
+
+def write_partial_task(write_output, group, partial_path):
+    from calc.bulk_processing_methods import finalize_accumulator
+
+    write_output(group, finalize_accumulator(load_partial(partial_path)))
+
+
+def scene_output_task(
+    folder_process, band_paths, reprojection_config, write_output, scene
+):
+    write_output(
+        scene, folder_process(band_paths, reprojection_config=reprojection_config)
+    )
+
+
+def add_reduction_tasks(graph, group, partial_paths, partials_folder, fan_in):
+    # partial_paths = {task_id: partial written by that task}, merged fan_in at a
+    # time until one is left. Returns (task_id, partial path) of the root.
+    level = 0
+    while len(partial_paths) > 1:
+        merged = {}
+        task_ids = list(partial_paths)
+        for start in range(0, len(task_ids), fan_in):
+            inputs = task_ids[start : start + fan_in]
+            task_id = f"merge/{group}/{level}/{start // fan_in}"
+            path = os.path.join(
+                partials_folder, f"{group}_{level}_{start // fan_in}.npz"
+            )
+            add_task(
+                graph,
+                task_id,
+                partial(
+                    merge_partials_task,
+                    [partial_paths[input_id] for input_id in inputs],
+                    path,
+                ),
+                inputs,
+            )
+            merged[task_id] = path
+        partial_paths = merged
+        level += 1
+    return next(iter(partial_paths.items()))
+
+
+def bulk_task_graph(
+    scene_groups,
+    scene_library,
+    folder_process,
+    reprojection_config,
+    write_output,
+    partials_folder,
+    fan_in=REDUCTION_FAN_IN,
+):
+    # scene_groups = {scene: output group}
+    graph = new_task_graph()
+    group_partials = {}
+    for index, scene in enumerate(scene_library):
+        task_id = f"scene/{scene}"
+        path = os.path.join(partials_folder, f"scene_{index}.npz")
+        add_task(
+            graph,
+            task_id,
+            partial(
+                scene_partial_task,
+                folder_process,
+                scene_library[scene],
+                reprojection_config,
+                path,
+            ),
+        )
+        group_partials.setdefault(scene_groups[scene], {})[task_id] = path
+
+    for group, partial_paths in group_partials.items():
+        root_id, root_path = add_reduction_tasks(
+            graph, group, partial_paths, partials_folder, fan_in
+        )
+        add_task(
+            graph,
+            f"write/{group}",
+            partial(write_partial_task, write_output, group, root_path),
+            [root_id],
+        )
+    return graph
+
+
+def scene_task_graph(scene_library, folder_process, reprojection_config, write_output):
+    graph = new_task_graph()
+    for scene in scene_library:
+        add_task(
+            graph,
+            f"scene/{scene}",
+            partial(
+                scene_output_task,
+                folder_process,
+                scene_library[scene],
+                reprojection_config,
+                write_output,
+                scene,
+            ),
+        )
+    return graph
+
+
+def partials_folder_path(output_path, run):
+    folder = os.path.join(output_path, PARTIALS_FOLDER, run)
+    os.makedirs(folder, exist_ok=True)
+    return folder
+
+
+def remove_partials(folder):
+    shutil.rmtree(folder, ignore_errors=True)
+    try:
+        os.rmdir(os.path.dirname(folder))
+    except OSError:
+        # Another run's partials are still there
+        pass
+
+
+def run_task(function):
+    return function()
+
+
+def run_task_graph_in_pool(graph, workers):
+    # Local backend, tasks are submitted as soon as their dependencies are done.
+    # Each task keeps a count of unfinished dependencies and is queued when it
+    # drops to zero, so scheduling is linear in the number of tasks and edges.
+    waiting_on = {task_id: len(task["dependencies"]) for task_id, task in graph.items()}
+    dependents = {task_id: [] for task_id in graph}
+    for task_id, task in graph.items():
+        for dependency in task["dependencies"]:
+            dependents[dependency].append(task_id)
+    ready = deque(task_id for task_id, count in waiting_on.items() if count == 0)
+    running = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        while ready or running:
+            while ready:
+                task_id = ready.popleft()
+                running[executor.submit(run_task, graph[task_id]["function"])] = task_id
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                task_id = running.pop(future)
+                try:
+                    future.result()
+                except Exception as error:
+                    raise Exception(f"Task {task_id} failed: {error}") from error
+                for dependent in dependents[task_id]:
+                    waiting_on[dependent] -= 1
+                    if waiting_on[dependent] == 0:
+                        ready.append(dependent)
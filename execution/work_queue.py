@@ -0,0 +1,246 @@
+import argparse
+import os
+import pickle
+import runpy
+import shutil
+import socket
+import sqlite3
+import sys
+import time
+import traceback
+import types
+from multiprocessing import get_context
+
+# A SQLite file work queue for task graphs (see task_graph.py). The coordinator
+# writes every task, pickled, with its dependencies, and any number of workers,
+# local processes or other machines that see the same storage, claim tasks whose
+# dependencies are done. Claims run in an IMMEDIATE transaction, so two workers
+# never take the same task. A running task whose claim is older than the lease is
+# handed out again (its worker is assumed dead), and a failing task is retried
+# before the whole queue is marked failed. SQLite locking needs a filesystem with
+# working POSIX locks, which NFS only has with a lock manager.
+#
+# Workers unpickle the task payloads and run the coordinator's main script, so
+# anyone who can write the queue file or its folder can run code as the workers.
+# Keep the queue in a folder only trusted users can write to. The main script is
+# copied next to the queue file, and a worker refuses to load one from anywhere
+# else.
+QUEUE_POLL_SECONDS = 1.0
+TASK_LEASE_SECONDS = 3600
+TASK_ATTEMPTS = 3
+QUEUE_TIMEOUT_SECONDS = 60
+
+
+def connect_queue(queue_path):
+    connection = sqlite3.connect(
+        queue_path, timeout=QUEUE_TIMEOUT_SECONDS, isolation_level=None
+    )
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS queue_info (key TEXT PRIMARY KEY, value TEXT)"
+    )
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS tasks (id TEXT PRIMARY KEY, payload BLOB, "
+        "state TEXT, worker TEXT, claimed REAL, attempts INTEGER, error TEXT)"
+    )
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS dependencies (task TEXT, dependency TEXT)"
+    )
+    return connection
+
+
+def create_work_queue(queue_path, graph):
+    # Replaces whatever the queue held. Workers run tasks from the coordinator's
+    # working directory, with a copy of its main script loaded for the pickled
+    # functions.
+    main_source = os.path.abspath(getattr(sys.modules["__main__"], "__file__", ""))
+    main_path = ""
+    if os.path.isfile(main_source):
+        main_path = os.path.abspath(queue_path) + ".main.py"
+        shutil.copyfile(main_source, main_path)
+    connection = connect_queue(queue_path)
+    with connection:
+        connection.execute("BEGIN IMMEDIATE")
+        for table in ["queue_info", "tasks", "dependencies"]:
+            connection.execute(f"DELETE FROM {table}")
+        connection.executemany(
+            "INSERT INTO queue_info VALUES (?, ?)",
+            [
+                ("working_directory", os.getcwd()),
+                ("main_source", main_source),
+                ("main_path", main_path),
+            ],
+        )
+        for task_id, task in graph.items():
+            connection.execute(
+                "INSERT INTO tasks VALUES (?, ?, 'pending', NULL, NULL, 0, NULL)",
+                (task_id, pickle.dumps(task["function"])),
+            )
+            connection.executemany(
+                "INSERT INTO dependencies VALUES (?, ?)",
+                [(task_id, dependency) for dependency in task["dependencies"]],
+            )
+    connection.close()
+
+
+def queue_info(connection):
+    return dict(connection.execute("SELECT key, value FROM queue_info"))
+
+
+def claim_task(connection, worker_id, lease_seconds=TASK_LEASE_SECONDS):
+    # Returns (task_id, payload) of a ready task, or None
+    now = time.time()
+    with connection:
+        connection.execute("BEGIN IMMEDIATE")
+        connection.execute(
+            "UPDATE tasks SET state = 'pending', worker = NULL "
+            "WHERE state = 'running' AND claimed < ?",
+            (now - lease_seconds,),
+        )
+        row = connection.execute(
+            "SELECT id, payload FROM tasks WHERE state = 'pending' AND NOT EXISTS ("
+            "SELECT 1 FROM dependencies JOIN tasks AS dependency_task "
+            "ON dependency_task.id = dependencies.dependency "
+            "WHERE dependencies.task = tasks.id AND dependency_task.state != 'done'"
+            ") ORDER BY rowid LIMIT 1"
+        ).fetchone()
+        if row is None:
+            return None
+        connection.execute(
+            "UPDATE tasks SET state = 'running', worker = ?, claimed = ?, "
+            "attempts = attempts + 1 WHERE id = ?",
+            (worker_id, now, row[0]),
+        )
+    return row
+
+
+def finish_task(connection, task_id, error=None):
+    with connection:
+        connection.execute("BEGIN IMMEDIATE")
+        if error is None:
+            connection.execute(
+                "UPDATE tasks SET state = 'done', error = NULL WHERE id = ?",
+                (task_id,),
+            )
+        else:
+            connection.execute(
+                "UPDATE tasks SET state = CASE WHEN attempts >= ? THEN 'failed' "
+                "ELSE 'pending' END, error = ? WHERE id = ?",
+                (TASK_ATTEMPTS, error, task_id),
+            )
+
+
+def queue_counts(connection):
+    return dict(connection.execute("SELECT state, COUNT(*) FROM tasks GROUP BY state"))
+
+
+def load_main_module(queue_path, main_path, main_source=None):
+    # The coordinator's functions may be pickled as __main__.<name>. They are
+    # found by loading its script as __mp_main__, as multiprocessing's spawn does.
+    # Forked workers already have it.
+    main_module = sys.modules["__main__"]
+    if not main_path or getattr(main_module, "__file__", None) == main_source:
+        return
+    queue_folder = os.path.dirname(os.path.realpath(queue_path))
+    real_main_path = os.path.realpath(main_path)
+    if os.path.commonpath([queue_folder, real_main_path]) != queue_folder:
+        raise Exception(
+            f"Refusing to load main script {main_path} from outside the queue "
+            f"folder {queue_folder}"
+        )
+    if not os.path.exists(real_main_path):
+        return
+    module = types.ModuleType("__mp_main__")
+    module.__dict__.update(runpy.run_path(real_main_path, run_name="__mp_main__"))
+    sys.modules["__main__"] = sys.modules["__mp_main__"] = module
+
+
+def run_worker(queue_path, worker_id=None, lease_seconds=TASK_LEASE_SECONDS):
+    # Runs tasks until every task is done or one failed for good
+    worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+    queue_path = os.path.abspath(queue_path)
+    connection = connect_queue(queue_path)
+    info = queue_info(connection)
+    if info.get("working_directory"):
+        os.chdir(info["working_directory"])
+    load_main_module(queue_path, info.get("main_path"), info.get("main_source"))
+
+    completed = 0
+    while True:
+        claimed = claim_task(connection, worker_id, lease_seconds)
+        if claimed is None:
+            counts = queue_counts(connection)
+            if counts.get("failed") or not (
+                counts.get("pending") or counts.get("running")
+            ):
+                break
+            time.sleep(QUEUE_POLL_SECONDS)
+            continue
+        task_id, payload = claimed
+        try:
+            pickle.loads(payload)()
+        except Exception:
+            print(f"Worker {worker_id}: task {task_id} failed")
+            finish_task(connection, task_id, traceback.format_exc())
+        else:
+            finish_task(connection, task_id)
+            completed += 1
+    connection.close()
+    return completed
+
+
+def wait_for_queue(queue_path):
+    connection = connect_queue(queue_path)
+    try:
+        while True:
+            counts = queue_counts(connection)
+            if counts.get("failed"):
+                task_id, error = connection.execute(
+                    "SELECT id, error FROM tasks WHERE state = 'failed' LIMIT 1"
+                ).fetchone()
+                raise Exception(f"Task {task_id} failed:\n{error}")
+            if not (counts.get("pending") or counts.get("running")):
+                return counts.get("done", 0)
+            time.sleep(QUEUE_POLL_SECONDS)
+    finally:
+        connection.close()
+
+
+def run_task_graph_in_queue(graph, queue_path, workers):
+    # Starts workers local processes on the queue (0 leaves it to workers started
+    # elsewhere) and waits until the graph is done
+    create_work_queue(queue_path, graph)
+    print(f"Queued {len(graph)} tasks in {queue_path}")
+    context = get_context("fork") if hasattr(os, "fork") else get_context()
+    processes = [
+        context.Process(target=run_worker, args=(queue_path,), daemon=True)
+        for _ in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    try:
+        wait_for_queue(queue_path)
+    finally:
+        for process in processes:
+            process.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run tasks from a Landsat processing work queue."
+    )
+    parser.add_argument("queue", help="Path to the SQLite work queue")
+    parser.add_argument("--worker-id", default=None)
+    parser.add_argument(
+        "--lease-seconds",
+        type=float,
+        default=TASK_LEASE_SECONDS,
+        help="Hand out running tasks again after this long",
+    )
+    args = parser.parse_args()
+
+    completed = run_worker(args.queue, args.worker_id, args.lease_seconds)
+    print(f"Worker finished after {completed} tasks")
+
+
+if __name__ == "__main__":
+    main()
@@ -1 +1,12 @@
-from . import file_methods
\ No newline at end of file
+from . import file_methods
+from . import reprojection
+from . import scene_records
+from . import scene_store
+from . import run_manifest
+from . import aoi
+from . import output_formats
+from . import scene_catalog
+from . import datacube
+from . import raster_comparison
+from . import grid_planner
+from . import raster_cache
@@ -0,0 +1,183 @@
+import json
+import math
+
+import numpy as np
+from affine import Affine
+from rasterio.crs import CRS
+from rasterio.features import geometry_mask
+from rasterio.warp import transform_bounds, transform_geom
+from rasterio.windows import Window, from_bounds
+
+from .grid_planner import read_scene_grids
+from .raster_cache import open_raster
+
+# Clipping to an area of interest: scenes outside the AOI are skipped, each other
+# scene only reads the window covering the AOI, everything is warped onto the part
+# of the target grid within the AOI bounds and optionally masked to the AOI
+# polygons.
+
+# Extra source pixels read around the AOI so bilinear resampling has neighbours
+AOI_WINDOW_PADDING = 2
+
+
+def load_aoi(aoi_path):
+    with open(aoi_path, "r") as f:
+        geojson = json.load(f)
+
+    if geojson.get("type") == "FeatureCollection":
+        geometries = [feature["geometry"] for feature in geojson["features"]]
+    elif geojson.get("type") == "Feature":
+        geometries = [geojson["geometry"]]
+    else:
+        geometries = [geojson]
+
+    # GeoJSON is lon/lat unless an (old style) crs member says otherwise
+    crs_name = geojson.get("crs", {}).get("properties", {}).get("name", "EPSG:4326")
+    crs = (
+        CRS.from_epsg(4326)
+        if crs_name.endswith("CRS84")
+        else CRS.from_user_input(crs_name)
+    )
+
+    xs, ys = [], []
+    for geometry in geometries:
+        for x, y in iter_coordinates(geometry["coordinates"]):
+            xs.append(x)
+            ys.append(y)
+
+    return {
+        "path": aoi_path,
+        "geometries": geometries,
+        "crs": crs,
+        "bounds": (min(xs), min(ys), max(xs), max(ys)),
+    }
+
+
+def iter_coordinates(coordinates):
+    if isinstance(coordinates[0], (int, float)):
+        yield coordinates[0], coordinates[1]
+    else:
+        for part in coordinates:
+            yield from iter_coordinates(part)
+
+
+def bounds_intersect(bounds, other):
+    return (
+        bounds[0] < other[2]
+        and other[0] < bounds[2]
+        and bounds[1] < other[3]
+        and other[1] < bounds[3]
+    )
+
+
+def scenes_overlapping_aoi(scene_library, aoi, target_band=10):
+    # Only the scenes whose footprint intersects the AOI bounds
+    scene_grids = read_scene_grids(scene_library, target_band)
+    overlapping = {}
+    for scene, grid in scene_grids.items():
+        if bounds_intersect(
+            grid["bounds"], transform_bounds(aoi["crs"], grid["crs"], *aoi["bounds"])
+        ):
+            overlapping[scene] = scene_library[scene]
+        else:
+            print(f"Skipping {scene}, it does not overlap the area of interest")
+    if not overlapping:
+        raise Exception(
+            f"The area of interest {aoi['path']} does not overlap any scene"
+        )
+    return overlapping
+
+
+def aoi_reprojection_config(aoi, reprojection_config, mask_to_polygon=False):
+    # Shrink a target grid to the AOI bounds, snapped to the same pixel grid and
+    # clamped to the grid, which covers the scenes
+    grid_transform = reprojection_config["transform"]
+    left, bottom, right, top = transform_bounds(
+        aoi["crs"], reprojection_config["crs"], *aoi["bounds"]
+    )
+    col_start = max(math.floor((left - grid_transform.c) / grid_transform.a), 0)
+    col_stop = min(
+        math.ceil((right - grid_transform.c) / grid_transform.a),
+        reprojection_config["width"],
+    )
+    row_start = max(math.floor((top - grid_transform.f) / grid_transform.e), 0)
+    row_stop = min(
+        math.ceil((bottom - grid_transform.f) / grid_transform.e),
+        reprojection_config["height"],
+    )
+    if col_stop <= col_start or row_stop <= row_start:
+        raise Exception(
+            f"The area of interest {aoi['path']} does not overlap the target grid"
+        )
+
+    width, height = col_stop - col_start, row_stop - row_start
+    aoi_config = reprojection_config.copy()
+    aoi_config.update(
+        {
+            "transform": grid_transform * Affine.translation(col_start, row_start),
+            "width": width,
+            "height": height,
+            "shape": (height, width),
+            "aoi": aoi,
+            "aoi_mask": None,
+        }
+    )
+    if mask_to_polygon:
+        aoi_config["aoi_mask"] = geometry_mask(
+            [
+                transform_geom(aoi["crs"], aoi_config["crs"], geometry)
+                for geometry in aoi["geometries"]
+            ],
+            out_shape=(height, width),
+            transform=aoi_config["transform"],
+        )
+    return aoi_config
+
+
+def aoi_window(src, aoi):
+    # Window of an open dataset covering the AOI, padded and clamped to the dataset
+    bounds = transform_bounds(aoi["crs"], src.crs, *aoi["bounds"])
+    window = from_bounds(*bounds, transform=src.transform)
+    col_start = max(math.floor(window.col_off) - AOI_WINDOW_PADDING, 0)
+    row_start = max(math.floor(window.row_off) - AOI_WINDOW_PADDING, 0)
+    col_stop = min(
+        math.ceil(window.col_off + window.width) + AOI_WINDOW_PADDING, src.width
+    )
+    row_stop = min(
+        math.ceil(window.row_off + window.height) + AOI_WINDOW_PADDING, src.height
+    )
+    return Window(
+        col_start,
+        row_start,
+        max(col_stop - col_start, 0),
+        max(row_stop - row_start, 0),
+    )
+
+
+def clip_plan_to_aoi(plan, aoi):
+    # Restrict a block calculation plan to the window covering the AOI
+    reference_path = next(iter(plan["sources"].values()))
+    with open_raster(reference_path) as src:
+        window = aoi_window(src, aoi)
+        window_transform = src.window_transform(window)
+    if window.width == 0 or window.height == 0:
+        raise Exception(f"{reference_path} does not overlap the area of interest")
+
+    clipped_plan = plan.copy()
+    clipped_plan["window"] = window
+    clipped_plan["meta"] = plan["meta"].copy()
+    clipped_plan["meta"].update(
+        {
+            "transform": window_transform,
+            "width": int(window.width),
+            "height": int(window.height),
+        }
+    )
+    return clipped_plan
+
+
+def apply_aoi_mask(band, reprojection_config, nodata):
+    aoi_mask = reprojection_config.get("aoi_mask")
+    if aoi_mask is not None:
+        band[aoi_mask] = np.nan if nodata is None else nodata
+    return band
@@ -0,0 +1,218 @@
+import os
+import tempfile
+from datetime import datetime
+
+import numpy as np
+from execution.scene_pool import spill_band
+from execution.instrumentation import measure_stage
+
+# Time series cube output: every reprojected scene of a run goes into one chunked,
+# compressed Zarr store with a (time, y, x) variable, so a pixel's time series is
+# one small read instead of a file open per scene. Scenes are spilled to scratch
+# memory maps as they arrive, sorted by acquisition time and written tile by tile
+# with the full time depth, so every chunk is written once whatever its shape.
+# The layout is Zarr format 2 with xarray's _ARRAY_DIMENSIONS, CF time units and a
+# rioxarray style spatial_ref, so xr.open_zarr(path).rio gives back the grid.
+CUBE_CHUNKS = (1, 512, 512)
+# Upper bound on the (time, rows, columns) block assembled per write
+CUBE_WRITE_BYTES = 256 * 2**20
+cube_compressors = {"deflate": "zlib", "zstd": "zstd"}
+TIME_UNITS = "microseconds since 1970-01-01T00:00:00"
+
+
+def zarr_format_options(zarr):
+    # Format 2 is what xarray, GDAL and older zarr releases all read
+    return {"zarr_format": 2} if int(zarr.__version__.split(".")[0]) >= 3 else {}
+
+
+def cube_path(output_path, processing_method, output_suffix):
+    name = (
+        f"{processing_method}_{output_suffix}" if output_suffix else processing_method
+    )
+    return os.path.join(output_path, f"{name}.zarr")
+
+
+def acquisition_time(mtl):
+    image_attributes = mtl["LANDSAT_METADATA_FILE"]["IMAGE_ATTRIBUTES"]
+    acquired = image_attributes["DATE_ACQUIRED"]
+    # Scenes of one day on different paths/rows are told apart by the centre time
+    center_time = image_attributes.get("SCENE_CENTER_TIME")
+    if center_time:
+        acquired = f"{acquired}T{center_time.rstrip('Z')[:15]}"
+    return np.datetime64(datetime.fromisoformat(acquired), "us")
+
+
+def scene_label(scene_key, mtl):
+    product_contents = mtl["LANDSAT_METADATA_FILE"].get("PRODUCT_CONTENTS", {})
+    return product_contents.get("LANDSAT_PRODUCT_ID") or os.path.basename(scene_key)
+
+
+def check_cube_grid(meta, reference_meta, scene_key):
+    if (meta["width"], meta["height"], meta["transform"], meta["crs"]) != (
+        reference_meta["width"],
+        reference_meta["height"],
+        reference_meta["transform"],
+        reference_meta["crs"],
+    ):
+        raise Exception(
+            f"Scene {scene_key} is not on the cube grid, cube output needs reprojected scenes"
+        )
+
+
+def create_cube(path, variable, entries, meta, chunks, compression):
+    import numcodecs
+    import zarr
+
+    format_options = zarr_format_options(zarr)
+    zarr.open_group(path, mode="w", **format_options)
+    height, width = meta["height"], meta["width"]
+    transform = meta["transform"]
+
+    def create(name, values=None, dimensions=(), fill_value=None, **array_options):
+        array = zarr.create(
+            store=path,
+            path=name,
+            fill_value=fill_value,
+            **array_options,
+            **format_options,
+        )
+        array.attrs["_ARRAY_DIMENSIONS"] = list(dimensions)
+        if values is not None:
+            array[...] = values
+        return array
+
+    times = np.array([entry["time"] for entry in entries])
+    time_values = (times - np.datetime64("1970-01-01T00:00:00", "us")).astype(np.int64)
+    time_array = create(
+        "time", time_values, ["time"], shape=times.shape, chunks=times.shape, dtype="i8"
+    )
+    time_array.attrs.update(
+        {
+            "units": TIME_UNITS,
+            "calendar": "proleptic_gregorian",
+            "standard_name": "time",
+        }
+    )
+    labels = np.array([entry["label"] for entry in entries])
+    create(
+        "scene",
+        labels,
+        ["time"],
+        shape=labels.shape,
+        chunks=labels.shape,
+        dtype=labels.dtype,
+    )
+
+    # Pixel centres of the grid
+    x = transform.c + transform.a * (np.arange(width) + 0.5)
+    y = transform.f + transform.e * (np.arange(height) + 0.5)
+    for name, values, axis in [("x", x, "X"), ("y", y, "Y")]:
+        coordinate = create(
+            name, values, [name], shape=values.shape, chunks=values.shape, dtype="f8"
+        )
+        coordinate.attrs.update(
+            {
+                "axis": axis,
+                "standard_name": f"projection_{name}_coordinate",
+                "units": "metre",
+            }
+        )
+
+    spatial_ref = create("spatial_ref", np.int64(0), shape=(), dtype="i8")
+    spatial_ref.attrs.update(
+        {
+            "crs_wkt": meta["crs"].to_wkt(),
+            "spatial_ref": meta["crs"].to_wkt(),
+            "GeoTransform": " ".join(str(value) for value in transform.to_gdal()),
+        }
+    )
+
+    nodata = meta["nodata"]
+    data = create(
+        variable,
+        dimensions=["time", "y", "x"],
+        shape=(len(entries), height, width),
+        chunks=(min(chunks[0], len(entries)), chunks[1], chunks[2]),
+        dtype=meta["dtype"],
+        fill_value=np.nan if nodata is None else nodata,
+        compressor=numcodecs.Blosc(
+            cname=cube_compressors[compression],
+            clevel=5,
+            shuffle=numcodecs.Blosc.SHUFFLE,
+        ),
+    )
+    data.attrs.update(
+        {"grid_mapping": "spatial_ref", "coordinates": "scene spatial_ref"}
+    )
+    return data
+
+
+def write_cube_tiles(data, entries):
+    # Each write covers the full time depth of whole chunk columns, so no chunk is
+    # read back and rewritten
+    time_count, height, width = data.shape
+    _, chunk_rows, chunk_columns = data.chunks
+    item_bytes = time_count * chunk_rows * data.dtype.itemsize
+    columns = max(CUBE_WRITE_BYTES // item_bytes // chunk_columns, 1) * chunk_columns
+    block = np.empty((time_count, chunk_rows, min(columns, width)), dtype=data.dtype)
+    for row_start in range(0, height, chunk_rows):
+        row_stop = min(row_start + chunk_rows, height)
+        for column_start in range(0, width, columns):
+            column_stop = min(column_start + columns, width)
+            tile = block[:, : row_stop - row_start, : column_stop - column_start]
+            for index, entry in enumerate(entries):
+                tile[index] = entry["band"][
+                    row_start:row_stop, column_start:column_stop
+                ]
+            data[:, row_start:row_stop, column_start:column_stop] = tile
+
+
+def folder_size(path):
+    return sum(
+        os.path.getsize(os.path.join(folder, file))
+        for folder, _, files in os.walk(path)
+        for file in files
+    )
+
+
+def write_cube(
+    path, variable, scenes, chunks=CUBE_CHUNKS, compression="deflate", scratch=None
+):
+    # scenes is an iterable of (scene_key, processed_scene) pairs on one grid
+    import zarr
+
+    if compression not in cube_compressors:
+        raise Exception(
+            f"Unsupported cube compression: {compression}, use one of {list(cube_compressors)}"
+        )
+    with tempfile.TemporaryDirectory(
+        prefix="landsat_cube_", dir=scratch or os.path.dirname(path)
+    ) as scratch_dir:
+        entries = []
+        for index, (scene_key, processed_scene) in enumerate(scenes):
+            if entries:
+                check_cube_grid(processed_scene["meta"], entries[0]["meta"], scene_key)
+            entries.append(
+                {
+                    "time": acquisition_time(processed_scene["mtl"]),
+                    "label": scene_label(scene_key, processed_scene["mtl"]),
+                    "band": spill_band(
+                        processed_scene["band"],
+                        os.path.join(scratch_dir, f"scene_{index}.npy"),
+                    ),
+                    "meta": processed_scene["meta"],
+                }
+            )
+        if not entries:
+            raise Exception("No scenes to write into the cube")
+        entries.sort(key=lambda entry: entry["time"])
+
+        print(f"Writing {len(entries)} scenes into {path}")
+        with measure_stage("write", os.path.basename(path)) as counters:
+            data = create_cube(
+                path, variable, entries, entries[0]["meta"], chunks, compression
+            )
+            write_cube_tiles(data, entries)
+            zarr.consolidate_metadata(path)
+            counters["bytes_written"] = folder_size(path)
+    return path
@@ -3,13 +3,15 @@ from rasterio.windows import from_bounds
 from rasterio.warp import reproject, Resampling
 import numpy as np
 
+from .raster_cache import open_raster
+
 
 def peek(scene_library, target_band=10):
     print("Peeking at scene library...")
     print(f"Number of scenes: {len(scene_library)}")
     first_scene = list(scene_library.keys())[0]
 
-    with rasterio.open(scene_library[first_scene][f"B{target_band}"]) as first_scene:
+    with open_raster(scene_library[first_scene][f"B{target_band}"]) as first_scene:
         sample_crs = first_scene.crs
         sample_transform = first_scene.transform
         sample_width = first_scene.width
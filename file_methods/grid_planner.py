@@ -0,0 +1,172 @@
+import json
+import math
+import os
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from affine import Affine
+from rasterio.crs import CRS
+from rasterio.warp import calculate_default_transform, transform_bounds
+
+from .raster_cache import open_raster
+
+# The shared grid bulk methods warp every scene onto, planned from the footprints
+# of all scenes instead of copied from one of them. Only the headers are read, on
+# a few threads. The grid covers the union (or intersection) of the footprints in
+# the target CRS, snapped to the pixel grid of a reference scene, so scenes of the
+# same path/row stay pixel aligned. The reference is picked deterministically:
+# the first scene, by key, in the most common CRS (ties go to the CRS whose WKT
+# sorts first). The grid is divided into tiles, and each scene is only warped
+# into the tiles its footprint overlaps.
+GRID_MODES = ["union", "intersection", "first"]
+GRID_READER_THREADS = 8
+TARGET_TILE_SIZE = 512
+# Points per edge when a footprint is transformed into the target CRS
+FOOTPRINT_DENSIFY_POINTS = 21
+# Grid file kept next to results that are keyed by the grid, see pinned_target_grid
+PINNED_GRID_NAME = "target_grid.json"
+
+
+def read_grid(path):
+    with open_raster(path) as src:
+        return {
+            "crs": src.crs,
+            "transform": src.transform,
+            "width": src.width,
+            "height": src.height,
+            "bounds": tuple(src.bounds),
+        }
+
+
+def read_scene_grids(scene_library, target_band=10, threads=GRID_READER_THREADS):
+    scenes = sorted(scene_library)
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        grids = executor.map(
+            read_grid,
+            [scene_library[scene][f"B{target_band}"] for scene in scenes],
+        )
+        return dict(zip(scenes, grids))
+
+
+def reference_grid(scene_grids, crs=None):
+    if crs is None:
+        crs_counts = Counter(grid["crs"].to_wkt() for grid in scene_grids.values())
+        crs = CRS.from_wkt(min(crs_counts, key=lambda wkt: (-crs_counts[wkt], wkt)))
+    for scene in sorted(scene_grids):
+        if scene_grids[scene]["crs"] == crs:
+            return crs, scene_grids[scene]
+    # No scene is in the requested CRS, the first one is converted in target_pixel_grid
+    return crs, scene_grids[sorted(scene_grids)[0]]
+
+
+def target_pixel_grid(reference, crs):
+    # Transform whose pixel edges the planned grid snaps to
+    if reference["crs"] == crs:
+        return reference["transform"]
+    # The reference scene's resolution in the units of the target CRS, e.g.
+    # degrees for EPSG:4326, with the grid anchored at the origin of the CRS
+    transform, _, _ = calculate_default_transform(
+        reference["crs"],
+        crs,
+        reference["width"],
+        reference["height"],
+        *reference["bounds"],
+    )
+    return Affine(transform.a, 0, 0, 0, transform.e, 0)
+
+
+def footprint_bounds(scene_grids, crs, mode):
+    footprints = [
+        transform_bounds(
+            grid["crs"], crs, *grid["bounds"], densify_pts=FOOTPRINT_DENSIFY_POINTS
+        )
+        for grid in scene_grids.values()
+    ]
+    if mode == "union":
+        combine = [min, min, max, max]
+    else:
+        combine = [max, max, min, min]
+    left, bottom, right, top = [
+        combine[index](footprint[index] for footprint in footprints)
+        for index in range(4)
+    ]
+    if right <= left or top <= bottom:
+        raise Exception("The scene footprints do not intersect")
+    return left, bottom, right, top
+
+
+def snapped_grid(bounds, reference_transform):
+    # Pixel edges stay on the reference scene's grid
+    pixel_width, pixel_height = reference_transform.a, reference_transform.e
+    left, bottom, right, top = bounds
+    col_start = math.floor((left - reference_transform.c) / pixel_width)
+    col_stop = math.ceil((right - reference_transform.c) / pixel_width)
+    row_start = math.floor((top - reference_transform.f) / pixel_height)
+    row_stop = math.ceil((bottom - reference_transform.f) / pixel_height)
+    transform = reference_transform * Affine.translation(col_start, row_start)
+    return transform, col_stop - col_start, row_stop - row_start
+
+
+def plan_target_grid(
+    scene_library,
+    mode="union",
+    crs=None,
+    target_band=10,
+    tile_size=TARGET_TILE_SIZE,
+    threads=GRID_READER_THREADS,
+):
+    if mode not in GRID_MODES or mode == "first":
+        raise Exception(f"Unsupported grid mode: {mode}, use union or intersection")
+    print(f"Planning the {mode} grid of {len(scene_library)} scene footprints...")
+    scene_grids = read_scene_grids(scene_library, target_band, threads)
+    crs, reference = reference_grid(scene_grids, crs and CRS.from_user_input(crs))
+    transform, width, height = snapped_grid(
+        footprint_bounds(scene_grids, crs, mode), target_pixel_grid(reference, crs)
+    )
+    print(f"Target grid: {width} x {height} pixels in {crs.to_string()}")
+    return {
+        "crs": crs,
+        "transform": transform,
+        "width": width,
+        "height": height,
+        "shape": (height, width),
+        "tile_size": tile_size,
+    }
+
+
+def pinned_target_grid(grid_folder, request, plan):
+    # Incremental runs and scene stores key their results by the target grid, and
+    # a planned grid moves when a scene widens the union or changes the most
+    # common CRS. The grid planned by their first run is saved in grid_folder and
+    # reused while the same grid options (request) are asked for, parts of later
+    # scenes outside it are left out. Delete the file to plan the grid again.
+    path = os.path.join(grid_folder, PINNED_GRID_NAME)
+    if os.path.exists(path):
+        with open(path, "r") as f:
+            pinned = json.load(f)
+        if pinned["request"] == request:
+            print(f"Using the target grid pinned in {path}")
+            grid = pinned["grid"]
+            grid["crs"] = CRS.from_wkt(grid["crs"])
+            grid["transform"] = Affine(*grid["transform"])
+            grid["shape"] = (grid["height"], grid["width"])
+            return grid
+        print(f"Grid options changed since {path} was saved, planning the grid again")
+
+    grid = plan()
+    pinned_grid = {
+        key: value for key, value in grid.items() if key not in ["crs", "transform"]
+    }
+    pinned_grid.update(
+        {
+            "crs": grid["crs"].to_wkt(),
+            "transform": list(grid["transform"])[:6],
+            "shape": list(grid["shape"]),
+        }
+    )
+    os.makedirs(grid_folder, exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "w") as f:
+        json.dump({"request": request, "grid": pinned_grid}, f, indent=2)
+    os.replace(temp_path, path)
+    return grid
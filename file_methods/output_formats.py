@@ -0,0 +1,92 @@
+import os
+from contextlib import contextmanager
+
+import rasterio
+from rasterio.shutil import copy
+
+from .datacube import CUBE_CHUNKS, cube_compressors
+
+# Output layouts. "gtiff" writes the processed meta as is (strips), "cog" writes
+# Cloud Optimized GeoTIFFs with internal tiles, predictor aware compression and
+# overviews, so reading a small area or a zoomed out view only decodes a few tiles.
+# "zarr" writes all scenes of a run into one time series cube (see datacube).
+OUTPUT_FORMATS = ["gtiff", "cog", "zarr"]
+COG_COMPRESSIONS = ["deflate", "zstd", "lzw"]
+COG_BLOCK_SIZE = 512
+COG_OVERVIEW_RESAMPLING = "average"
+
+
+def output_options(
+    output_format="gtiff",
+    compression="deflate",
+    block_size=COG_BLOCK_SIZE,
+    num_threads="ALL_CPUS",
+    cube_chunks=CUBE_CHUNKS,
+):
+    if output_format not in OUTPUT_FORMATS:
+        raise Exception(
+            f"Unsupported output format: {output_format}, use one of {OUTPUT_FORMATS}"
+        )
+    if compression not in COG_COMPRESSIONS:
+        raise Exception(
+            f"Unsupported compression: {compression}, use one of {COG_COMPRESSIONS}"
+        )
+    if block_size % 16 != 0:
+        raise Exception(f"Block size must be a multiple of 16, got {block_size}")
+    if output_format == "zarr" and compression not in cube_compressors:
+        raise Exception(
+            f"Unsupported compression for zarr output: {compression}, use one of {list(cube_compressors)}"
+        )
+    if len(cube_chunks) != 3 or min(cube_chunks) < 1:
+        raise Exception(f"Cube chunks must be three positive sizes, got {cube_chunks}")
+    return {
+        "output_format": output_format,
+        "compression": compression,
+        "block_size": block_size,
+        "num_threads": num_threads,
+        "cube_chunks": tuple(cube_chunks),
+    }
+
+
+def cog_creation_options(options):
+    return {
+        "COMPRESS": options["compression"].upper(),
+        # Horizontal differencing for integers, floating point predictor for floats
+        "PREDICTOR": "YES",
+        "BLOCKSIZE": options["block_size"],
+        "NUM_THREADS": options["num_threads"],
+        "OVERVIEWS": "AUTO",
+        "RESAMPLING": COG_OVERVIEW_RESAMPLING.upper(),
+        "BIGTIFF": "IF_SAFER",
+    }
+
+
+@contextmanager
+def open_output(file_path, meta, options=None):
+    # Yields an open rasterio writer for file_path. COG output is written to a tiled,
+    # uncompressed staging file first and copied into the COG layout (overviews
+    # and compression) when the block exits.
+    if not options or options["output_format"] == "gtiff":
+        with rasterio.open(file_path, "w", **meta) as destination:
+            yield destination
+        return
+
+    staging_path = f"{file_path}.{os.getpid()}.staging.tif"
+    staging_meta = meta.copy()
+    staging_meta.pop("compress", None)
+    staging_meta.update(
+        {
+            "driver": "GTiff",
+            "tiled": True,
+            "blockxsize": options["block_size"],
+            "blockysize": options["block_size"],
+            "BIGTIFF": "IF_SAFER",
+        }
+    )
+    try:
+        with rasterio.open(staging_path, "w", **staging_meta) as destination:
+            yield destination
+        copy(staging_path, file_path, driver="COG", **cog_creation_options(options))
+    finally:
+        if os.path.exists(staging_path):
+            os.remove(staging_path)
@@ -0,0 +1,156 @@
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+import rasterio
+from rasterio.env import set_gdal_config
+
+# Raster access shared by every method and bulk step in the process. Dataset
+# handles are kept open in a pool (one per thread, a rasterio dataset can't be
+# shared across threads), so reading a header and then the pixels of the same band
+# opens the file once. Decoded blocks go into a byte-budgeted LRU cache keyed by
+# path, modification time, size, band and window, so running another method over
+# the same scenes, or the same method again in a notebook, reads from memory. A
+# rewritten file gets a new key and its old blocks age out of the cache. Cached
+# blocks are read-only, readers get a copy in their own buffer. The block cache
+# is off unless a size is configured, every worker process would hold its own.
+READ_CACHE_MB = 0
+MAX_OPEN_DATASETS = 64
+# GDAL reads a GDAL_CACHEMAX below 100000 as megabytes, rasterio passes it as
+# bytes, smaller sizes are raised to this so both readings agree
+GDAL_CACHE_MIN_BYTES = 100000
+
+raster_cache_config = {
+    "cache_bytes": READ_CACHE_MB * 2**20,
+    "max_open_datasets": MAX_OPEN_DATASETS,
+}
+# {key: read-only block}, least recently used first
+block_cache = OrderedDict()
+block_cache_stats = {"hits": 0, "misses": 0, "bytes": 0}
+block_cache_lock = threading.Lock()
+dataset_pools = threading.local()
+
+
+def reset_after_fork():
+    # A forked worker must not share open file offsets with its parent, or wait on
+    # a lock held by one of the parent's threads. Its copy of the blocks is valid.
+    global block_cache_lock
+    block_cache_lock = threading.Lock()
+    dataset_pools.__dict__.clear()
+
+
+os.register_at_fork(after_in_child=reset_after_fork)
+
+
+def configure_raster_cache(cache_mb=None, gdal_cache_mb=None, max_open_datasets=None):
+    # cache_mb=0 turns the block cache off. GDAL's own block cache is separate and
+    # process wide.
+    if cache_mb is not None:
+        raster_cache_config["cache_bytes"] = int(cache_mb * 2**20)
+        with block_cache_lock:
+            evict_blocks(raster_cache_config["cache_bytes"])
+    if gdal_cache_mb is not None:
+        set_gdal_config(
+            "GDAL_CACHEMAX", max(int(gdal_cache_mb * 2**20), GDAL_CACHE_MIN_BYTES)
+        )
+    if max_open_datasets is not None:
+        raster_cache_config["max_open_datasets"] = max_open_datasets
+
+
+def raster_key(path):
+    stat = os.stat(path)
+    return (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+
+
+class DatasetPool(OrderedDict):
+    # {raster key: open dataset} of one thread, least recently used first. The
+    # thread's local state is dropped when it finishes, which closes its datasets.
+    def close(self):
+        while self:
+            self.popitem()[1].close()
+
+    def __del__(self):
+        self.close()
+
+
+def dataset_pool():
+    if not hasattr(dataset_pools, "datasets"):
+        dataset_pools.datasets = DatasetPool()
+    return dataset_pools.datasets
+
+
+@contextmanager
+def open_raster(path):
+    # Drop-in for rasterio.open(path) when reading, the dataset stays open in the
+    # pool when the block exits
+    key = raster_key(path)
+    datasets = dataset_pool()
+    src = datasets.get(key)
+    if src is None:
+        src = datasets[key] = rasterio.open(path)
+        while len(datasets) > max(raster_cache_config["max_open_datasets"], 1):
+            datasets.popitem(last=False)[1].close()
+    datasets.move_to_end(key)
+    yield src
+
+
+def evict_blocks(cache_bytes):
+    while block_cache and block_cache_stats["bytes"] > cache_bytes:
+        block_cache_stats["bytes"] -= block_cache.popitem(last=False)[1].nbytes
+
+
+def read_block(src, key, window, out, band=1):
+    # src.read(band, window=window, out=out) through the block cache. key is the
+    # raster_key of the file, plus anything else the pixels depend on (e.g. the
+    # grid a warped source is resampled onto).
+    block_key = (
+        key,
+        band,
+        (
+            int(window.col_off),
+            int(window.row_off),
+            int(window.width),
+            int(window.height),
+        ),
+    )
+    cache_bytes = raster_cache_config["cache_bytes"]
+    if cache_bytes:
+        with block_cache_lock:
+            block = block_cache.get(block_key)
+            if block is not None:
+                block_cache.move_to_end(block_key)
+                block_cache_stats["hits"] += 1
+        if block is not None:
+            np.copyto(out, block)
+            return out
+
+    src.read(band, window=window, out=out)
+    if cache_bytes and out.nbytes <= cache_bytes:
+        block = out.copy()
+        block.flags.writeable = False
+        with block_cache_lock:
+            block_cache_stats["misses"] += 1
+            if block_key not in block_cache:
+                block_cache[block_key] = block
+                block_cache_stats["bytes"] += block.nbytes
+                evict_blocks(cache_bytes)
+    return out
+
+
+def raster_cache_info():
+    with block_cache_lock:
+        return {
+            **block_cache_stats,
+            "blocks": len(block_cache),
+            "open_datasets": len(dataset_pool()),
+        }
+
+
+def clear_raster_cache():
+    # Empties the block cache and closes the calling thread's datasets
+    with block_cache_lock:
+        block_cache.clear()
+        block_cache_stats.update({"hits": 0, "misses": 0, "bytes": 0})
+    dataset_pool().close()
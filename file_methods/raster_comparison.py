@@ -0,0 +1,197 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import rasterio
+from rasterio.windows import Window, bounds
+
+# Streaming comparison of two rasters for regression checks. Both files are walked
+# one internal block of the original at a time, so memory stays at a few blocks
+# whatever the file size. Metadata is compared on the same open datasets. With
+# threads, each thread opens its own handles (a rasterio dataset can't be shared
+# across threads) and takes every n-th block. equal_only stops all threads at the
+# first block with a difference beyond the tolerance. Every block is read once,
+# so GDAL's block cache is kept small and the shared raster cache (raster_cache.py)
+# is bypassed rather than flushed by blocks that are never read again.
+COMPARISON_CACHE_MB = 64
+
+
+def compare_metadata(orig, out):
+    # Returns one line per discrepancy between two open datasets
+    discrepancies = []
+    out_meta = out.meta
+    for key, value in orig.meta.items():
+        if value != out_meta.get(key, None):
+            discrepancies.append(
+                f"'{key}': original {value}, output {out_meta.get(key, None)}"
+            )
+    for band in range(1, min(orig.count, out.count) + 1):
+        out_tags = out.tags(band)
+        for key, value in orig.tags(band).items():
+            if value != out_tags.get(key, None):
+                discrepancies.append(
+                    f"band {band} '{key}': original {value}, output {out_tags.get(key, None)}"
+                )
+        if orig.colorinterp[band - 1] != out.colorinterp[band - 1]:
+            discrepancies.append(
+                f"band {band} color interpretation: original {orig.colorinterp[band - 1]}, "
+                f"output {out.colorinterp[band - 1]}"
+            )
+    return discrepancies
+
+
+def new_diff_summary():
+    return {
+        "compared_pixels": 0,
+        "differing_pixels": 0,
+        "max_abs_diff": 0.0,
+        "sum_abs_diff": 0.0,
+        # Pixel bounding box of the differences as [row_min, col_min, row_max, col_max]
+        "box": None,
+    }
+
+
+def compare_blocks(summary, orig_block, out_block, window, tolerance):
+    summary["compared_pixels"] += orig_block.size
+    # Identical blocks, the common case of a regression check, skip the arithmetic.
+    # Compared bitwise, so identical NaNs are equal in one pass.
+    if orig_block.dtype == out_block.dtype:
+        bits = np.dtype(f"u{orig_block.dtype.itemsize}")
+        if np.array_equal(orig_block.view(bits), out_block.view(bits)):
+            return summary
+
+    # Pixels that are NaN in both count as equal, NaN in one of them as different
+    orig_block = orig_block.astype(np.float64, copy=False)
+    out_block = out_block.astype(np.float64, copy=False)
+    abs_diff = np.abs(orig_block - out_block)
+    both_nan = np.isnan(orig_block) & np.isnan(out_block)
+    abs_diff[both_nan] = 0
+    finite = np.isfinite(abs_diff)
+    differing = ~finite | (abs_diff > tolerance)
+
+    if finite.any():
+        summary["max_abs_diff"] = max(
+            summary["max_abs_diff"], float(abs_diff.max(where=finite, initial=0))
+        )
+        summary["sum_abs_diff"] += float(abs_diff.sum(where=finite))
+    differing_count = int(np.count_nonzero(differing))
+    if differing_count == 0:
+        return summary
+    summary["differing_pixels"] += differing_count
+    rows = np.flatnonzero(differing.any(axis=(0, 2)))
+    cols = np.flatnonzero(differing.any(axis=(0, 1)))
+    box = [
+        int(window.row_off + rows[0]),
+        int(window.col_off + cols[0]),
+        int(window.row_off + rows[-1]),
+        int(window.col_off + cols[-1]),
+    ]
+    summary["box"] = merge_boxes(summary["box"], box)
+    return summary
+
+
+def merge_boxes(box, other):
+    if box is None:
+        return other
+    if other is None:
+        return box
+    return [
+        min(box[0], other[0]),
+        min(box[1], other[1]),
+        max(box[2], other[2]),
+        max(box[3], other[3]),
+    ]
+
+
+def merge_diff_summaries(summary, other):
+    summary["compared_pixels"] += other["compared_pixels"]
+    summary["differing_pixels"] += other["differing_pixels"]
+    summary["max_abs_diff"] = max(summary["max_abs_diff"], other["max_abs_diff"])
+    summary["sum_abs_diff"] += other["sum_abs_diff"]
+    summary["box"] = merge_boxes(summary["box"], other["box"])
+    return summary
+
+
+def read_block(src, window, buffers, name):
+    # One buffer per file reused for every block, edge blocks get a view of it
+    shape = (src.count, int(window.height), int(window.width))
+    buffer = buffers.get(name)
+    if buffer is None or buffer.size < np.prod(shape):
+        buffer = buffers[name] = np.empty(int(np.prod(shape)), dtype=src.dtypes[0])
+    return src.read(window=window, out=buffer[: int(np.prod(shape))].reshape(shape))
+
+
+def compare_windows(orig, out, windows, tolerance, equal_only, stop):
+    summary = new_diff_summary()
+    buffers = {}
+    for window in windows:
+        if stop.is_set():
+            break
+        compare_blocks(
+            summary,
+            read_block(orig, window, buffers, "orig"),
+            read_block(out, window, buffers, "out"),
+            window,
+            tolerance,
+        )
+        if equal_only and summary["differing_pixels"]:
+            stop.set()
+    return summary
+
+
+def compare_windows_in_thread(
+    original_path, output_path, windows, tolerance, equal_only, stop
+):
+    with rasterio.open(original_path) as orig, rasterio.open(output_path) as out:
+        return compare_windows(orig, out, windows, tolerance, equal_only, stop)
+
+
+def compare_raster_files(
+    original_path, output_path, tolerance=0.0, equal_only=False, threads=1
+):
+    stop = threading.Event()
+    with rasterio.Env(GDAL_CACHEMAX=COMPARISON_CACHE_MB * 2**20), rasterio.open(
+        original_path
+    ) as orig, rasterio.open(output_path) as out:
+        result = {"metadata": compare_metadata(orig, out)}
+        if (orig.count, orig.height, orig.width) != (out.count, out.height, out.width):
+            result.update(new_diff_summary())
+            result["equal"] = False
+            result["shape_mismatch"] = True
+            return result
+
+        windows = [window for _, window in orig.block_windows(1)]
+        if threads > 1:
+            with ThreadPoolExecutor(max_workers=threads) as executor:
+                futures = [
+                    executor.submit(
+                        compare_windows_in_thread,
+                        original_path,
+                        output_path,
+                        windows[offset::threads],
+                        tolerance,
+                        equal_only,
+                        stop,
+                    )
+                    for offset in range(threads)
+                ]
+                summary = new_diff_summary()
+                for future in futures:
+                    merge_diff_summaries(summary, future.result())
+        else:
+            summary = compare_windows(orig, out, windows, tolerance, equal_only, stop)
+
+        result.update(summary)
+        result["equal"] = summary["differing_pixels"] == 0
+        result["stopped_early"] = stop.is_set()
+        # A pixel count over several bands, the mean is per compared band pixel
+        result["mean_abs_diff"] = summary["sum_abs_diff"] / max(
+            summary["compared_pixels"], 1
+        )
+        if summary["box"]:
+            row_min, col_min, row_max, col_max = summary["box"]
+            box_window = Window(
+                col_min, row_min, col_max - col_min + 1, row_max - row_min + 1
+            )
+            result["box_bounds"] = bounds(box_window, orig.transform)
+    return result
@@ -0,0 +1,321 @@
+import hashlib
+import math
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from affine import Affine
+from rasterio.transform import array_bounds
+from rasterio.warp import reproject, transform, transform_bounds, Resampling
+
+from execution.instrumentation import measure_stage
+from .aoi import apply_aoi_mask
+
+# Reprojection plans are computed once per unique (source grid, target grid) pair
+# and reused for every scene on that grid, e.g. a time series over one path/row.
+# A gather plan holds two float32 arrays the size of the target grid, so the
+# in-memory plans are kept least recently used first within PLAN_CACHE_MB, plans
+# evicted from it are read back from the cache folder if there is one.
+PLAN_CHUNK_ROWS = 256
+PLAN_CACHE_MB = 1024
+_plan_cache = OrderedDict()
+_plan_cache_stats = {"bytes": 0}
+# Reader threads sharing a source grid build its plan once
+_plan_cache_lock = threading.Lock()
+
+
+def reprojection_plan_key(src_crs, src_transform, src_shape, reprojection_config):
+    grid_description = "|".join(
+        [
+            src_crs.to_wkt(),
+            repr(tuple(src_transform)[:6]),
+            repr(tuple(src_shape)),
+            reprojection_config["crs"].to_wkt(),
+            repr(tuple(reprojection_config["transform"])[:6]),
+            repr((reprojection_config["height"], reprojection_config["width"])),
+        ]
+    )
+    return hashlib.sha1(grid_description.encode("utf-8")).hexdigest()
+
+
+def is_axis_aligned(affine):
+    return affine.b == 0 and affine.d == 0
+
+
+def fractional_source_coords(src_transform, xs, ys):
+    # Source pixel coordinates measured from pixel centers, as bilinear expects
+    cols, rows = ~src_transform * (np.asarray(xs), np.asarray(ys))
+    return np.asarray(cols) - 0.5, np.asarray(rows) - 0.5
+
+
+def build_reprojection_plan(src_crs, src_transform, src_shape, reprojection_config):
+    dst_transform = reprojection_config["transform"]
+    dst_height, dst_width = reprojection_config["height"], reprojection_config["width"]
+
+    if (
+        src_crs == reprojection_config["crs"]
+        and tuple(src_transform) == tuple(dst_transform)
+        and tuple(src_shape) == (dst_height, dst_width)
+    ):
+        return {"kind": "identity"}
+
+    if (
+        src_crs == reprojection_config["crs"]
+        and is_axis_aligned(src_transform)
+        and is_axis_aligned(dst_transform)
+    ):
+        # Same CRS and north up grids, rows and columns map independently
+        dst_cols = np.arange(dst_width) + 0.5
+        dst_rows = np.arange(dst_height) + 0.5
+        xs = dst_transform.c + dst_cols * dst_transform.a
+        ys = dst_transform.f + dst_rows * dst_transform.e
+        src_cols, _ = fractional_source_coords(src_transform, xs, np.zeros_like(xs))
+        _, src_rows = fractional_source_coords(src_transform, np.zeros_like(ys), ys)
+        return {
+            "kind": "separable",
+            "src_cols": src_cols.astype(np.float32),
+            "src_rows": src_rows.astype(np.float32),
+        }
+
+    # General case, transform every destination pixel center into the source CRS
+    src_cols = np.empty((dst_height, dst_width), dtype=np.float32)
+    src_rows = np.empty((dst_height, dst_width), dtype=np.float32)
+    dst_cols = np.arange(dst_width) + 0.5
+    for start in range(0, dst_height, PLAN_CHUNK_ROWS):
+        stop = min(start + PLAN_CHUNK_ROWS, dst_height)
+        cols, rows = np.meshgrid(dst_cols, np.arange(start, stop) + 0.5)
+        xs, ys = dst_transform * (cols.ravel(), rows.ravel())
+        xs, ys = transform(reprojection_config["crs"], src_crs, xs, ys)
+        chunk_cols, chunk_rows = fractional_source_coords(src_transform, xs, ys)
+        src_cols[start:stop] = chunk_cols.reshape(stop - start, dst_width)
+        src_rows[start:stop] = chunk_rows.reshape(stop - start, dst_width)
+    return {"kind": "gather", "src_cols": src_cols, "src_rows": src_rows}
+
+
+def plan_nbytes(plan):
+    return sum(value.nbytes for value in plan.values() if isinstance(value, np.ndarray))
+
+
+def get_reprojection_plan(
+    src_crs, src_transform, src_shape, reprojection_config, cache_folder=None
+):
+    key = reprojection_plan_key(src_crs, src_transform, src_shape, reprojection_config)
+    with _plan_cache_lock:
+        plan = _plan_cache.get(key)
+        if plan is not None:
+            _plan_cache.move_to_end(key)
+            return plan
+        plan = load_or_build_reprojection_plan(
+            key,
+            src_crs,
+            src_transform,
+            src_shape,
+            reprojection_config,
+            cache_folder,
+        )
+        cache_bytes = PLAN_CACHE_MB * 2**20
+        if plan_nbytes(plan) <= cache_bytes:
+            _plan_cache[key] = plan
+            _plan_cache_stats["bytes"] += plan_nbytes(plan)
+            while _plan_cache_stats["bytes"] > cache_bytes:
+                evicted = _plan_cache.popitem(last=False)[1]
+                _plan_cache_stats["bytes"] -= plan_nbytes(evicted)
+        return plan
+
+
+def clear_plan_cache():
+    with _plan_cache_lock:
+        _plan_cache.clear()
+        _plan_cache_stats["bytes"] = 0
+
+
+def load_or_build_reprojection_plan(
+    key, src_crs, src_transform, src_shape, reprojection_config, cache_folder=None
+):
+    cache_path = os.path.join(cache_folder, f"{key}.npz") if cache_folder else None
+    if cache_path and os.path.exists(cache_path):
+        with np.load(cache_path) as cached:
+            plan = {name: cached[name] for name in cached.files}
+        plan["kind"] = str(plan["kind"])
+    else:
+        print("Building reprojection plan for a new source grid...")
+        plan = build_reprojection_plan(
+            src_crs, src_transform, src_shape, reprojection_config
+        )
+        if cache_path:
+            os.makedirs(cache_folder, exist_ok=True)
+            # Write then rename so concurrent workers never read a partial plan
+            temp_path = f"{cache_path}.{os.getpid()}.tmp.npz"
+            np.savez(temp_path, **plan)
+            os.replace(temp_path, cache_path)
+    return plan
+
+
+def bilinear_gather(source, src_cols, src_rows, nodata, out):
+    # Bilinear resampling as GDAL's warper does it: a pixel is only filled if the
+    # source pixel under its center is valid, neighbours outside the source or
+    # equal to nodata are dropped and the remaining weights renormalised. Other
+    # pixels stay untouched in out.
+    height, width = source.shape
+    inside = (
+        (src_cols >= -0.5)
+        & (src_cols < width - 0.5)
+        & (src_rows >= -0.5)
+        & (src_rows < height - 0.5)
+    )
+    center_values = source[
+        np.clip(np.floor(src_rows + 0.5).astype(np.intp), 0, height - 1),
+        np.clip(np.floor(src_cols + 0.5).astype(np.intp), 0, width - 1),
+    ]
+    inside &= np.isfinite(center_values)
+    if nodata is not None:
+        inside &= center_values != nodata
+    col0 = np.floor(src_cols)
+    row0 = np.floor(src_rows)
+    col_frac = src_cols - col0
+    row_frac = src_rows - row0
+    col0 = col0.astype(np.intp)
+    row0 = row0.astype(np.intp)
+
+    weighted_sum = np.zeros(out.shape, dtype=np.float64)
+    weight_total = np.zeros(out.shape, dtype=np.float64)
+    for rows, cols, weight in [
+        (row0, col0, (1 - row_frac) * (1 - col_frac)),
+        (row0, col0 + 1, (1 - row_frac) * col_frac),
+        (row0 + 1, col0, row_frac * (1 - col_frac)),
+        (row0 + 1, col0 + 1, row_frac * col_frac),
+    ]:
+        in_source = (cols >= 0) & (cols < width) & (rows >= 0) & (rows < height)
+        values = source[np.clip(rows, 0, height - 1), np.clip(cols, 0, width - 1)]
+        valid = in_source & np.isfinite(values)
+        if nodata is not None:
+            valid &= values != nodata
+        weight = np.where(valid, weight, 0)
+        weighted_sum += np.where(valid, values, 0) * weight
+        weight_total += weight
+
+    # GDAL's threshold for a pixel with no valid neighbours
+    filled = inside & (weight_total >= 1e-5)
+    np.divide(weighted_sum, weight_total, out=weighted_sum, where=filled)
+    out[filled] = weighted_sum[filled]
+
+
+def apply_reprojection_plan(plan, source, nodata, destination):
+    if plan["kind"] == "identity":
+        destination[...] = source
+        return destination
+
+    for start in range(0, destination.shape[0], PLAN_CHUNK_ROWS):
+        stop = min(start + PLAN_CHUNK_ROWS, destination.shape[0])
+        if plan["kind"] == "separable":
+            src_cols, src_rows = np.meshgrid(
+                plan["src_cols"], plan["src_rows"][start:stop]
+            )
+        else:
+            src_cols = plan["src_cols"][start:stop]
+            src_rows = plan["src_rows"][start:stop]
+        bilinear_gather(source, src_cols, src_rows, nodata, destination[start:stop])
+    return destination
+
+
+def overlap_window(src_crs, src_transform, src_shape, reprojection_config):
+    # Rows and columns of the target tiles a source footprint overlaps, padded by
+    # a pixel for the bilinear neighbours, as (row_start, row_stop, col_start, col_stop)
+    tile_size = reprojection_config["tile_size"]
+    dst_transform = reprojection_config["transform"]
+    left, bottom, right, top = transform_bounds(
+        src_crs,
+        reprojection_config["crs"],
+        *array_bounds(src_shape[0], src_shape[1], src_transform),
+        densify_pts=21,
+    )
+    cols = sorted((x - dst_transform.c) / dst_transform.a for x in [left, right])
+    rows = sorted((y - dst_transform.f) / dst_transform.e for y in [top, bottom])
+    row_start = max((math.floor(rows[0]) - 1) // tile_size * tile_size, 0)
+    row_stop = min(
+        -(-(math.ceil(rows[1]) + 1) // tile_size) * tile_size,
+        reprojection_config["height"],
+    )
+    col_start = max((math.floor(cols[0]) - 1) // tile_size * tile_size, 0)
+    col_stop = min(
+        -(-(math.ceil(cols[1]) + 1) // tile_size) * tile_size,
+        reprojection_config["width"],
+    )
+    return row_start, max(row_stop, row_start), col_start, max(col_stop, col_start)
+
+
+def tile_reprojection_config(reprojection_config, window):
+    row_start, row_stop, col_start, col_stop = window
+    tile_config = reprojection_config.copy()
+    tile_config.update(
+        {
+            "transform": reprojection_config["transform"]
+            * Affine.translation(col_start, row_start),
+            "width": col_stop - col_start,
+            "height": row_stop - row_start,
+            "shape": (row_stop - row_start, col_stop - col_start),
+        }
+    )
+    return tile_config
+
+
+def reproject_band(band, meta, reprojection_config):
+    # Reproject a band onto the shared bulk grid, returns the new band and meta
+    with measure_stage("reproject"):
+        nodata = meta["nodata"]
+        dest_array = np.full(
+            (reprojection_config["height"], reprojection_config["width"]),
+            np.nan if nodata is None else nodata,
+            dtype=band.dtype,
+        )
+        # On a tiled (planned) grid only the tiles the scene overlaps are warped
+        window = (0, reprojection_config["height"], 0, reprojection_config["width"])
+        if band.size and reprojection_config.get("tile_size"):
+            window = overlap_window(
+                meta["crs"], meta["transform"], band.shape, reprojection_config
+            )
+        warp_config = tile_reprojection_config(reprojection_config, window)
+        warp_destination = dest_array[window[0] : window[1], window[2] : window[3]]
+        if band.size == 0 or warp_destination.size == 0:
+            # Scene does not overlap the target grid (e.g. outside the AOI)
+            pass
+        elif reprojection_config.get("use_plan_cache"):
+            plan = get_reprojection_plan(
+                meta["crs"],
+                meta["transform"],
+                band.shape,
+                warp_config,
+                reprojection_config.get("plan_cache_folder"),
+            )
+            apply_reprojection_plan(plan, band, nodata, warp_destination)
+        else:
+            # GDAL needs a contiguous destination
+            tile = np.ascontiguousarray(warp_destination)
+            reproject(
+                source=band,
+                destination=tile,
+                src_transform=meta["transform"],
+                src_crs=meta["crs"],
+                src_nodata=nodata,
+                dst_transform=warp_config["transform"],
+                dst_crs=warp_config["crs"],
+                dst_nodata=nodata,
+                resampling=Resampling.bilinear,
+            )
+            if tile is not warp_destination:
+                warp_destination[...] = tile
+        apply_aoi_mask(dest_array, reprojection_config, nodata)
+
+    # Update meta with the reprojection config
+    new_meta = meta.copy()
+    new_meta.update(
+        {
+            "crs": reprojection_config["crs"],
+            "transform": reprojection_config["transform"],
+            "width": reprojection_config["width"],
+            "height": reprojection_config["height"],
+            "compress": "deflate",
+        }
+    )
+    return dest_array, new_meta
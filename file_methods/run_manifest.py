@@ -0,0 +1,115 @@
+import json
+import os
+
+import numpy as np
+
+from .scene_records import serialize_meta, deserialize_meta
+
+# A run manifest in the output folder records, per processing method and suffix,
+# the input fingerprints of every scene, the target grid and what was written, so
+# later runs only redo scenes (or yearly groups) whose inputs changed.
+MANIFEST_NAME = "run_manifest.json"
+ACCUMULATOR_FOLDER = ".accumulators"
+
+
+def run_key(processing_method, output_suffix):
+    return f"{processing_method}_{output_suffix}"
+
+
+def remove_entry_outputs(entry):
+    # Outputs and accumulators of a discarded entry, groups or scenes that are
+    # gone from the new run would otherwise be left behind
+    paths = [
+        path for scene in entry["scenes"].values() for path in scene.get("outputs", [])
+    ]
+    for group in entry["groups"].values():
+        paths.extend([group["output"], group["accumulator"]])
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def load_run_manifest(
+    output_path, processing_method, output_suffix, grid, qa_mask=None
+):
+    # Returns the manifest entry for this method/suffix, or a fresh one when it
+    # does not exist or was produced on a different target grid or QA mask
+    manifest_path = os.path.join(output_path, MANIFEST_NAME)
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, "r") as f:
+            manifest = json.load(f)
+    entry = manifest.get(run_key(processing_method, output_suffix))
+    if entry is not None and entry["grid"] != grid:
+        print("Target grid changed since the last run, reprocessing everything")
+        remove_entry_outputs(entry)
+        entry = None
+    elif entry is not None and entry.get("qa_mask") != qa_mask:
+        print("QA mask changed since the last run, reprocessing everything")
+        remove_entry_outputs(entry)
+        entry = None
+    if entry is None:
+        entry = {
+            "processing_method": processing_method,
+            "grid": grid,
+            "qa_mask": qa_mask,
+            "scenes": {},
+            "groups": {},
+        }
+    return entry
+
+
+def save_run_manifest(output_path, processing_method, output_suffix, entry):
+    manifest_path = os.path.join(output_path, MANIFEST_NAME)
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, "r") as f:
+            manifest = json.load(f)
+    manifest[run_key(processing_method, output_suffix)] = entry
+    temp_path = f"{manifest_path}.tmp"
+    with open(temp_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(temp_path, manifest_path)
+
+
+def scene_is_current(entry, scene, fingerprint):
+    previous = entry["scenes"].get(scene)
+    return (
+        previous is not None
+        and previous["fingerprint"] == fingerprint
+        and all(os.path.exists(path) for path in previous["outputs"])
+    )
+
+
+def accumulator_path(output_path, processing_method, output_suffix, group_key):
+    folder = os.path.join(
+        output_path, ACCUMULATOR_FOLDER, run_key(processing_method, output_suffix)
+    )
+    os.makedirs(folder, exist_ok=True)
+    return os.path.join(folder, f"{group_key}.npz")
+
+
+def save_accumulator(path, accumulator):
+    temp_path = f"{path}.tmp.npz"
+    np.savez(temp_path, sum=accumulator["sum"], count=accumulator["count"])
+    os.replace(temp_path, path)
+    # Everything but the arrays goes into the manifest entry for the group
+    return {
+        "accumulator": path,
+        "scene_count": accumulator["scene_count"],
+        "dtype": np.dtype(accumulator["dtype"]).name,
+        "meta": serialize_meta(accumulator["meta"]),
+        "mtl": accumulator["mtl"],
+    }
+
+
+def load_accumulator(group_entry):
+    with np.load(group_entry["accumulator"]) as arrays:
+        return {
+            "sum": arrays["sum"],
+            "count": arrays["count"],
+            "scene_count": group_entry["scene_count"],
+            "dtype": np.dtype(group_entry["dtype"]),
+            "meta": deserialize_meta(group_entry["meta"]),
+            "mtl": group_entry["mtl"],
+        }
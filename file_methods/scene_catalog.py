@@ -0,0 +1,258 @@
+import json
+import os
+import sqlite3
+
+from .raster_cache import open_raster
+
+# A SQLite index of the scene folders kept in the input folder. Each scene's band
+# paths, parsed MTL, acquisition attributes, grid and scaling coefficients are
+# recorded once. Later runs only rescan folders whose modification time changed,
+# or whose MTL file's modification time or size did, and select scenes (by year,
+# date range, cloud cover) with a query instead of listing every folder and
+# parsing every MTL.
+CATALOG_NAME = "scene_catalog.sqlite"
+CATALOG_COLUMNS = [
+    ("scene", "TEXT PRIMARY KEY"),
+    ("folder_mtime_ns", "INTEGER"),
+    # An MTL rewritten in place doesn't change the folder's modification time
+    ("mtl_mtime_ns", "INTEGER"),
+    ("mtl_size", "INTEGER"),
+    ("band_paths", "TEXT"),
+    ("mtl", "TEXT"),
+    ("product_id", "TEXT"),
+    ("spacecraft", "TEXT"),
+    ("date_acquired", "TEXT"),
+    ("year", "INTEGER"),
+    ("wrs_path", "INTEGER"),
+    ("wrs_row", "INTEGER"),
+    ("cloud_cover", "REAL"),
+    ("crs", "TEXT"),
+    ("transform", "TEXT"),
+    ("width", "INTEGER"),
+    ("height", "INTEGER"),
+    ("temperature_mult", "REAL"),
+    ("temperature_add", "REAL"),
+    ("temperature_minimum", "REAL"),
+    ("temperature_maximum", "REAL"),
+    # JSON {band: [mult, add]} for every band with reflectance coefficients
+    ("reflectance_scaling", "TEXT"),
+]
+# Band used for the recorded grid, the same one peek uses for the bulk grid
+CATALOG_GRID_BAND = "B10"
+
+# Parsed MTLs of catalogued scenes, so the processing methods do not re-read them
+_mtl_cache = {}
+
+
+def load_mtl(mtl_path):
+    if mtl_path in _mtl_cache:
+        return _mtl_cache[mtl_path]
+    with open(mtl_path, "r") as f:
+        return json.load(f)
+
+
+def open_scene_catalog(input_folder, scan_key):
+    # scan_key describes which files a scene scan picks up, a different set of
+    # bands invalidates every entry
+    connection = sqlite3.connect(os.path.join(input_folder, CATALOG_NAME))
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS catalog_info (key TEXT PRIMARY KEY, value TEXT)"
+    )
+    stored_columns = [row[1] for row in connection.execute("PRAGMA table_info(scenes)")]
+    if stored_columns and stored_columns != [name for name, _ in CATALOG_COLUMNS]:
+        print("Catalog columns changed since the catalog was built, rebuilding it")
+        connection.execute("DROP TABLE scenes")
+    columns = ", ".join(f"{name} {kind}" for name, kind in CATALOG_COLUMNS)
+    connection.execute(f"CREATE TABLE IF NOT EXISTS scenes ({columns})")
+    stored_key = connection.execute(
+        "SELECT value FROM catalog_info WHERE key = 'scan_key'"
+    ).fetchone()
+    if stored_key is None or stored_key[0] != scan_key:
+        if stored_key is not None:
+            print("Scanned bands changed since the catalog was built, rebuilding it")
+        connection.execute("DELETE FROM scenes")
+        connection.execute(
+            "INSERT OR REPLACE INTO catalog_info VALUES ('scan_key', ?)", (scan_key,)
+        )
+    connection.commit()
+    return connection
+
+
+def reflectance_coefficients(reflectance):
+    # {"B4": [mult, add], ...} from the MTL's surface reflectance parameters
+    prefix = "REFLECTANCE_MULT_BAND_"
+    return {
+        f"B{key[len(prefix):]}": [
+            float(value),
+            float(reflectance[f"REFLECTANCE_ADD_BAND_{key[len(prefix):]}"]),
+        ]
+        for key, value in reflectance.items()
+        if key.startswith(prefix)
+    }
+
+
+def mtl_freshness(mtl_path):
+    # (modification time, size) of an MTL file, None once it is gone
+    try:
+        stat = os.stat(mtl_path)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def catalog_entry(scene_folder, folder_mtime_ns, band_paths):
+    mtl_mtime_ns, mtl_size = mtl_freshness(band_paths["MTL"])
+    with open(band_paths["MTL"], "r") as f:
+        mtl_text = f.read()
+    metadata = json.loads(mtl_text)["LANDSAT_METADATA_FILE"]
+    attributes = metadata["IMAGE_ATTRIBUTES"]
+    temperature = metadata.get("LEVEL2_SURFACE_TEMPERATURE_PARAMETERS", {})
+    reflectance = metadata.get("LEVEL2_SURFACE_REFLECTANCE_PARAMETERS", {})
+
+    entry = {
+        "scene": os.path.basename(scene_folder),
+        "folder_mtime_ns": folder_mtime_ns,
+        "mtl_mtime_ns": mtl_mtime_ns,
+        "mtl_size": mtl_size,
+        # Stored relative to the scene folder so the input folder can move
+        "band_paths": json.dumps(
+            {band: os.path.basename(path) for band, path in band_paths.items()}
+        ),
+        "mtl": mtl_text,
+        "product_id": metadata["PRODUCT_CONTENTS"].get("LANDSAT_PRODUCT_ID"),
+        "spacecraft": attributes.get("SPACECRAFT_ID"),
+        "date_acquired": attributes["DATE_ACQUIRED"],
+        "year": int(attributes["DATE_ACQUIRED"][:4]),
+        "wrs_path": int(attributes["WRS_PATH"]),
+        "wrs_row": int(attributes["WRS_ROW"]),
+        "cloud_cover": float(attributes["CLOUD_COVER"]),
+        "crs": None,
+        "transform": None,
+        "width": None,
+        "height": None,
+        "temperature_mult": temperature.get("TEMPERATURE_MULT_BAND_ST_B10"),
+        "temperature_add": temperature.get("TEMPERATURE_ADD_BAND_ST_B10"),
+        "temperature_minimum": temperature.get("TEMPERATURE_MINIMUM_BAND_ST_B10"),
+        "temperature_maximum": temperature.get("TEMPERATURE_MAXIMUM_BAND_ST_B10"),
+        "reflectance_scaling": json.dumps(reflectance_coefficients(reflectance)),
+    }
+
+    grid_band = CATALOG_GRID_BAND if CATALOG_GRID_BAND in band_paths else None
+    if grid_band is None:
+        grid_band = next((band for band in band_paths if band != "MTL"), None)
+    if grid_band is not None:
+        with open_raster(band_paths[grid_band]) as src:
+            entry.update(
+                {
+                    "crs": src.crs.to_wkt() if src.crs else None,
+                    "transform": json.dumps(list(src.transform)[:6]),
+                    "width": src.width,
+                    "height": src.height,
+                }
+            )
+    return entry
+
+
+def scene_is_fresh(scene_folder, folder_mtime_ns, known_scene):
+    stored_folder_mtime_ns, band_paths, mtl_mtime_ns, mtl_size = known_scene
+    if stored_folder_mtime_ns != folder_mtime_ns:
+        return False
+    mtl_path = os.path.join(scene_folder, json.loads(band_paths)["MTL"])
+    return mtl_freshness(mtl_path) == (mtl_mtime_ns, mtl_size)
+
+
+def update_scene_catalog(connection, input_folder, scan_folder):
+    # Rescan new folders, folders whose modification time changed and folders
+    # whose MTL was rewritten, drop folders that are gone. Reprocessed USGS
+    # products get new file names, which changes the folder's modification time.
+    known = {
+        scene: known_scene
+        for scene, *known_scene in connection.execute(
+            "SELECT scene, folder_mtime_ns, band_paths, mtl_mtime_ns, mtl_size "
+            "FROM scenes"
+        )
+    }
+    seen = set()
+    scanned = 0
+    with os.scandir(input_folder) as entries:
+        for entry in entries:
+            if not entry.is_dir():
+                continue
+            seen.add(entry.name)
+            folder_mtime_ns = entry.stat().st_mtime_ns
+            if entry.name in known and scene_is_fresh(
+                entry.path, folder_mtime_ns, known[entry.name]
+            ):
+                continue
+            if entry.name in known:
+                forget_mtl(entry.path, known[entry.name][1])
+            band_paths = scan_folder(entry.path)
+            if "MTL" not in band_paths:
+                print(
+                    f"WARNING: No MTL file in {entry.path}, leaving it out of the catalog"
+                )
+                continue
+            scene_entry = catalog_entry(entry.path, folder_mtime_ns, band_paths)
+            names = ", ".join(scene_entry)
+            placeholders = ", ".join("?" for _ in scene_entry)
+            connection.execute(
+                f"INSERT OR REPLACE INTO scenes ({names}) VALUES ({placeholders})",
+                list(scene_entry.values()),
+            )
+            scanned += 1
+
+    removed = [scene for scene in known if scene not in seen]
+    for scene in removed:
+        forget_mtl(os.path.join(input_folder, scene), known[scene][1])
+    connection.executemany(
+        "DELETE FROM scenes WHERE scene = ?", [(scene,) for scene in removed]
+    )
+    connection.commit()
+    print(
+        f"Scene catalog: {scanned} scenes scanned, {len(removed)} removed, "
+        f"{len(seen) - scanned} unchanged"
+    )
+
+
+def forget_mtl(scene_folder, band_paths):
+    # A rescanned or removed scene's parsed MTL must not be served again
+    _mtl_cache.pop(os.path.join(scene_folder, json.loads(band_paths)["MTL"]), None)
+
+
+def query_scene_catalog(
+    connection,
+    input_folder,
+    years=None,
+    start_date=None,
+    end_date=None,
+    max_cloud_cover=None,
+):
+    # Returns a scene library ({scene folder: band paths}) of the matching scenes
+    conditions, parameters = [], []
+    if years:
+        conditions.append(f"year IN ({', '.join('?' for _ in years)})")
+        parameters.extend(years)
+    if start_date:
+        conditions.append("date_acquired >= ?")
+        parameters.append(start_date)
+    if end_date:
+        conditions.append("date_acquired <= ?")
+        parameters.append(end_date)
+    if max_cloud_cover is not None:
+        conditions.append("cloud_cover <= ?")
+        parameters.append(max_cloud_cover)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+    scene_library = {}
+    for scene, band_paths, mtl_text in connection.execute(
+        f"SELECT scene, band_paths, mtl FROM scenes {where} ORDER BY scene",
+        parameters,
+    ):
+        scene_folder = os.path.join(input_folder, scene)
+        band_paths = {
+            band: os.path.join(scene_folder, file_name)
+            for band, file_name in json.loads(band_paths).items()
+        }
+        _mtl_cache[band_paths["MTL"]] = json.loads(mtl_text)
+        scene_library[scene_folder] = band_paths
+    return scene_library
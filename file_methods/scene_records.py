@@ -0,0 +1,39 @@
+import hashlib
+import json
+import os
+
+from affine import Affine
+from rasterio.crs import CRS
+
+# Shared by the scene store and the run manifest: band meta in a JSON friendly
+# form, and fingerprints of a scene's input files that change when any of them
+# is replaced or reprocessed.
+
+
+def serialize_meta(meta):
+    serialized = meta.copy()
+    serialized["crs"] = meta["crs"].to_wkt() if meta["crs"] else None
+    serialized["transform"] = list(meta["transform"])[:6]
+    return serialized
+
+
+def deserialize_meta(serialized):
+    meta = serialized.copy()
+    meta["crs"] = CRS.from_wkt(serialized["crs"]) if serialized["crs"] else None
+    meta["transform"] = Affine(*serialized["transform"])
+    return meta
+
+
+def file_fingerprint(path):
+    stat = os.stat(path)
+    fingerprint = [os.path.basename(path), stat.st_size, stat.st_mtime_ns]
+    if path.endswith(".json"):
+        # The MTL is tiny and changes whenever USGS reprocesses a scene
+        with open(path, "rb") as f:
+            fingerprint.append(hashlib.sha256(f.read()).hexdigest())
+    return fingerprint
+
+
+def scene_fingerprint(band_paths):
+    fingerprint = [file_fingerprint(band_paths[band]) for band in sorted(band_paths)]
+    return hashlib.sha256(json.dumps(fingerprint).encode("utf-8")).hexdigest()
@@ -0,0 +1,106 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from .scene_records import serialize_meta, deserialize_meta, scene_fingerprint
+
+# Processed scene bands are written once as .npy files next to a JSON sidecar and
+# handed around as read-only memory maps. A scene whose sidecar exists is complete,
+# so an interrupted run (or another method producing the same product on the same
+# grid) picks up where the last one stopped. Entries are named after the scene and
+# a fingerprint of its input files.
+
+
+def grid_key(reprojection_config):
+    if not reprojection_config:
+        return "native"
+    grid_description = "|".join(
+        [
+            reprojection_config["crs"].to_wkt(),
+            repr(tuple(reprojection_config["transform"])[:6]),
+            repr((reprojection_config["height"], reprojection_config["width"])),
+            repr(reprojection_config.get("aoi_mask") is not None),
+        ]
+    )
+    return hashlib.sha1(grid_description.encode("utf-8")).hexdigest()[:12]
+
+
+def scene_store_folder(store_root, product, reprojection_config):
+    folder = os.path.join(store_root, f"{product}_{grid_key(reprojection_config)}")
+    os.makedirs(folder, exist_ok=True)
+    return folder
+
+
+def stored_scene_paths(store_folder, scene_name):
+    base = os.path.join(store_folder, scene_name)
+    return f"{base}.npy", f"{base}.json"
+
+
+def load_stored_scene(store_folder, scene_name):
+    band_path, sidecar_path = stored_scene_paths(store_folder, scene_name)
+    if not os.path.exists(sidecar_path):
+        return None
+    with open(sidecar_path, "r") as f:
+        sidecar = json.load(f)
+    return {
+        "band": np.load(band_path, mmap_mode="r"),
+        "meta": deserialize_meta(sidecar["meta"]),
+        "mtl": sidecar["mtl"],
+    }
+
+
+def store_scene(store_folder, scene_name, processed_scene):
+    band_path, sidecar_path = stored_scene_paths(store_folder, scene_name)
+    temp_band_path = f"{band_path}.{os.getpid()}.tmp.npy"
+    np.save(temp_band_path, processed_scene["band"])
+    os.replace(temp_band_path, band_path)
+
+    # The sidecar goes last, its presence marks the scene as complete
+    temp_sidecar_path = f"{sidecar_path}.{os.getpid()}.tmp"
+    with open(temp_sidecar_path, "w") as f:
+        json.dump(
+            {
+                "meta": serialize_meta(processed_scene["meta"]),
+                "mtl": processed_scene["mtl"],
+            },
+            f,
+        )
+    os.replace(temp_sidecar_path, sidecar_path)
+    return load_stored_scene(store_folder, scene_name)
+
+
+def stored_scene_name(scene):
+    # The input fingerprint is part of the name, so a scene whose files were
+    # replaced or reprocessed gets a new entry instead of the stale one
+    scene_name = os.path.basename(os.path.dirname(scene["MTL"]))
+    return scene_name, f"{scene_name}_{scene_fingerprint(scene)[:12]}"
+
+
+def remove_stale_scenes(store_folder, scene_name, stored_name):
+    # Entries of the same scene from older inputs, temporary files are left alone
+    for file in os.listdir(store_folder):
+        stem, extension = os.path.splitext(file)
+        if (
+            extension in [".npy", ".json"]
+            and stem.startswith(f"{scene_name}_")
+            and len(stem) == len(stored_name)
+            and stem != stored_name
+        ):
+            os.remove(os.path.join(store_folder, file))
+
+
+def stored_folder_process(
+    folder_process, store_folder, scene, reprojection_config=None
+):
+    # Drop-in folder_process that reuses (or fills) the on-disk scene store
+    scene_name, stored_name = stored_scene_name(scene)
+    stored_scene = load_stored_scene(store_folder, stored_name)
+    if stored_scene is not None:
+        print(f"Reusing stored scene {scene_name}")
+        return stored_scene
+    processed_scene = folder_process(scene, reprojection_config=reprojection_config)
+    stored_scene = store_scene(store_folder, stored_name, processed_scene)
+    remove_stale_scenes(store_folder, scene_name, stored_name)
+    return stored_scene
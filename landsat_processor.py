@@ -1,74 +1,227 @@
 import argparse
+import json
 import os
 import sys
+from functools import partial
 
 import numpy as np
 import rasterio
 
-from calc.landsat_processing_methods import calc_surface_temp, calc_ndvi
-from calc.bulk_processing_methods import average_by_year, average_all_data
-from calc.band_stat_calculators import surface_temp_stats, ndvi_stats
+from calc.landsat_processing_methods import (
+    calc_surface_temp,
+    surface_temp_plan,
+    calc_emissivity_surface_temp,
+    emissivity_surface_temp_plan,
+)
+from calc.band_expressions import index_registry, calc_index, index_plan
+from calc.bulk_processing_methods import (
+    average_by_year,
+    average_all_data,
+    average_by_month,
+    average_by_season,
+    accumulate_scene,
+    finalize_accumulators,
+    print_num_scenes_by_year,
+    bulk_group_keys,
+)
+from calc.compositing import composite_reducers, composite_groupings, composite_scenes
+from calc.product_processing import product_output_name, process_scene_products
+from calc.qa_masking import qa_flag_bits, qa_bitmask, resolve_qa_mask
+from execution.instrumentation import (
+    configure_metrics,
+    finish_metrics,
+    measure_stage,
+    metrics_folder_process,
+)
+from calc.band_stat_calculators import (
+    surface_temp_stats,
+    index_stats,
+    surface_temp_stat_accumulator,
+    index_stat_accumulator,
+    update_stat_accumulator,
+    finalize_stats,
+)
+from calc.windowed_processing import run_block_calculation
 from file_methods.file_methods import peek
+from file_methods.raster_cache import READ_CACHE_MB, configure_raster_cache
+from file_methods.grid_planner import GRID_MODES, plan_target_grid, pinned_target_grid
+from file_methods.aoi import load_aoi, aoi_reprojection_config, scenes_overlapping_aoi
+from file_methods.scene_catalog import (
+    open_scene_catalog,
+    update_scene_catalog,
+    query_scene_catalog,
+    load_mtl,
+)
+from file_methods.output_formats import (
+    OUTPUT_FORMATS,
+    COG_COMPRESSIONS,
+    COG_BLOCK_SIZE,
+    output_options,
+    open_output,
+)
+from file_methods.datacube import CUBE_CHUNKS, cube_path, write_cube
+from file_methods.scene_store import (
+    grid_key,
+    scene_store_folder,
+    stored_folder_process,
+)
+from file_methods.scene_records import scene_fingerprint
+from file_methods.run_manifest import (
+    load_run_manifest,
+    save_run_manifest,
+    scene_is_current,
+    accumulator_path,
+    run_key,
+    save_accumulator,
+    load_accumulator,
+)
+from execution.scene_pool import process_scenes_in_pool, map_scenes_in_pool
+from execution.task_graph import (
+    bulk_task_graph,
+    scene_task_graph,
+    partials_folder_path,
+    remove_partials,
+    run_task_graph_in_pool,
+)
+from execution.work_queue import run_task_graph_in_queue
+from execution.pipeline import read_scenes_in_pipeline, write_scenes_in_pipeline
 
+TASK_EXECUTORS = ["pool", "queue"]
+WORK_QUEUE_NAME = "work_queue.sqlite"
 
 process_dict = {
     # TEMPERATURE
     # Kelvin
     "surface_temp": {
+        "product": "surface_temp",
         "folder_process": calc_surface_temp,
+        "folder_plan": surface_temp_plan,
         "bulk_process": None,
         "stat_calculator": surface_temp_stats,
+        "stat_accumulator": surface_temp_stat_accumulator,
     },
     # Celsius
     "surface_temp_celsius": {
-        "folder_process": lambda scene, celsius=True, reprojection_config=None: calc_surface_temp(
-            scene, celsius, reprojection_config
-        ),
+        "product": "surface_temp_celsius",
+        "folder_process": partial(calc_surface_temp, celsius=True),
+        "folder_plan": partial(surface_temp_plan, celsius=True),
         "bulk_process": None,
-        "stat_calculator": lambda band, meta, mtl: surface_temp_stats(
-            band, meta, mtl, celsius=True
-        ),
+        "stat_calculator": partial(surface_temp_stats, celsius=True),
+        "stat_accumulator": partial(surface_temp_stat_accumulator, celsius=True),
     },
     # Celsius with yearly averages
     "averaged_yearly_surface_temp_celsius": {
-        "folder_process": lambda scene, celsius=True, reprojection_config=None: calc_surface_temp(
-            scene, celsius, reprojection_config
-        ),
+        "product": "surface_temp_celsius",
+        "folder_process": partial(calc_surface_temp, celsius=True),
+        "folder_plan": partial(surface_temp_plan, celsius=True),
         "bulk_process": average_by_year,
-        "stat_calculator": lambda band, meta, mtl: surface_temp_stats(
-            band, meta, mtl, celsius=True
-        ),
+        "stat_calculator": partial(surface_temp_stats, celsius=True),
+        "stat_accumulator": partial(surface_temp_stat_accumulator, celsius=True),
     },
     # Celsius with yearly averages
     "averaged_surface_temp_celsius": {
-        "folder_process": lambda scene, celsius=True, reprojection_config=None: calc_surface_temp(
-            scene, celsius, reprojection_config
-        ),
+        "product": "surface_temp_celsius",
+        "folder_process": partial(calc_surface_temp, celsius=True),
+        "folder_plan": partial(surface_temp_plan, celsius=True),
         "bulk_process": average_all_data,
-        "stat_calculator": lambda band, meta, mtl: surface_temp_stats(
-            band, meta, mtl, celsius=True
-        ),
+        "stat_calculator": partial(surface_temp_stats, celsius=True),
+        "stat_accumulator": partial(surface_temp_stat_accumulator, celsius=True),
     },
-    # NDVI
-    "ndvi": {
-        "folder_process": calc_ndvi,
+    # EMISSIVITY CORRECTED TEMPERATURE
+    # Kelvin
+    "emissivity_surface_temp": {
+        "product": "emissivity_surface_temp",
+        "folder_process": calc_emissivity_surface_temp,
+        "folder_plan": emissivity_surface_temp_plan,
         "bulk_process": None,
-        "stat_calculator": ndvi_stats,
-    },
-    # NDVI with yearly averages
-    "averaged_yearly_ndvi": {
-        "folder_process": calc_ndvi,
-        "bulk_process": average_by_year,
-        "stat_calculator": ndvi_stats,
+        "stat_calculator": surface_temp_stats,
+        "stat_accumulator": surface_temp_stat_accumulator,
     },
-    # NDVI averaged over all data
-    "averaged_ndvi": {
-        "folder_process": calc_ndvi,
-        "bulk_process": average_all_data,
-        "stat_calculator": ndvi_stats,
+    # Celsius
+    "emissivity_surface_temp_celsius": {
+        "product": "emissivity_surface_temp_celsius",
+        "folder_process": partial(calc_emissivity_surface_temp, celsius=True),
+        "folder_plan": partial(emissivity_surface_temp_plan, celsius=True),
+        "bulk_process": None,
+        "stat_calculator": partial(surface_temp_stats, celsius=True),
+        "stat_accumulator": partial(surface_temp_stat_accumulator, celsius=True),
     },
 }
 
+# Celsius with yearly and overall averages
+for averaged_method, bulk_process in [
+    ("averaged_yearly_emissivity_surface_temp_celsius", average_by_year),
+    ("averaged_emissivity_surface_temp_celsius", average_all_data),
+]:
+    process_dict[averaged_method] = dict(
+        process_dict["emissivity_surface_temp_celsius"], bulk_process=bulk_process
+    )
+
+
+def index_processing_methods(index_name):
+    # Per-scene, yearly averaged and overall averaged methods for a registry index
+    value_range = index_registry[index_name]["range"]
+    method = {
+        "product": index_name,
+        "folder_process": partial(calc_index, index_name=index_name),
+        "folder_plan": partial(index_plan, index_name=index_name),
+        "stat_calculator": partial(index_stats, value_range=value_range),
+        "stat_accumulator": partial(index_stat_accumulator, value_range=value_range),
+    }
+    return {
+        # e.g. ndvi
+        index_name: dict(method, bulk_process=None),
+        # e.g. averaged_yearly_ndvi
+        f"averaged_yearly_{index_name}": dict(method, bulk_process=average_by_year),
+        # e.g. averaged_ndvi
+        f"averaged_{index_name}": dict(method, bulk_process=average_all_data),
+    }
+
+
+# SPECTRAL INDICES (NDVI, NDWI, NDBI, EVI, SAVI)
+for index_name in index_registry:
+    process_dict.update(index_processing_methods(index_name))
+
+
+def grouped_processing_methods(product_name):
+    # Monthly/seasonal averages and per-pixel composites of an averaged product
+    method = {
+        key: value
+        for key, value in process_dict[f"averaged_{product_name}"].items()
+        if key != "bulk_process"
+    }
+    methods = {
+        # e.g. averaged_monthly_ndvi
+        f"averaged_monthly_{product_name}": dict(method, bulk_process=average_by_month),
+        # e.g. averaged_seasonal_ndvi
+        f"averaged_seasonal_{product_name}": dict(
+            method, bulk_process=average_by_season
+        ),
+    }
+    for reducer in composite_reducers:
+        for grouping in composite_groupings:
+            # e.g. median_yearly_ndvi, max_seasonal_ndvi, p90_surface_temp_celsius
+            name = (
+                f"{reducer}_{product_name}"
+                if grouping == "all"
+                else f"{reducer}_{grouping}_{product_name}"
+            )
+            methods[name] = dict(
+                method,
+                bulk_process=partial(
+                    composite_scenes, reducer=reducer, grouping=grouping
+                ),
+            )
+    return methods
+
+
+# TEMPORAL GROUPINGS AND COMPOSITES
+for product_name in [
+    "surface_temp_celsius",
+    "emissivity_surface_temp_celsius",
+] + list(index_registry):
+    process_dict.update(grouped_processing_methods(product_name))
+
 
 def load_bands(scene_folder, band_numbers, meta_bands):
     band_paths = {}
@@ -86,72 +239,767 @@ def load_bands(scene_folder, band_numbers, meta_bands):
     return band_paths
 
 
-def write_outputs(output_path, output_suffix, output_library, processing_method):
+def output_file_path(output_path, scene_key, output_suffix):
+    modified_scene_key = (
+        scene_key.replace("./landsat", "", 1)
+        if scene_key.startswith("./landsat")
+        else f"/{scene_key}"
+    )
+    return f"{output_path}{modified_scene_key}_{output_suffix}.tif"
+
+
+def update_stat_tags(destination, stats):
+    # Update metadata with statistics for the band
+    destination.update_tags(
+        1,
+        STATISTICS_MINIMUM=stats["min"],
+        STATISTICS_MAXIMUM=stats["max"],
+        STATISTICS_MEAN=stats["mean"],
+        STATISTICS_STDDEV=stats["std"],
+        STATISTICS_MEDIAN=stats["median"],
+    )
+
+
+def write_scene_output(
+    output_path,
+    output_suffix,
+    processing_method,
+    scene_key,
+    current_scene,
+    write_count_band=False,
+    exact_median=False,
+    output_format_options=None,
+):
+    file_path = output_file_path(output_path, scene_key, output_suffix)
+    print(f"Writing {file_path}")
+
+    meta = current_scene["meta"]
+    include_count = write_count_band and "count" in current_scene
+    if include_count:
+        meta = meta.copy()
+        meta["count"] = 2
+
+    scene_name = os.path.basename(scene_key)
+    band_data = current_scene["band"]
+    with measure_stage("stats", scene_name):
+        stats = process_dict[processing_method]["stat_calculator"](
+            band_data,
+            current_scene["meta"],
+            current_scene["mtl"],
+            exact_median=exact_median,
+        )
+
+    with measure_stage("write", scene_name) as counters:
+        with open_output(file_path, meta, output_format_options) as destination:
+            update_stat_tags(destination, stats)
+            destination.write(band_data, 1)
+
+            if include_count:
+                # Per-pixel number of valid scenes that went into the average
+                destination.write(current_scene["count"].astype(meta["dtype"]), 2)
+                destination.set_band_description(2, "valid_count")
+        counters["bytes_written"] = os.path.getsize(file_path)
+
+
+def write_outputs(
+    output_path,
+    output_suffix,
+    output_library,
+    processing_method,
+    write_count_band=False,
+    exact_median=False,
+    writer_threads=0,
+    output_format_options=None,
+):
+    # output_library is a dict of scenes, or an iterable of (scene_key, scene)
+    # pairs that are written as they arrive
     print("Writing output files...")
     print(f"Output path: {output_path}")
-    for scene_key in output_library:
-        current_scene = output_library[scene_key]
-        modified_scene_key = (
-            scene_key.replace("./landsat", "", 1)
-            if scene_key.startswith("./landsat")
-            else f"/{scene_key}"
+    scenes = (
+        output_library.items() if isinstance(output_library, dict) else output_library
+    )
+    if output_format_options and output_format_options["output_format"] == "zarr":
+        write_cube(
+            cube_path(output_path, processing_method, output_suffix),
+            process_dict[processing_method]["product"],
+            scenes,
+            output_format_options["cube_chunks"],
+            output_format_options["compression"],
         )
-        file_path = f"{output_path}{modified_scene_key}_{output_suffix}.tif"
-        print(f"Writing {file_path}")
+        return
 
-        with rasterio.open(file_path, "w", **current_scene["meta"]) as destination:
-            band_data = current_scene["band"]
+    write_scene = partial(
+        write_scene_output,
+        output_path,
+        output_suffix,
+        processing_method,
+        write_count_band=write_count_band,
+        exact_median=exact_median,
+        output_format_options=output_format_options,
+    )
+    if writer_threads:
+        write_scenes_in_pipeline(scenes, write_scene, writer_threads)
+    else:
+        for scene_key, current_scene in scenes:
+            write_scene(scene_key, current_scene)
 
-            stats = process_dict[processing_method]["stat_calculator"](
-                band_data, current_scene["meta"], current_scene["mtl"]
-            )
 
-            # Update metadata with statistics for the band
-            destination.update_tags(
-                1,
-                STATISTICS_MINIMUM=stats["min"],
-                STATISTICS_MAXIMUM=stats["max"],
-                STATISTICS_MEAN=stats["mean"],
-                STATISTICS_STDDEV=stats["std"],
-                STATISTICS_MEDIAN=stats["median"],
+def write_windowed_output(
+    folder_plan,
+    stat_accumulator,
+    band_paths,
+    file_path,
+    exact_median=False,
+    output_format_options=None,
+):
+    # Compute the scene block by block straight into the output file, folding each
+    # block into the band statistics on the way
+    plan = folder_plan(band_paths)
+    accumulator = stat_accumulator(plan["meta"], plan["mtl"], exact_median=exact_median)
+    print(f"Writing {file_path} block by block...")
+    scene_name = os.path.basename(os.path.dirname(band_paths["MTL"]))
+    # Reads, compute and the statistics blocks are recorded by the block loop
+    with measure_stage("write", scene_name) as counters:
+        with open_output(file_path, plan["meta"], output_format_options) as destination:
+            run_block_calculation(
+                plan,
+                destination,
+                block_callback=partial(update_stat_accumulator, accumulator),
             )
-            destination.write(band_data, 1)
+            update_stat_tags(destination, finalize_stats(accumulator))
+        counters["bytes_written"] = os.path.getsize(file_path)
+    return file_path
 
 
-def process_landsat_data(
-    input_folder, processing_method, output_path, output_suffix=""
+def processed_scene_stream(
+    scene_library, folder_process, reprojection_config, workers=1, reader_threads=0
+):
+    # (scene, processed scene) pairs, one at a time, so a bulk step can fold each
+    # scene in, or its output can be written, and the scene dropped. Scenes are
+    # processed by worker processes, read ahead on threads or processed here.
+    if workers > 1:
+        print(f"Processing scenes across {workers} worker processes...")
+        return process_scenes_in_pool(
+            scene_library, folder_process, reprojection_config, workers
+        )
+    if reader_threads:
+        print(f"Reading scenes ahead on {reader_threads} threads...")
+        return read_scenes_in_pipeline(
+            scene_library, folder_process, reprojection_config, reader_threads
+        )
+    return (
+        (
+            scene,
+            folder_process(
+                scene_library[scene], reprojection_config=reprojection_config
+            ),
+        )
+        for scene in scene_library
+    )
+
+
+def process_incremental_bulk(
+    scene_library,
+    fingerprints,
+    manifest_entry,
+    processing_method,
+    folder_process,
+    reprojection_config,
+    output_path,
+    output_suffix,
+    workers=1,
+    write_count_band=False,
+    exact_median=False,
+    reader_threads=0,
+    writer_threads=0,
+    output_format_options=None,
+):
+    # New scenes are folded into the persisted sum/count of their group, groups that
+    # lost or changed a scene are rebuilt from their current scenes
+    group_key = bulk_group_keys[process_dict[processing_method]["bulk_process"]]
+    previous_scenes = manifest_entry["scenes"]
+    groups = manifest_entry["groups"]
+
+    changed = [
+        scene
+        for scene in scene_library
+        if previous_scenes.get(scene, {}).get("fingerprint") != fingerprints[scene]
+    ]
+    removed = [scene for scene in previous_scenes if scene not in scene_library]
+    dirty_groups = {
+        previous_scenes[scene]["group"]
+        for scene in changed + removed
+        if scene in previous_scenes
+    }
+    dirty_groups.update(
+        group for group in groups if not os.path.exists(groups[group]["output"])
+    )
+    to_process = {
+        scene: scene_library[scene]
+        for scene in scene_library
+        if scene in changed or previous_scenes[scene]["group"] in dirty_groups
+    }
+    print(
+        f"{len(changed)} new or changed scenes, {len(removed)} removed, "
+        f"rebuilding groups: {sorted(dirty_groups)}"
+    )
+    if not to_process and not dirty_groups:
+        print("All outputs are up to date")
+        return
+
+    processed_scenes = processed_scene_stream(
+        to_process, folder_process, reprojection_config, workers, reader_threads
+    )
+
+    accumulators = {}
+    for scene, processed_scene in processed_scenes:
+        group = group_key(processed_scene)
+        if group not in accumulators and group in groups and group not in dirty_groups:
+            accumulators[group] = load_accumulator(groups[group])
+        accumulate_scene(accumulators, group, processed_scene)
+        previous_scenes[scene] = {"fingerprint": fingerprints[scene], "group": group}
+
+    for scene in removed:
+        del previous_scenes[scene]
+    for group in dirty_groups - set(accumulators):
+        # Every scene of this group is gone, so is its output
+        print(f"Removing {group}, it no longer has any scenes")
+        for path in [groups[group]["output"], groups[group]["accumulator"]]:
+            if os.path.exists(path):
+                os.remove(path)
+        del groups[group]
+
+    write_outputs(
+        output_path,
+        output_suffix,
+        finalize_accumulators(accumulators),
+        processing_method,
+        write_count_band=write_count_band,
+        exact_median=exact_median,
+        writer_threads=writer_threads,
+        output_format_options=output_format_options,
+    )
+    for group in accumulators:
+        groups[group] = save_accumulator(
+            accumulator_path(output_path, processing_method, output_suffix, group),
+            accumulators[group],
+        )
+        groups[group]["output"] = output_file_path(output_path, group, output_suffix)
+
+
+def process_with_task_graph(
+    scene_library,
+    processing_method,
+    folder_process,
+    reprojection_config,
+    output_path,
+    output_suffix,
+    executor="pool",
+    queue_path=None,
+    workers=1,
+    write_count_band=False,
+    exact_median=False,
+    output_format_options=None,
+):
+    # Scene tasks write partial sums (or outputs for per-scene methods), merged per
+    # group in a tree reduction, run by a process pool or through a work queue
+    write_output = partial(
+        write_scene_output,
+        output_path,
+        output_suffix,
+        processing_method,
+        write_count_band=write_count_band,
+        exact_median=exact_median,
+        output_format_options=output_format_options,
+    )
+    bulk_process = process_dict[processing_method]["bulk_process"]
+    partials_folder = None
+    if bulk_process:
+        group_key = bulk_group_keys[bulk_process]
+        scene_groups = {
+            scene: group_key({"mtl": load_mtl(scene_library[scene]["MTL"])})
+            for scene in scene_library
+        }
+        partials_folder = partials_folder_path(
+            output_path, run_key(processing_method, output_suffix)
+        )
+        graph = bulk_task_graph(
+            scene_groups,
+            scene_library,
+            folder_process,
+            reprojection_config,
+            write_output,
+            partials_folder,
+        )
+    else:
+        graph = scene_task_graph(
+            scene_library, folder_process, reprojection_config, write_output
+        )
+
+    print(f"Running {len(graph)} tasks on the {executor} executor...")
+    if executor == "queue":
+        run_task_graph_in_queue(
+            graph, queue_path or os.path.join(output_path, WORK_QUEUE_NAME), workers
+        )
+    else:
+        run_task_graph_in_pool(graph, max(workers, 1))
+    if partials_folder:
+        remove_partials(partials_folder)
+
+
+def build_scene_library(
+    input_folder,
+    catalog=False,
+    refresh_catalog=True,
+    years=None,
+    start_date=None,
+    end_date=None,
+    max_cloud_cover=None,
 ):
-    if processing_method not in process_dict:
-        raise Exception(f"Unsupported processing method: {processing_method}")
     scene_library = {}
     required_bands = [1, 2, 3, 4, 5, 6, 7, 10]
-    meta_bands = ["_EMIS.TIF", "_MTL.json"]
+    meta_bands = ["_EMIS.TIF", "_TRAD.TIF", "_MTL.json", "_QA_PIXEL.TIF"]
+
+    scene_filters = [years, start_date, end_date, max_cloud_cover]
+    if catalog or any(scene_filter is not None for scene_filter in scene_filters):
+        with measure_stage("discovery"):
+            connection = open_scene_catalog(
+                input_folder, json.dumps([required_bands, meta_bands])
+            )
+            if refresh_catalog:
+                update_scene_catalog(
+                    connection,
+                    input_folder,
+                    partial(
+                        load_bands, band_numbers=required_bands, meta_bands=meta_bands
+                    ),
+                )
+            scene_library = query_scene_catalog(
+                connection, input_folder, years, start_date, end_date, max_cloud_cover
+            )
+            connection.close()
+        print(f"{len(scene_library)} scenes selected from the scene catalog")
+        if not scene_library:
+            raise Exception("No scenes in the catalog match the selection")
+    else:
+        for scene_folder in os.listdir(input_folder):
+            full_path = os.path.join(input_folder, scene_folder)
+            if os.path.isdir(full_path):
+                print(f"Processing scene: {scene_folder}")
+                with measure_stage("discovery", scene_folder):
+                    band_paths = load_bands(full_path, required_bands, meta_bands)
+                scene_library[full_path] = band_paths
+    return scene_library
+
+
+def target_reprojection_config(
+    scene_library,
+    aoi=None,
+    aoi_mask=False,
+    reprojection_cache=False,
+    reprojection_cache_folder=None,
+    target_grid="union",
+    target_crs=None,
+    grid_folder=None,
+):
+    # The shared grid bulk methods (and AOI clipping) warp every scene onto, "first"
+    # keeps the grid of the first scene. With a grid_folder the grid is planned
+    # once and pinned there.
+    if target_grid == "first":
+        plan = partial(peek, scene_library)
+    else:
+        plan = partial(
+            plan_target_grid, scene_library, mode=target_grid, crs=target_crs
+        )
+    if grid_folder:
+        reprojection_config = pinned_target_grid(
+            grid_folder, {"mode": target_grid, "crs": target_crs}, plan
+        )
+    else:
+        reprojection_config = plan()
+    if aoi:
+        print(f"Clipping to area of interest: {aoi}")
+        reprojection_config = aoi_reprojection_config(
+            load_aoi(aoi), reprojection_config, mask_to_polygon=aoi_mask
+        )
+    if reprojection_cache or reprojection_cache_folder:
+        reprojection_config["use_plan_cache"] = True
+        reprojection_config["plan_cache_folder"] = reprojection_cache_folder
+    return reprojection_config
+
+
+def method_output_suffix(output_suffix, processing_method):
+    # Outputs of several methods written in one run are told apart by method name
+    return (
+        f"{output_suffix}_{processing_method}" if output_suffix else processing_method
+    )
+
+
+def process_methods_in_one_pass(
+    scene_library,
+    processing_methods,
+    output_path,
+    output_suffix,
+    reprojection_config,
+    workers=1,
+    reader_threads=0,
+    writer_threads=0,
+    write_count_band=False,
+    exact_median=False,
+    output_format_options=None,
+    qa_mask=None,
+):
+    # Each scene is read once, every product is computed once and fanned out to the
+    # per-scene outputs and bulk accumulators of all requested methods
+    clip_to_aoi = bool(reprojection_config and reprojection_config.get("aoi"))
+    product_requests = {}
+    method_outputs = {}
+    for method in processing_methods:
+        product = process_dict[method]["product"]
+        grid = (
+            "target"
+            if process_dict[method]["bulk_process"] or clip_to_aoi
+            else "native"
+        )
+        request = product_requests.setdefault(
+            product,
+            {"folder_process": process_dict[method]["folder_process"], "grids": set()},
+        )
+        request["grids"].add(grid)
+        method_outputs[method] = product_output_name(product, grid)
+    print(
+        f"Computing {', '.join(product_requests)} once per scene for "
+        f"{', '.join(processing_methods)}"
+    )
+    folder_process = metrics_folder_process(
+        partial(
+            process_scene_products, product_requests=product_requests, qa_mask=qa_mask
+        )
+    )
+
+    processed_scenes = processed_scene_stream(
+        scene_library, folder_process, reprojection_config, workers, reader_threads
+    )
+
+    accumulators = {
+        method: {}
+        for method in processing_methods
+        if process_dict[method]["bulk_process"]
+    }
+
+    def per_scene_outputs():
+        # Per-scene outputs to write, bulk methods fold the scene in on the way
+        for scene, outputs in processed_scenes:
+            for method in processing_methods:
+                processed_scene = outputs[method_outputs[method]]
+                bulk_process = process_dict[method]["bulk_process"]
+                if bulk_process:
+                    group = bulk_group_keys[bulk_process](processed_scene)
+                    accumulate_scene(accumulators[method], group, processed_scene)
+                else:
+                    yield (
+                        output_path,
+                        method_output_suffix(output_suffix, method),
+                        method,
+                        scene,
+                        processed_scene,
+                    )
+
+    print("Writing output files...")
+    write_scene = partial(
+        write_scene_output,
+        write_count_band=write_count_band,
+        exact_median=exact_median,
+        output_format_options=output_format_options,
+    )
+    if writer_threads:
+        write_scenes_in_pipeline(per_scene_outputs(), write_scene, writer_threads)
+    else:
+        for output in per_scene_outputs():
+            write_scene(*output)
+
+    for method in accumulators:
+        print(f"{method}:")
+        print_num_scenes_by_year(accumulators[method])
+        write_outputs(
+            output_path,
+            method_output_suffix(output_suffix, method),
+            finalize_accumulators(accumulators[method]),
+            method,
+            write_count_band=write_count_band,
+            exact_median=exact_median,
+            writer_threads=writer_threads,
+            output_format_options=output_format_options,
+        )
 
-    for scene_folder in os.listdir(input_folder):
-        full_path = os.path.join(input_folder, scene_folder)
-        if os.path.isdir(full_path):
-            print(f"Processing scene: {scene_folder}")
-            band_paths = load_bands(full_path, required_bands, meta_bands)
-            scene_library[full_path] = band_paths
 
-    processed_scene_library = {}
-    process_bulk = bool(process_dict[processing_method]["bulk_process"])
-    reprojection_config = peek(scene_library) if process_bulk else None
-    for scene in scene_library:
-        processed_scene_library[scene] = process_dict[processing_method][
-            "folder_process"
-        ](
-            scene_library[scene],
-            reprojection_config=reprojection_config,
+def validate_processing_options(
+    processing_methods,
+    windowed=False,
+    incremental=False,
+    scene_store=None,
+    output_format="gtiff",
+    executor=None,
+):
+    # Rejects methods and options that can't run together, before any scene is read
+    for method in processing_methods:
+        if method not in process_dict:
+            raise Exception(f"Unsupported processing method: {method}")
+    several_methods = len(processing_methods) > 1
+    process_bulk = any(
+        process_dict[method]["bulk_process"] for method in processing_methods
+    )
+    # Composites keep every scene of a group, they have no running accumulator
+    composite_methods = [
+        method
+        for method in processing_methods
+        if process_dict[method]["bulk_process"]
+        and process_dict[method]["bulk_process"] not in bulk_group_keys
+    ]
+    cube_output = output_format == "zarr"
+
+    if several_methods and (windowed or incremental or scene_store):
+        raise Exception(
+            "--windowed, --incremental and --scene-store support a single processing method"
         )
+    if cube_output and (process_bulk or several_methods or incremental or windowed):
+        raise Exception(
+            "zarr output takes a single per-scene method without --incremental or --windowed"
+        )
+    if composite_methods and (several_methods or incremental):
+        raise Exception(
+            f"{', '.join(composite_methods)} can't be combined with other methods or --incremental"
+        )
+    if executor and (
+        composite_methods or several_methods or windowed or incremental or cube_output
+    ):
+        raise Exception(
+            "--executor takes a single per-scene or averaged method without "
+            "--windowed, --incremental or zarr output"
+        )
+
+
+def process_landsat_data(
+    input_folder,
+    processing_method,
+    output_path,
+    output_suffix="",
+    write_count_band=False,
+    workers=1,
+    windowed=False,
+    exact_median=False,
+    reprojection_cache=False,
+    reprojection_cache_folder=None,
+    scene_store=None,
+    incremental=False,
+    aoi=None,
+    aoi_mask=False,
+    reader_threads=0,
+    writer_threads=0,
+    output_format="gtiff",
+    compression="deflate",
+    block_size=COG_BLOCK_SIZE,
+    compression_threads="ALL_CPUS",
+    catalog=False,
+    refresh_catalog=True,
+    years=None,
+    start_date=None,
+    end_date=None,
+    max_cloud_cover=None,
+    qa_mask=None,
+    cube_chunks=CUBE_CHUNKS,
+    executor=None,
+    queue_path=None,
+    target_grid="union",
+    target_crs=None,
+):
+    # Several methods can be requested at once, as a list or comma separated
+    processing_methods = (
+        processing_method.split(",")
+        if isinstance(processing_method, str)
+        else list(processing_method)
+    )
+    validate_processing_options(
+        processing_methods,
+        windowed=windowed,
+        incremental=incremental,
+        scene_store=scene_store,
+        output_format=output_format,
+        executor=executor,
+    )
+    output_format_options = output_options(
+        output_format, compression, block_size, compression_threads, cube_chunks
+    )
+    qa_mask = resolve_qa_mask(qa_mask)
+    if qa_mask:
+        print(f"Masking QA_PIXEL flags: {', '.join(qa_mask)}")
+    scene_library = build_scene_library(
+        input_folder,
+        catalog=catalog,
+        refresh_catalog=refresh_catalog,
+        years=years,
+        start_date=start_date,
+        end_date=end_date,
+        max_cloud_cover=max_cloud_cover,
+    )
+    if aoi:
+        scene_library = scenes_overlapping_aoi(scene_library, load_aoi(aoi))
 
-    output_library = (
-        process_dict[processing_method]["bulk_process"](processed_scene_library)
-        if process_dict[processing_method]["bulk_process"]
-        else processed_scene_library
+    process_bulk = any(
+        process_dict[method]["bulk_process"] for method in processing_methods
+    )
+    # A cube stacks every scene on the shared grid
+    cube_output = output_format == "zarr"
+    reprojection_config = (
+        target_reprojection_config(
+            scene_library,
+            aoi=aoi,
+            aoi_mask=aoi_mask,
+            reprojection_cache=reprojection_cache,
+            reprojection_cache_folder=reprojection_cache_folder,
+            target_grid=target_grid,
+            target_crs=target_crs,
+            # Stored scenes and incremental outputs are only reused on the same grid
+            grid_folder=scene_store or (output_path if incremental else None),
+        )
+        if process_bulk or aoi or cube_output
+        else None
     )
 
-    write_outputs(output_path, output_suffix, output_library, processing_method)
+    if len(processing_methods) > 1:
+        process_methods_in_one_pass(
+            scene_library,
+            processing_methods,
+            output_path,
+            output_suffix,
+            reprojection_config,
+            workers=workers,
+            reader_threads=reader_threads,
+            writer_threads=writer_threads,
+            write_count_band=write_count_band,
+            exact_median=exact_median,
+            output_format_options=output_format_options,
+            qa_mask=qa_mask,
+        )
+        return
+
+    processing_method = processing_methods[0]
+    folder_process = process_dict[processing_method]["folder_process"]
+    folder_plan = process_dict[processing_method]["folder_plan"]
+    product = process_dict[processing_method]["product"]
+    if qa_mask:
+        folder_process = partial(folder_process, qa_mask=qa_mask)
+        folder_plan = partial(folder_plan, qa_mask=qa_mask)
+        product = f"{product}_qa{qa_bitmask(qa_mask)}"
+    if scene_store:
+        store_folder = scene_store_folder(scene_store, product, reprojection_config)
+        print(f"Using scene store: {store_folder}")
+        folder_process = partial(stored_folder_process, folder_process, store_folder)
+    folder_process = metrics_folder_process(folder_process)
+    if executor:
+        process_with_task_graph(
+            scene_library,
+            processing_method,
+            folder_process,
+            reprojection_config,
+            output_path,
+            output_suffix,
+            executor=executor,
+            queue_path=queue_path,
+            workers=workers,
+            write_count_band=write_count_band,
+            exact_median=exact_median,
+            output_format_options=output_format_options,
+        )
+        return
+    if incremental:
+        manifest_entry = load_run_manifest(
+            output_path,
+            processing_method,
+            output_suffix,
+            grid_key(reprojection_config),
+            qa_mask,
+        )
+        fingerprints = {
+            scene: scene_fingerprint(scene_library[scene]) for scene in scene_library
+        }
+        if process_bulk:
+            process_incremental_bulk(
+                scene_library,
+                fingerprints,
+                manifest_entry,
+                processing_method,
+                folder_process,
+                reprojection_config,
+                output_path,
+                output_suffix,
+                workers=workers,
+                write_count_band=write_count_band,
+                exact_median=exact_median,
+                reader_threads=reader_threads,
+                writer_threads=writer_threads,
+                output_format_options=output_format_options,
+            )
+            save_run_manifest(
+                output_path, processing_method, output_suffix, manifest_entry
+            )
+            return
+        scene_library = {
+            scene: scene_library[scene]
+            for scene in scene_library
+            if not scene_is_current(manifest_entry, scene, fingerprints[scene])
+        }
+        print(f"{len(scene_library)} of {len(fingerprints)} scenes need processing")
+
+    if windowed and not reprojection_config:
+        print("Writing scenes block by block...")
+        task_arguments = [
+            (
+                folder_plan,
+                process_dict[processing_method]["stat_accumulator"],
+                scene_library[scene],
+                output_file_path(output_path, scene, output_suffix),
+                exact_median,
+                output_format_options,
+            )
+            for scene in scene_library
+        ]
+        if workers > 1:
+            for _ in map_scenes_in_pool(write_windowed_output, task_arguments, workers):
+                pass
+        else:
+            for arguments in task_arguments:
+                write_windowed_output(*arguments)
+    else:
+        processed_scenes = processed_scene_stream(
+            scene_library, folder_process, reprojection_config, workers, reader_threads
+        )
+        bulk_process = process_dict[processing_method]["bulk_process"]
+        # Per-scene outputs are written as soon as each scene is processed
+        output_library = (
+            bulk_process(processed_scene for _, processed_scene in processed_scenes)
+            if bulk_process
+            else processed_scenes
+        )
+
+        write_outputs(
+            output_path,
+            output_suffix,
+            output_library,
+            processing_method,
+            write_count_band=write_count_band,
+            exact_median=exact_median,
+            writer_threads=writer_threads,
+            output_format_options=output_format_options,
+        )
+
+    if incremental:
+        for scene in scene_library:
+            manifest_entry["scenes"][scene] = {
+                "fingerprint": fingerprints[scene],
+                "outputs": [output_file_path(output_path, scene, output_suffix)],
+            }
+        save_run_manifest(output_path, processing_method, output_suffix, manifest_entry)
 
 
 def main():
@@ -160,7 +1008,8 @@ def main():
         "input_folder", help="Folder containing folders of Landsat scenes"
     )
     parser.add_argument(
-        "processing_method", help="Processing methodology (e.g., surface temp, NDVI)"
+        "processing_method",
+        help="Processing methodology (e.g., surface temp, NDVI), several can be given comma separated",
     )
     parser.add_argument("output_path", help="Path where the output files will be saved")
     parser.add_argument(
@@ -171,6 +1020,199 @@ def main():
         default="",
     )
 
+    parser.add_argument(
+        "--count-band",
+        dest="write_count_band",
+        action="store_true",
+        help="Write the per-pixel valid scene count as a second band of averaged outputs",
+    )
+
+    parser.add_argument(
+        "--windowed",
+        action="store_true",
+        help="Compute per-scene methods block by block straight into the output files",
+    )
+    parser.add_argument(
+        "--exact-median",
+        action="store_true",
+        help="Compute the exact median for band statistics instead of the histogram estimate",
+    )
+    parser.add_argument(
+        "--reprojection-cache",
+        action="store_true",
+        help="Reuse a precomputed bilinear mapping for scenes sharing a source grid",
+    )
+    parser.add_argument(
+        "--reprojection-cache-folder",
+        help="Folder where reprojection plans are persisted between runs (implies --reprojection-cache)",
+        default=None,
+    )
+    parser.add_argument(
+        "--scene-store",
+        help="Scratch folder where processed scene bands are kept as memory mapped files and reused by later runs",
+        default=None,
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Skip scenes (or yearly groups) whose outputs are current according to the run manifest",
+    )
+    parser.add_argument(
+        "--aoi",
+        help="GeoJSON area of interest, scenes are only read and written within its bounds",
+        default=None,
+    )
+    parser.add_argument(
+        "--target-grid",
+        choices=GRID_MODES,
+        default="union",
+        help="Grid of averaged outputs: the union or intersection of all scene footprints, or the grid of the first scene",
+    )
+    parser.add_argument(
+        "--target-crs",
+        default=None,
+        help="CRS of the planned grid (e.g. EPSG:32617), the most common scene CRS by default",
+    )
+    parser.add_argument(
+        "--aoi-mask",
+        action="store_true",
+        help="Also set pixels outside the AOI polygons to nodata",
+    )
+    parser.add_argument(
+        "--reader-threads",
+        type=int,
+        default=0,
+        help="Threads that read and process upcoming scenes while earlier ones are aggregated or written",
+    )
+    parser.add_argument(
+        "--writer-threads",
+        type=int,
+        default=0,
+        help="Threads that compute statistics and write output files in the background",
+    )
+    parser.add_argument(
+        "--output-format",
+        choices=OUTPUT_FORMATS,
+        default="gtiff",
+        help="Write plain GeoTIFFs or tiled Cloud Optimized GeoTIFFs with overviews",
+    )
+    parser.add_argument(
+        "--compression",
+        choices=COG_COMPRESSIONS,
+        default="deflate",
+        help="Compression codec for COG output",
+    )
+    parser.add_argument(
+        "--block-size",
+        type=int,
+        default=COG_BLOCK_SIZE,
+        help="Internal tile size in pixels for COG output",
+    )
+    parser.add_argument(
+        "--compression-threads",
+        default="ALL_CPUS",
+        help="GDAL NUM_THREADS used to compress COG output",
+    )
+    parser.add_argument(
+        "--cube-chunks",
+        type=int,
+        nargs=3,
+        default=list(CUBE_CHUNKS),
+        metavar=("TIME", "ROWS", "COLUMNS"),
+        help="Chunk shape of zarr cube output, deep in time for pixel time series, wide in space for maps",
+    )
+    parser.add_argument(
+        "--executor",
+        choices=TASK_EXECUTORS,
+        default=None,
+        help="Run the method as a task graph of scene and per-group reduction tasks on a local process pool or a work queue",
+    )
+    parser.add_argument(
+        "--queue",
+        default=None,
+        help=f"SQLite work queue for --executor queue, {WORK_QUEUE_NAME} in the output folder by default",
+    )
+    parser.add_argument(
+        "--catalog",
+        action="store_true",
+        help="Select scenes from a SQLite scene catalog kept in the input folder",
+    )
+    parser.add_argument(
+        "--no-catalog-refresh",
+        dest="refresh_catalog",
+        action="store_false",
+        help="Use the scene catalog as is without checking the scene folders for changes",
+    )
+    parser.add_argument(
+        "--years",
+        type=int,
+        nargs="+",
+        default=None,
+        help="Only process scenes acquired in these years (uses the scene catalog)",
+    )
+    parser.add_argument(
+        "--start-date",
+        default=None,
+        help="Only process scenes acquired on or after this YYYY-MM-DD date (uses the scene catalog)",
+    )
+    parser.add_argument(
+        "--end-date",
+        default=None,
+        help="Only process scenes acquired on or before this YYYY-MM-DD date (uses the scene catalog)",
+    )
+    parser.add_argument(
+        "--max-cloud-cover",
+        type=float,
+        default=None,
+        help="Only process scenes with at most this CLOUD_COVER percentage (uses the scene catalog)",
+    )
+    parser.add_argument(
+        "--qa-mask",
+        nargs="*",
+        choices=list(qa_flag_bits),
+        default=None,
+        help="Set pixels with these QA_PIXEL flags to nodata before statistics and averaging (default: fill dilated_cloud cloud cloud_shadow snow)",
+    )
+    parser.add_argument(
+        "--read-cache-mb",
+        type=float,
+        default=READ_CACHE_MB,
+        help="Keep up to this many MB of decoded input blocks in memory for reuse across methods, in each process, off (0) by default",
+    )
+    parser.add_argument(
+        "--gdal-cache-mb",
+        type=float,
+        default=None,
+        help="Size of GDAL's own block cache in MB (default: GDAL's, 5%% of the memory)",
+    )
+    parser.add_argument(
+        "--metrics-log",
+        default=None,
+        help="Append per-stage, per-scene timings, bytes and peak memory to this JSON lines file",
+    )
+    parser.add_argument(
+        "--metrics-prometheus",
+        default=None,
+        help="Write per-stage totals to this Prometheus textfile at the end of the run",
+    )
+    parser.add_argument(
+        "--metrics-allocations",
+        action="store_true",
+        help="Also trace Python and numpy allocations per stage (slows processing down)",
+    )
+    parser.add_argument(
+        "--profile-scene",
+        default=None,
+        help="Run cProfile over the processing of the scene whose folder name contains this text",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of worker processes used to process scenes in parallel",
+    )
+
     args = parser.parse_args()
 
     # Verify the input folder exists
@@ -182,9 +1224,49 @@ def main():
     if not os.path.exists(args.output_path):
         os.makedirs(args.output_path)
 
+    configure_raster_cache(args.read_cache_mb, args.gdal_cache_mb)
+    configure_metrics(
+        args.metrics_log,
+        args.metrics_prometheus,
+        trace_allocations=args.metrics_allocations,
+        profile_scene=args.profile_scene,
+        profile_folder=args.output_path,
+    )
     process_landsat_data(
-        args.input_folder, args.processing_method, args.output_path, args.output_suffix
+        args.input_folder,
+        args.processing_method,
+        args.output_path,
+        args.output_suffix,
+        write_count_band=args.write_count_band,
+        workers=args.workers,
+        windowed=args.windowed,
+        exact_median=args.exact_median,
+        reprojection_cache=args.reprojection_cache,
+        reprojection_cache_folder=args.reprojection_cache_folder,
+        scene_store=args.scene_store,
+        incremental=args.incremental,
+        aoi=args.aoi,
+        aoi_mask=args.aoi_mask,
+        reader_threads=args.reader_threads,
+        writer_threads=args.writer_threads,
+        output_format=args.output_format,
+        compression=args.compression,
+        block_size=args.block_size,
+        compression_threads=args.compression_threads,
+        catalog=args.catalog,
+        refresh_catalog=args.refresh_catalog,
+        years=args.years,
+        start_date=args.start_date,
+        end_date=args.end_date,
+        max_cloud_cover=args.max_cloud_cover,
+        qa_mask=args.qa_mask,
+        cube_chunks=args.cube_chunks,
+        executor=args.executor,
+        queue_path=args.queue,
+        target_grid=args.target_grid,
+        target_crs=args.target_crs,
     )
+    finish_metrics()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,44 @@
+import numpy as np
+
+from calc.band_math import (
+    KERNEL_DTYPE,
+    normalized_difference,
+    safe_divide,
+    linear_scale,
+)
+
+
+def float64_normalized_difference(a, b):
+    a, b = a.astype(np.float64), b.astype(np.float64)
+    return (a - b) / (a + b)
+
+
+def test_uint16_normalized_difference_does_not_wrap():
+    # a < b would wrap in uint16 subtraction, a + b > 65535 in uint16 addition
+    a = np.array([[100, 40000, 65535], [1, 30000, 20]], dtype=np.uint16)
+    b = np.array([[200, 60000, 65534], [65535, 50000, 10]], dtype=np.uint16)
+    out = np.empty(a.shape, dtype=KERNEL_DTYPE)
+    normalized_difference(a, b, out, {})
+    np.testing.assert_allclose(out, float64_normalized_difference(a, b), rtol=1e-6)
+    assert (out[0, :2] < 0).all()
+
+
+def test_zero_denominator_is_nodata():
+    a = np.array([0, 5, 0], dtype=np.uint16)
+    b = np.array([0, 5, 3], dtype=np.uint16)
+    out = np.empty(a.shape, dtype=KERNEL_DTYPE)
+    normalized_difference(a, b, out, {}, nodata=-9999)
+    assert out.tolist() == [-9999, 0, -1]
+
+    out = np.array([1, 2], dtype=KERNEL_DTYPE)
+    safe_divide(out, np.array([0, 4], dtype=KERNEL_DTYPE), {})
+    assert np.isnan(out[0]) and out[1] == 0.5
+
+
+def test_linear_scale_keeps_nodata():
+    band = np.array([0, 10000, 65535], dtype=np.uint16)
+    out = np.empty(band.shape, dtype=KERNEL_DTYPE)
+    linear_scale(band, 0.00341802, 149.0, out, {}, nodata=0)
+    expected = band.astype(np.float64) * 0.00341802 + 149.0
+    assert out[0] == 0
+    np.testing.assert_allclose(out[1:], expected[1:], rtol=1e-6)
@@ -0,0 +1,81 @@
+import numpy as np
+
+from calc.band_stat_calculators import (
+    STAT_HISTOGRAM_BINS,
+    new_stat_accumulator,
+    update_stat_accumulator,
+    merge_stat_accumulators,
+    finalize_stats,
+    accumulate_band,
+)
+
+LOW, HIGH, NODATA = 250.0, 350.0, 0
+
+
+def temperature_band(seed=0, shape=(700, 300)):
+    rng = np.random.default_rng(seed)
+    band = rng.normal(300, 8, shape).astype(np.float32)
+    band[rng.random(shape) < 0.1] = NODATA
+    # Out of range pixels are not valid either
+    band[:5] = LOW
+    return band
+
+
+def valid_values(band):
+    return band[(band > LOW) & (band < HIGH) & (band != NODATA)].astype(np.float64)
+
+
+def test_stats_match_numpy():
+    band = temperature_band()
+    values = valid_values(band)
+    stats = finalize_stats(
+        accumulate_band(new_stat_accumulator(LOW, HIGH, NODATA), band)
+    )
+    assert np.isclose(stats["mean"], values.mean())
+    assert np.isclose(stats["std"], values.std())
+    assert stats["min"] == values.min()
+    assert stats["max"] == values.max()
+
+
+def test_histogram_median_within_a_bin_of_numpy():
+    band = temperature_band()
+    stats = finalize_stats(
+        accumulate_band(new_stat_accumulator(LOW, HIGH, NODATA), band)
+    )
+    bin_width = (HIGH - LOW) / STAT_HISTOGRAM_BINS
+    assert abs(stats["median"] - np.median(valid_values(band))) <= bin_width
+
+
+def test_exact_median_matches_numpy():
+    band = temperature_band()
+    accumulator = new_stat_accumulator(LOW, HIGH, NODATA, exact_median=True)
+    stats = finalize_stats(accumulate_band(accumulator, band))
+    assert stats["median"] == np.median(valid_values(band))
+
+
+def test_merged_partials_match_single_pass():
+    bands = [temperature_band(seed) for seed in range(3)]
+    single = new_stat_accumulator(LOW, HIGH, NODATA)
+    for band in bands:
+        update_stat_accumulator(single, band)
+
+    # One partial per band, as windows or worker processes would produce, and an
+    # empty one
+    merged = new_stat_accumulator(LOW, HIGH, NODATA)
+    for band in bands + [np.full((4, 4), NODATA, dtype=np.float32)]:
+        partial = accumulate_band(new_stat_accumulator(LOW, HIGH, NODATA), band)
+        merge_stat_accumulators(merged, partial)
+
+    assert merged["count"] == single["count"]
+    assert np.array_equal(merged["histogram"], single["histogram"])
+    merged_stats, single_stats = finalize_stats(merged), finalize_stats(single)
+    for key in ["mean", "median", "std", "min", "max"]:
+        assert np.isclose(merged_stats[key], single_stats[key])
+
+
+def test_no_valid_pixels():
+    band = np.full((3, 3), NODATA, dtype=np.float32)
+    stats = finalize_stats(
+        accumulate_band(new_stat_accumulator(LOW, HIGH, NODATA), band)
+    )
+    assert all(np.isnan(value) for value in stats.values())
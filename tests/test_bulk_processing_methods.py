@@ -0,0 +1,43 @@
+import numpy as np
+
+from calc.bulk_processing_methods import (
+    accumulate_scene,
+    average_bands,
+    finalize_accumulator,
+)
+
+NODATA = 0
+
+
+def scene(values, nodata=NODATA):
+    return {
+        "band": np.array(values, dtype=np.float32),
+        "meta": {"nodata": nodata},
+        "mtl": {"LANDSAT_METADATA_FILE": {}},
+    }
+
+
+def test_nodata_and_nan_are_left_out_of_sum_and_count():
+    scenes = [
+        scene([[1, 2, NODATA, np.nan]]),
+        scene([[3, NODATA, NODATA, 5]]),
+        scene([[5, np.nan, NODATA, np.inf]]),
+    ]
+    accumulators = {}
+    for current_scene in scenes:
+        accumulate_scene(accumulators, "average", current_scene)
+    accumulator = accumulators["average"]
+    assert accumulator["sum"].tolist() == [[9, 2, 0, 5]]
+    assert accumulator["count"].tolist() == [[3, 1, 0, 1]]
+    assert accumulator["scene_count"] == 3
+
+    average = finalize_accumulator(accumulator)
+    assert average["band"].tolist() == [[3, 2, NODATA, 5]]
+    assert average["count"].tolist() == [[3, 1, 0, 1]]
+
+
+def test_pixels_without_valid_scenes_are_nan_without_nodata():
+    average = average_bands([scene([[np.nan, 4]], None), scene([[np.nan, 2]], None)])
+    assert np.isnan(average["band"][0, 0])
+    assert average["band"][0, 1] == 3
+    assert average["count"].tolist() == [[0, 2]]
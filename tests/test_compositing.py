@@ -0,0 +1,93 @@
+import numpy as np
+import pytest
+
+from calc import compositing
+from calc.compositing import composite_block_shape, composite_scenes, reduce_group
+
+NODATA = -9999
+
+
+def scenes(count=7, shape=(9, 11), seed=0):
+    rng = np.random.default_rng(seed)
+    library = []
+    for index in range(count):
+        band = rng.normal(0.5, 0.2, shape).astype(np.float32)
+        band[rng.random(shape) < 0.3] = NODATA
+        band[0, index % shape[1]] = np.nan
+        library.append(
+            {
+                "band": band,
+                "meta": {"nodata": NODATA},
+                "mtl": {
+                    "LANDSAT_METADATA_FILE": {
+                        "IMAGE_ATTRIBUTES": {
+                            "DATE_ACQUIRED": f"{2020 + index % 2}-06-{index + 1:02d}"
+                        }
+                    }
+                },
+            }
+        )
+    # A pixel no scene has a valid value for
+    for scene in library:
+        scene["band"][4, 4] = NODATA
+    return library
+
+
+def reference_stack(library):
+    stack = np.stack([scene["band"] for scene in library]).astype(np.float64)
+    stack[stack == NODATA] = np.nan
+    return stack
+
+
+@pytest.mark.parametrize(
+    "reducer, reference",
+    [
+        ("median", np.nanmedian),
+        ("p90", lambda stack, axis: np.nanpercentile(stack, 90, axis=axis)),
+        ("min", np.nanmin),
+        ("max", np.nanmax),
+    ],
+)
+def test_reducers_match_numpy(reducer, reference):
+    library = scenes()
+    stack = reference_stack(library)
+    valid = ~np.isnan(stack).all(axis=0)
+    result = reduce_group(library, reducer)
+    np.testing.assert_allclose(
+        result["band"][valid], reference(stack[:, valid], axis=0), rtol=1e-6
+    )
+    assert result["band"][4, 4] == NODATA
+
+
+def test_count_is_valid_scenes_per_pixel():
+    library = scenes()
+    result = reduce_group(library, "median")
+    assert np.array_equal(result["count"], (~np.isnan(reference_stack(library))).sum(0))
+    assert result["count"][4, 4] == 0
+
+
+def test_blocks_smaller_than_a_row_give_the_same_composite(monkeypatch):
+    library = scenes()
+    expected = reduce_group(library, "median")
+    # Room for 3 pixels of every scene, blocks are parts of a row
+    monkeypatch.setattr(compositing, "COMPOSITE_BLOCK_BYTES", 3 * 7 * 4)
+    assert composite_block_shape(7, 9, 11, 4) == (1, 3)
+    result = reduce_group(library, "median")
+    assert np.array_equal(result["band"], expected["band"])
+    assert np.array_equal(result["count"], expected["count"])
+
+
+def test_block_shape_stays_within_budget(monkeypatch):
+    monkeypatch.setattr(compositing, "COMPOSITE_BLOCK_BYTES", 2**20)
+    for scene_count in [1, 10, 1000, 100000]:
+        rows, cols = composite_block_shape(scene_count, 8000, 8000, 4)
+        assert rows * cols * scene_count * 4 <= max(2**20, scene_count * 4)
+        assert 1 <= rows <= 8000 and 1 <= cols <= 8000
+
+
+def test_yearly_groups():
+    library = scenes()
+    composites = composite_scenes(library, "median", "yearly")
+    assert sorted(composites) == ["2020_median", "2021_median"]
+    expected = reduce_group(library[0::2], "median")
+    assert np.array_equal(composites["2020_median"]["band"], expected["band"])
@@ -0,0 +1,55 @@
+from functools import partial
+
+from affine import Affine
+from rasterio.crs import CRS
+
+from file_methods.grid_planner import reference_grid, pinned_target_grid
+
+
+def scene_grid(epsg):
+    return {
+        "crs": CRS.from_epsg(epsg),
+        "transform": Affine(30, 0, 600000, 0, -30, 4000000),
+        "width": 100,
+        "height": 100,
+        "bounds": (600000, 3997000, 603000, 4000000),
+    }
+
+
+def test_crs_tie_does_not_depend_on_scene_order():
+    grids = {"b": scene_grid(32618), "a": scene_grid(32617)}
+    reversed_grids = dict(reversed(grids.items()))
+    assert reference_grid(grids)[0] == reference_grid(reversed_grids)[0]
+
+
+def test_most_common_crs_wins():
+    grids = {"a": scene_grid(32617), "b": scene_grid(32618), "c": scene_grid(32618)}
+    crs, reference = reference_grid(grids)
+    assert crs == CRS.from_epsg(32618)
+    assert reference is grids["b"]
+
+
+def planned_grid(epsg, width):
+    return {
+        "crs": CRS.from_epsg(epsg),
+        "transform": Affine(30, 0, 600000, 0, -30, 4000000),
+        "width": width,
+        "height": 50,
+        "shape": (50, width),
+        "tile_size": 512,
+    }
+
+
+def test_pinned_grid_is_reused(tmp_path):
+    request = {"mode": "union", "crs": None}
+    first = pinned_target_grid(tmp_path, request, partial(planned_grid, 32617, 80))
+    # A later run whose scenes would plan another grid
+    again = pinned_target_grid(tmp_path, request, partial(planned_grid, 32618, 90))
+    assert again == first
+
+    other_request = {"mode": "intersection", "crs": None}
+    replanned = pinned_target_grid(
+        tmp_path, other_request, partial(planned_grid, 32618, 90)
+    )
+    assert replanned["crs"] == CRS.from_epsg(32618)
+    assert replanned["width"] == 90
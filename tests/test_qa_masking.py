@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+
+from calc.qa_masking import (
+    QA_BAND,
+    DEFAULT_QA_MASK,
+    qa_bitmask,
+    qa_masked_block,
+    resolve_qa_mask,
+)
+
+# Collection 2 QA_PIXEL values of pixels with one condition each (cirrus is a clear
+# land value with the cirrus bit set)
+QA_VALUES = {
+    "fill": 1,
+    "clear": 21824,
+    "water": 21952,
+    "dilated_cloud": 21890,
+    "cirrus": 21828,
+    "cloud": 22280,
+    "cloud_shadow": 23888,
+    "snow": 30048,
+}
+NODATA = 0
+
+
+def constant_block(blocks, out, workspace):
+    out[...] = 5
+    return out
+
+
+def masked(qa_mask):
+    names = list(QA_VALUES)
+    qa_block = np.array([[QA_VALUES[name] for name in names]], dtype=np.uint16)
+    out = np.empty(qa_block.shape, dtype=np.float32)
+    result = qa_masked_block(
+        {QA_BAND: qa_block}, out, {}, constant_block, qa_bitmask(qa_mask), NODATA
+    )
+    return {name for name, value in zip(names, result[0]) if value == NODATA}
+
+
+def test_default_mask_bits():
+    assert qa_bitmask(DEFAULT_QA_MASK) == 0b111011
+
+
+def test_default_mask_keeps_clear_water_and_cirrus():
+    assert masked(resolve_qa_mask([])) == {
+        "fill",
+        "dilated_cloud",
+        "cloud",
+        "cloud_shadow",
+        "snow",
+    }
+
+
+def test_chosen_flags_only():
+    assert masked(resolve_qa_mask("cloud,cirrus")) == {"cirrus", "cloud"}
+    assert masked(resolve_qa_mask(["snow"])) == {"snow"}
+
+
+def test_resolve_qa_mask():
+    assert resolve_qa_mask(None) is None
+    assert resolve_qa_mask(["cloud", "cloud"]) == ["cloud"]
+    with pytest.raises(Exception, match="Unknown QA_PIXEL flag"):
+        resolve_qa_mask(["water"])
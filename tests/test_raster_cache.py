@@ -0,0 +1,40 @@
+import threading
+
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+
+from file_methods.raster_cache import open_raster
+
+
+def write_raster(path):
+    with rasterio.open(
+        path,
+        "w",
+        driver="GTiff",
+        width=4,
+        height=4,
+        count=1,
+        dtype="uint16",
+        transform=from_origin(600000, 4000000, 30, 30),
+    ) as dst:
+        dst.write(np.ones((4, 4), dtype=np.uint16), 1)
+
+
+def test_thread_datasets_close_when_thread_ends(tmp_path):
+    path = str(tmp_path / "band.tif")
+    write_raster(path)
+    opened = []
+
+    def reader():
+        with open_raster(path) as src:
+            pass
+        # Still open in the thread's pool after the block
+        opened.append((src, src.closed))
+
+    thread = threading.Thread(target=reader)
+    thread.start()
+    thread.join()
+    src, closed_in_thread = opened[0]
+    assert not closed_in_thread
+    assert src.closed
@@ -0,0 +1,103 @@
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+
+from file_methods.raster_comparison import compare_raster_files
+
+TRANSFORM = from_origin(600000, 4000000, 30, 30)
+
+
+def write_raster(path, band):
+    with rasterio.open(
+        path,
+        "w",
+        driver="GTiff",
+        width=band.shape[1],
+        height=band.shape[0],
+        count=1,
+        dtype=band.dtype,
+        transform=TRANSFORM,
+        crs="EPSG:32617",
+        tiled=True,
+        blockxsize=16,
+        blockysize=16,
+    ) as dst:
+        dst.write(band, 1)
+    return str(path)
+
+
+def band(seed=0):
+    rng = np.random.default_rng(seed)
+    values = rng.normal(300, 10, (64, 48)).astype(np.float32)
+    values[:4, :4] = np.nan
+    return values
+
+
+def compare(tmp_path, original, output, **kwargs):
+    return compare_raster_files(
+        write_raster(tmp_path / "original.tif", original),
+        write_raster(tmp_path / "output.tif", output),
+        **kwargs,
+    )
+
+
+@pytest.mark.parametrize("threads", [1, 2])
+def test_equal_rasters(tmp_path, threads):
+    result = compare(tmp_path, band(), band(), threads=threads)
+    assert result["equal"]
+    assert result["metadata"] == []
+    assert result["differing_pixels"] == 0
+    assert result["max_abs_diff"] == 0
+    assert result["box"] is None
+    assert result["compared_pixels"] == 64 * 48
+
+
+@pytest.mark.parametrize("threads", [1, 2])
+def test_differences_beyond_tolerance(tmp_path, threads):
+    output = band()
+    # Two pixels in different blocks beyond the tolerance, one within it
+    output[5, 40] += 1
+    output[50, 7] -= 2
+    output[30, 30] += 0.001
+    result = compare(tmp_path, band(), output, tolerance=0.01, threads=threads)
+    assert not result["equal"]
+    assert result["differing_pixels"] == 2
+    assert result["max_abs_diff"] == pytest.approx(2, abs=1e-4)
+    assert result["box"] == [5, 7, 50, 40]
+    left, bottom, right, top = result["box_bounds"]
+    assert (left, top) == (600000 + 7 * 30, 4000000 - 5 * 30)
+    assert (right, bottom) == (600000 + 41 * 30, 4000000 - 51 * 30)
+
+
+def test_differences_within_tolerance(tmp_path):
+    output = band() + np.float32(0.001)
+    result = compare(tmp_path, band(), output, tolerance=0.01)
+    assert result["equal"]
+    assert 0 < result["max_abs_diff"] <= 0.01
+
+
+def test_nan_in_both_is_equal(tmp_path):
+    original, output = band(), band()
+    original[10:12, 20:22] = np.nan
+    output[10:12, 20:22] = np.nan
+    assert compare(tmp_path, original, output)["equal"]
+
+
+def test_nan_in_one_differs(tmp_path):
+    output = band()
+    output[20, 10] = np.nan
+    result = compare(tmp_path, band(), output, tolerance=1000)
+    assert not result["equal"]
+    assert result["differing_pixels"] == 1
+    # A NaN has no magnitude, it is counted but left out of the differences
+    assert result["max_abs_diff"] == 0
+    assert result["box"] == [20, 10, 20, 10]
+
+
+def test_equal_only_stops_at_first_difference(tmp_path):
+    output = band() + 1
+    result = compare(tmp_path, band(), output, equal_only=True)
+    assert not result["equal"]
+    assert result["stopped_early"]
+    assert result["compared_pixels"] < 64 * 48
@@ -0,0 +1,90 @@
+import numpy as np
+from affine import Affine
+from rasterio.crs import CRS
+from rasterio.warp import calculate_default_transform
+
+from file_methods import reprojection
+from file_methods.reprojection import reproject_band
+
+# GDAL's warper uses an approximate transformer, sample positions may be off by
+# up to 0.125 source pixels. On a ramp rising 1 per pixel along rows and columns
+# that moves a value by less than 0.25.
+TRANSFORMER_ERROR = 0.125
+NODATA = 0
+
+
+def ramp_scene(height=300, width=400):
+    rows, cols = np.mgrid[0:height, 0:width].astype(np.float32)
+    band = rows + cols + 1
+    # A hole of fill pixels, its edges are resampled like the scene edges
+    band[100:140, 200:260] = NODATA
+    meta = {
+        "crs": CRS.from_epsg(32617),
+        "transform": Affine(30, 0, 600000, 0, -30, 4000000),
+        "nodata": NODATA,
+    }
+    return band, meta
+
+
+def target_config(meta, shape, crs):
+    height, width = shape
+    left, top = meta["transform"].c, meta["transform"].f
+    transform, dst_width, dst_height = calculate_default_transform(
+        meta["crs"],
+        crs,
+        width,
+        height,
+        left,
+        top - 30 * height,
+        left + 30 * width,
+        top,
+        resolution=30,
+    )
+    # Pad the grid so the scene edges fall inside it
+    return {
+        "crs": crs,
+        "transform": transform * Affine.translation(-5, -5),
+        "width": dst_width + 10,
+        "height": dst_height + 10,
+    }
+
+
+def warp_both_ways(crs):
+    band, meta = ramp_scene()
+    config = target_config(meta, band.shape, crs)
+    warped, _ = reproject_band(band, meta, config)
+    cached, _ = reproject_band(band, meta, dict(config, use_plan_cache=True))
+    return warped, cached
+
+
+def test_cached_matches_warp_on_same_crs():
+    warped, cached = warp_both_ways(CRS.from_epsg(32617))
+    assert np.array_equal(warped != NODATA, cached != NODATA)
+    np.testing.assert_allclose(cached, warped, atol=1e-3)
+
+
+def test_cached_matches_warp_across_crs():
+    warped, cached = warp_both_ways(CRS.from_epsg(32618))
+    in_warped, in_cached = warped != NODATA, cached != NODATA
+    both = in_warped & in_cached
+    assert both.sum() > 0.9 * in_warped.sum()
+    # Only pixels whose center is within the transformer error of a scene or
+    # hole edge may be filled by one and not the other
+    assert (in_warped ^ in_cached).sum() <= 0.001 * both.sum()
+    assert np.abs(cached[both] - warped[both]).max() <= 2 * TRANSFORMER_ERROR
+
+
+def test_plan_cache_stays_within_budget(monkeypatch):
+    band, meta = ramp_scene(60, 80)
+    config = target_config(meta, band.shape, CRS.from_epsg(32618))
+    plan_bytes = 2 * 4 * config["width"] * config["height"]
+    # Room for two plans
+    monkeypatch.setattr(reprojection, "PLAN_CACHE_MB", 2.5 * plan_bytes / 2**20)
+    reprojection.clear_plan_cache()
+    for shift in range(4):
+        # Each scene is on another source grid
+        shifted = dict(meta, transform=meta["transform"] * Affine.translation(shift, 0))
+        reproject_band(band, shifted, dict(config, use_plan_cache=True))
+    assert len(reprojection._plan_cache) == 2
+    assert reprojection._plan_cache_stats["bytes"] == 2 * plan_bytes
+    reprojection.clear_plan_cache()
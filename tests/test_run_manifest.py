@@ -0,0 +1,138 @@
+import json
+import os
+import shutil
+
+from benchmarks.synthetic_scenes import generate_scenes
+from file_methods.scene_records import scene_fingerprint
+from file_methods.run_manifest import (
+    ACCUMULATOR_FOLDER,
+    load_run_manifest,
+    save_run_manifest,
+    scene_is_current,
+    run_key,
+)
+from landsat_processor import process_landsat_data
+
+METHOD, SUFFIX, GRID = "surface_temp", "st", "grid_a"
+
+
+def write_scene(folder, cloud_cover="10"):
+    os.makedirs(folder, exist_ok=True)
+    band_paths = {
+        "B10": os.path.join(folder, "scene_ST_B10.TIF"),
+        "MTL": os.path.join(folder, "scene_MTL.json"),
+    }
+    with open(band_paths["B10"], "wb") as f:
+        f.write(b"\0" * 64)
+    with open(band_paths["MTL"], "w") as f:
+        json.dump({"LANDSAT_METADATA_FILE": {"CLOUD_COVER": cloud_cover}}, f)
+    return band_paths
+
+
+def record_scene(output_path, band_paths):
+    # What an incremental run records after writing a scene
+    output = os.path.join(output_path, "scene_st.tif")
+    open(output, "w").close()
+    entry = load_run_manifest(output_path, METHOD, SUFFIX, GRID)
+    entry["scenes"]["scene"] = {
+        "fingerprint": scene_fingerprint(band_paths),
+        "outputs": [output],
+    }
+    save_run_manifest(output_path, METHOD, SUFFIX, entry)
+    return output
+
+
+def test_unchanged_scene_is_current(tmp_path):
+    band_paths = write_scene(tmp_path / "scene")
+    record_scene(tmp_path, band_paths)
+    entry = load_run_manifest(tmp_path, METHOD, SUFFIX, GRID)
+    assert scene_is_current(entry, "scene", scene_fingerprint(band_paths))
+
+
+def test_changed_input_invalidates_scene(tmp_path):
+    band_paths = write_scene(tmp_path / "scene")
+    record_scene(tmp_path, band_paths)
+    entry = load_run_manifest(tmp_path, METHOD, SUFFIX, GRID)
+
+    # A rewritten band with the same size, only its modification time changes
+    stat = os.stat(band_paths["B10"])
+    os.utime(band_paths["B10"], ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert not scene_is_current(entry, "scene", scene_fingerprint(band_paths))
+
+
+def test_reprocessed_mtl_invalidates_scene(tmp_path):
+    band_paths = write_scene(tmp_path / "scene")
+    record_scene(tmp_path, band_paths)
+    entry = load_run_manifest(tmp_path, METHOD, SUFFIX, GRID)
+
+    # Same size and modification time, different content
+    stat = os.stat(band_paths["MTL"])
+    write_scene(tmp_path / "scene", cloud_cover="20")
+    os.utime(band_paths["MTL"], ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert os.path.getsize(band_paths["MTL"]) == stat.st_size
+    assert not scene_is_current(entry, "scene", scene_fingerprint(band_paths))
+
+
+def test_missing_output_invalidates_scene(tmp_path):
+    band_paths = write_scene(tmp_path / "scene")
+    output = record_scene(tmp_path, band_paths)
+    os.remove(output)
+    entry = load_run_manifest(tmp_path, METHOD, SUFFIX, GRID)
+    assert not scene_is_current(entry, "scene", scene_fingerprint(band_paths))
+
+
+def test_grid_or_qa_mask_change_starts_over(tmp_path):
+    band_paths = write_scene(tmp_path / "scene")
+    record_scene(tmp_path, band_paths)
+    assert load_run_manifest(tmp_path, METHOD, SUFFIX, GRID)["scenes"]
+    assert not load_run_manifest(tmp_path, METHOD, SUFFIX, "grid_b")["scenes"]
+    assert not load_run_manifest(tmp_path, METHOD, SUFFIX, GRID, ["cloud"])["scenes"]
+    # Other methods and suffixes have their own entries
+    assert not load_run_manifest(tmp_path, METHOD, "other", GRID)["scenes"]
+
+
+def test_discarded_entry_removes_its_outputs(tmp_path):
+    band_paths = write_scene(tmp_path / "scene")
+    output = record_scene(tmp_path, band_paths)
+    entry = load_run_manifest(tmp_path, METHOD, SUFFIX, GRID)
+    group_output = tmp_path / "2022_average_st.tif"
+    group_accumulator = tmp_path / "2022_average.npz"
+    for path in [group_output, group_accumulator]:
+        path.touch()
+    entry["groups"]["2022_average"] = {
+        "output": str(group_output),
+        "accumulator": str(group_accumulator),
+    }
+    save_run_manifest(tmp_path, METHOD, SUFFIX, entry)
+
+    load_run_manifest(tmp_path, METHOD, SUFFIX, "grid_b")
+    assert not any(
+        os.path.exists(path) for path in [output, group_output, group_accumulator]
+    )
+
+
+def test_group_without_scenes_is_removed(tmp_path):
+    # Three scenes, the second is the only one of 2021
+    input_folder = tmp_path / "landsat"
+    scenes = sorted(generate_scenes(input_folder, 3, 64, 64, years=2))
+    output_path = tmp_path / "output"
+    os.makedirs(output_path)
+    method = "averaged_yearly_ndvi"
+    accumulators = output_path / ACCUMULATOR_FOLDER / run_key(method, "avg")
+
+    process_landsat_data(
+        str(input_folder), method, str(output_path), "avg", incremental=True
+    )
+    assert sorted(os.listdir(accumulators)) == [
+        "2020_average.npz",
+        "2021_average.npz",
+    ]
+
+    shutil.rmtree(next(scene for scene in scenes if "_2021" in scene))
+    process_landsat_data(
+        str(input_folder), method, str(output_path), "avg", incremental=True
+    )
+    assert os.listdir(accumulators) == ["2020_average.npz"]
+    assert sorted(
+        file for file in os.listdir(output_path) if file.endswith(".tif")
+    ) == ["2020_average_avg.tif"]
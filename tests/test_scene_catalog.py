@@ -0,0 +1,34 @@
+import json
+import os
+
+from benchmarks.synthetic_scenes import generate_scenes
+from file_methods.scene_catalog import load_mtl
+from landsat_processor import build_scene_library
+
+
+def set_cloud_cover(mtl_path, cloud_cover):
+    with open(mtl_path, "r") as f:
+        mtl = json.load(f)
+    mtl["LANDSAT_METADATA_FILE"]["IMAGE_ATTRIBUTES"]["CLOUD_COVER"] = cloud_cover
+    # Rewritten in place, the scene folder's modification time stays the same
+    with open(mtl_path, "w") as f:
+        json.dump(mtl, f)
+
+
+def test_rewritten_mtl_is_rescanned(tmp_path):
+    input_folder = str(tmp_path / "landsat")
+    scene_folders = sorted(generate_scenes(input_folder, 2, 16, 16))
+    library = build_scene_library(input_folder, catalog=True)
+    for scene in library:
+        set_cloud_cover(library[scene]["MTL"], "90.0")
+    build_scene_library(input_folder, catalog=True)
+
+    folder_mtime_ns = os.stat(scene_folders[0]).st_mtime_ns
+    mtl_path = library[scene_folders[0]]["MTL"]
+    set_cloud_cover(mtl_path, "5.0")
+    assert os.stat(scene_folders[0]).st_mtime_ns == folder_mtime_ns
+
+    clear_library = build_scene_library(input_folder, max_cloud_cover=10)
+    assert list(clear_library) == [scene_folders[0]]
+    attributes = load_mtl(mtl_path)["LANDSAT_METADATA_FILE"]["IMAGE_ATTRIBUTES"]
+    assert attributes["CLOUD_COVER"] == "5.0"
@@ -0,0 +1,75 @@
+import os
+from functools import partial
+
+import numpy as np
+from affine import Affine
+from rasterio.crs import CRS
+
+from calc.bulk_processing_methods import (
+    accumulate_scene,
+    average_bands,
+    finalize_accumulator,
+    merge_accumulators,
+)
+from execution.task_graph import bulk_task_graph, run_task_graph_in_pool
+
+NODATA = 0
+SCENES = 11
+
+
+def processed_scene(seed, reprojection_config=None):
+    # Stands in for a folder_process, scenes are numbered instead of read
+    rng = np.random.default_rng(seed)
+    band = rng.normal(300, 10, (40, 30)).astype(np.float32)
+    band[rng.random(band.shape) < 0.2] = NODATA
+    band[0, 0] = np.nan
+    return {
+        "band": band,
+        "meta": {
+            "crs": CRS.from_epsg(32617),
+            "transform": Affine(30, 0, 600000, 0, -30, 4000000),
+            "nodata": NODATA,
+        },
+        "mtl": {"LANDSAT_METADATA_FILE": {}},
+    }
+
+
+def save_output(output_folder, group, result):
+    np.save(os.path.join(output_folder, f"{group}.npy"), result["band"])
+    np.save(os.path.join(output_folder, f"{group}_count.npy"), result["count"])
+
+
+def test_merged_partials_match_single_pass():
+    single = average_bands([processed_scene(seed) for seed in range(SCENES)])
+
+    # Partials of uneven size, as workers would produce them
+    partials = {}
+    for seed in range(SCENES):
+        accumulate_scene(partials, seed % 3, processed_scene(seed))
+    merged = partials[0]
+    for group in [1, 2]:
+        merge_accumulators(merged, partials[group])
+    merged = finalize_accumulator(merged)
+
+    assert np.array_equal(merged["count"], single["count"])
+    np.testing.assert_allclose(merged["band"], single["band"], rtol=1e-6)
+
+
+def test_task_graph_reduction_matches_single_pass(tmp_path):
+    single = average_bands([processed_scene(seed) for seed in range(SCENES)])
+
+    # Every scene in one group, a fan in of 2 gives a four level reduction tree
+    scene_library = {f"scene_{seed}": seed for seed in range(SCENES)}
+    graph = bulk_task_graph(
+        {scene: "all" for scene in scene_library},
+        scene_library,
+        processed_scene,
+        None,
+        partial(save_output, str(tmp_path)),
+        str(tmp_path),
+        fan_in=2,
+    )
+    run_task_graph_in_pool(graph, 2)
+
+    assert np.array_equal(np.load(tmp_path / "all_count.npy"), single["count"])
+    np.testing.assert_allclose(np.load(tmp_path / "all.npy"), single["band"], rtol=1e-6)
@@ -0,0 +1,30 @@
+import sqlite3
+
+import pytest
+
+from execution.work_queue import create_work_queue, load_main_module, queue_info
+
+
+def test_main_script_is_copied_next_to_the_queue(tmp_path):
+    queue_path = tmp_path / "work_queue.sqlite"
+    create_work_queue(str(queue_path), {})
+    connection = sqlite3.connect(queue_path)
+    info = queue_info(connection)
+    connection.close()
+    # Under pytest the main script may be missing, then nothing is copied
+    if info["main_path"]:
+        assert info["main_path"] == str(queue_path) + ".main.py"
+        assert (tmp_path / "work_queue.sqlite.main.py").exists()
+
+
+def test_main_script_outside_the_queue_folder_is_refused(tmp_path):
+    queue_folder = tmp_path / "queue"
+    queue_folder.mkdir()
+    script = tmp_path / "main.py"
+    script.write_text("raise SystemExit('must not run')\n")
+    queue_path = str(queue_folder / "work_queue.sqlite")
+    with pytest.raises(Exception, match="Refusing"):
+        load_main_module(queue_path, str(script))
+    # A relative path that climbs out of the folder is refused too
+    with pytest.raises(Exception, match="Refusing"):
+        load_main_module(queue_path, str(queue_folder / ".." / "main.py"))